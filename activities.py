@@ -1,15 +1,123 @@
-from threading import Thread
+from threading import Thread, Condition, Lock, BoundedSemaphore, local
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from contextlib import contextmanager
 from urllib.parse import urljoin
+from requests.adapters import HTTPAdapter
+from doors import DoorRegistry
+import transfer
+import bootstrap
+import metrics
 import tempfile
 import os
 import requests
 import time
 import zipfile
+import tarfile
 import shutil
 import subprocess
+import collections
+import json
+import sys
+import multiprocessing
+
+ARCHIVES = metrics.REGISTRY.counter('archives_total', 'Archives processed by the unarchive activity, by outcome', ['outcome'])
+ARCHIVE_SECONDS = metrics.REGISTRY.histogram('archive_seconds', 'Time to download, extract and upload an archive',
+                                             buckets=[0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800])
+UPLOADED_BYTES = metrics.REGISTRY.counter('uploaded_bytes_total', 'Bytes uploaded by the unarchive activity')
+COMMANDS = metrics.REGISTRY.counter('commands_total', 'Commands started by the execute activity, by mode', ['mode'])
+COMMAND_FAILURES = metrics.REGISTRY.counter('command_failures_total', 'Commands that exited with a non-zero status')
+
+# The inotify events each callback depends on.  Moves whose other half is
+# not seen are reported as a new or deleted file or directory.
+CALLBACK_FLAGS = {'onNewFile': ['IN_CLOSE_WRITE', 'IN_MOVED_TO'],
+                  'onDeletedFile': ['IN_DELETE', 'IN_MOVED_FROM'],
+                  'onFileMetadataChanged': ['IN_ATTRIB'],
+                  'onMovedFile': ['IN_MOVED_FROM', 'IN_MOVED_TO'],
+                  'onNewDirectory': ['IN_CREATE', 'IN_MOVED_TO'],
+                  'onDeletedDirectory': ['IN_DELETE', 'IN_MOVED_FROM'],
+                  'onDirMetadataChanged': ['IN_ATTRIB'],
+                  'onMovedDirectory': ['IN_MOVED_FROM', 'IN_MOVED_TO']}
+
+# One event, as passed to onEvents.  targetPath is only set for moves.
+Event = collections.namedtuple('Event', ['operation', 'path', 'targetPath'], defaults=[None])
+
+# The callback for each kind of event.
+OPERATIONS = {'NEW_FILE': 'onNewFile',
+              'DELETED_FILE': 'onDeletedFile',
+              'FILE_METADATA_CHANGED': 'onFileMetadataChanged',
+              'MOVED_FILE': 'onMovedFile',
+              'NEW_DIR': 'onNewDirectory',
+              'DELETED_DIR': 'onDeletedDirectory',
+              'DIR_METADATA_CHANGED': 'onDirMetadataChanged',
+              'MOVED_DIR': 'onMovedDirectory'}
+
+class EventNumbers:
+    """
+    Number the events given to the activities, so an activity that holds
+    events back can say which is the oldest it holds.  Each thread has a
+    current event: the one it is passing on.  An activity that passes on
+    an event later, or from another thread, makes that event current while
+    doing so, with handling.
+    """
+
+    def __init__(self):
+        self.__last = 0
+        self.__local = local()
+
+    def next(self):
+        "Number a new event, making it the calling thread's current event"
+        self.__last += 1
+        self.__local.current = self.__last
+        return self.__last
+
+    def current(self):
+        "Return the number of the calling thread's current event"
+        return getattr(self.__local, 'current', self.__last)
+
+    @contextmanager
+    def handling(self, number):
+        "Make number the calling thread's current event for the duration"
+        previous = self.current()
+        self.__local.current = number
+        try:
+            yield
+        finally:
+            self.__local.current = previous
+
+EVENT_NUMBERS = EventNumbers()
+
+
+def oldest_of(*numbers):
+    "Return the lowest of these event numbers, ignoring None, or None if there are none"
+    numbers = [n for n in numbers if n is not None]
+    return min(numbers) if numbers else None
+
 
 class BaseActivity:
-    """The base class that does nothing when presented with events."""
+    """
+    The base class that does nothing when presented with events.
+
+    An activity may list the inotify flags it needs in INOTIFY_FLAGS;
+    otherwise they are inferred from the callbacks it overrides.  An
+    activity that only overrides onEvents must list them.
+
+    An activity that holds events back, rather than acting on them before
+    the callback returns, reports the number of the oldest it holds (see
+    EventNumbers) from oldest_held, so the checkpoint does not move past it.
+    """
+
+    INOTIFY_FLAGS = None
+
+    @classmethod
+    def inotifyFlags(cls):
+        "Return the set of inotify flags for the events this activity handles"
+        if cls.INOTIFY_FLAGS is not None:
+            return set(cls.INOTIFY_FLAGS)
+        flags = set()
+        for callback, needed in CALLBACK_FLAGS.items():
+            if getattr(cls, callback) is not getattr(BaseActivity, callback):
+                flags.update(needed)
+        return flags
 
     def onNewFile(self, path):
         pass
@@ -38,12 +146,166 @@ class BaseActivity:
     def onEventLoss(self):
         pass
 
+    def onEvents(self, events):
+        "Handle a batch of Events, in order, by calling the callback for each"
+        for event in events:
+            callback = getattr(self, OPERATIONS[event.operation])
+            if event.targetPath is None:
+                callback(event.path)
+            else:
+                callback(event.path, event.targetPath)
+
+    def oldest_held(self):
+        "Return the number of the oldest event held back, or None"
+        return None
+
     def close(self):
         pass
 
 
+class TimedActivity(BaseActivity):
+    """Pass events to another activity, recording how long each callback takes."""
+
+    def __init__(self, activity):
+        self.__activity = activity
+
+    def onNewFile(self, path):
+        with metrics.CALLBACKS.time('onNewFile'):
+            self.__activity.onNewFile(path)
+
+    def onDeletedFile(self, path):
+        with metrics.CALLBACKS.time('onDeletedFile'):
+            self.__activity.onDeletedFile(path)
+
+    def onFileMetadataChanged(self, path):
+        with metrics.CALLBACKS.time('onFileMetadataChanged'):
+            self.__activity.onFileMetadataChanged(path)
+
+    def onMovedFile(self, fromPath, toPath):
+        with metrics.CALLBACKS.time('onMovedFile'):
+            self.__activity.onMovedFile(fromPath, toPath)
+
+    def onNewDirectory(self, path):
+        with metrics.CALLBACKS.time('onNewDirectory'):
+            self.__activity.onNewDirectory(path)
+
+    def onDeletedDirectory(self, path):
+        with metrics.CALLBACKS.time('onDeletedDirectory'):
+            self.__activity.onDeletedDirectory(path)
+
+    def onDirMetadataChanged(self, path):
+        with metrics.CALLBACKS.time('onDirMetadataChanged'):
+            self.__activity.onDirMetadataChanged(path)
+
+    def onMovedDirectory(self, fromPath, toPath):
+        with metrics.CALLBACKS.time('onMovedDirectory'):
+            self.__activity.onMovedDirectory(fromPath, toPath)
+
+    def onEventLoss(self):
+        with metrics.CALLBACKS.time('onEventLoss'):
+            self.__activity.onEventLoss()
+
+    def onEvents(self, events):
+        with metrics.CALLBACKS.time('onEvents'):
+            self.__activity.onEvents(events)
+
+    def oldest_held(self):
+        return self.__activity.oldest_held()
+
+    def close(self):
+        self.__activity.close()
+
+
+class BatchingActivity(BaseActivity):
+    """
+    Collect events and pass them to the wrapped activity's onEvents, in
+    batches of at most max_size events.  A smaller batch is passed on once
+    its oldest event has waited max_latency seconds, which relies on
+    flush_expired being called regularly.  Event loss is reported after
+    any waiting events.
+    """
+
+    def __init__(self, activity, max_size=100, max_latency=0.1):
+        self.__activity = activity
+        self.__max_size = max_size
+        self.__max_latency = max_latency
+        self.__batch = []
+        self.__batch_started = None
+        self.__batch_number = None
+        self.__lock = Lock()
+
+    def onNewFile(self, path):
+        self.__add(Event('NEW_FILE', path))
+
+    def onDeletedFile(self, path):
+        self.__add(Event('DELETED_FILE', path))
+
+    def onFileMetadataChanged(self, path):
+        self.__add(Event('FILE_METADATA_CHANGED', path))
+
+    def onMovedFile(self, fromPath, toPath):
+        self.__add(Event('MOVED_FILE', fromPath, toPath))
+
+    def onNewDirectory(self, path):
+        self.__add(Event('NEW_DIR', path))
+
+    def onDeletedDirectory(self, path):
+        self.__add(Event('DELETED_DIR', path))
+
+    def onDirMetadataChanged(self, path):
+        self.__add(Event('DIR_METADATA_CHANGED', path))
+
+    def onMovedDirectory(self, fromPath, toPath):
+        self.__add(Event('MOVED_DIR', fromPath, toPath))
+
+    def onEvents(self, events):
+        for event in events:
+            self.__add(event)
+
+    def onEventLoss(self):
+        with self.__lock:
+            self.__flush()
+        self.__activity.onEventLoss()
+
+    def flush_expired(self):
+        "Pass on the waiting events if the oldest has waited max_latency seconds"
+        with self.__lock:
+            if self.__batch and time.monotonic() - self.__batch_started >= self.__max_latency:
+                self.__flush()
+
+    def oldest_held(self):
+        return oldest_of(self.__batch_number, self.__activity.oldest_held())
+
+    def __add(self, event):
+        with self.__lock:
+            if not self.__batch:
+                self.__batch_started = time.monotonic()
+                self.__batch_number = EVENT_NUMBERS.current()
+            self.__batch.append(event)
+            if len(self.__batch) >= self.__max_size:
+                self.__flush()
+
+    def __flush(self):
+        "Pass on all waiting events; the caller must hold the lock"
+        if self.__batch:
+            (batch, self.__batch) = (self.__batch, [])
+            try:
+                with EVENT_NUMBERS.handling(self.__batch_number):
+                    self.__activity.onEvents(batch)
+            finally:
+                self.__batch_number = None
+
+    def close(self):
+        with self.__lock:
+            self.__flush()
+        self.__activity.close()
+
+
 class HttpBasedActivity(BaseActivity):
-    """Any activity that makes use of python's Requests library."""
+    """
+    Any activity that makes use of python's Requests library.  Sessions are
+    not thread-safe, so each thread is given its own session.
+    """
     def __init__(self, *args, **kwargs):
         if kwargs is None:
             raise Exception('Missing kwargs in HttpBasedActivity')
@@ -56,17 +318,25 @@ class HttpBasedActivity(BaseActivity):
         if self.__args is None:
             raise Exception('Missing args in HttpBasedActivity')
 
-        self.__session = None
+        self.__local = local()
+        self.__sessions = []
+        self.__sessions_lock = Lock()
 
     def session(self):
-        if self.__session is None:
-            self.__session = self.__session_factory(self.__args)
-        return self.__session
+        session = getattr(self.__local, 'session', None)
+        if session is None:
+            session = self.__session_factory(self.__args)
+            self.__local.session = session
+            with self.__sessions_lock:
+                self.__sessions.append(session)
+        return session
 
     def close(self):
-        if self.__session is not None:
-            self.__session.close()
-            self.__session = None
+        with self.__sessions_lock:
+            for session in self.__sessions:
+                session.close()
+            self.__sessions = []
+        self.__local = local()
 
 
 class FrontendBasedActivity(HttpBasedActivity):
@@ -85,6 +355,9 @@ class FrontendBasedActivity(HttpBasedActivity):
     def rest_url(self, path):
         return self.__api_uri + '/' + path ## REVISIT: use URL combining to resolve
 
+    def api_url(self):
+        return self.__api_uri
+
     def close(self):
         super(FrontendBasedActivity, self).close()
 
@@ -97,41 +370,39 @@ class TransferringActivity(FrontendBasedActivity):
     """
     def __init__(self, *args, **kwargs):
         super(TransferringActivity, self).__init__(*args, **kwargs)
-        self.__doors = None
+        self.__doors = DoorRegistry(self.__discoverDoors, ttl=kwargs.get('door_ttl', 60))
+        self.__mounted = local()
 
     def __discoverDoors(self):
         r = self.session().get(self.rest_url("doors"))
         r.raise_for_status()
         return r.json()
 
-    def __load(self, door_info):
-        return door_info['load']
-
     def doors(self, protocol, tags):
-        """Return the URL of a door with this protocol"""
-        ## REVISIT: should cached value expires after some time?
-        if not self.__doors:
-            self.__doors = self.__discoverDoors()
-
-        selected_doors = []
-        for door in self.__doors:
-            if door['protocol'] != protocol:
-                continue
-            if not tags or all(elem in door['tags'] for elem in tags):
-                selected_doors.append(door)
-
-        if not selected_doors:
-            raise Exception('No doors match protocol=' + protocol + ', tags=' + str(tags))
-
-        selected_doors.sort(key = self.__load)
-        best_door = selected_doors[0]
-
-        addresses = set(best_door['addresses'])
-        address = addresses.pop() # What if there are multiple interfaces?
-        return "%s://%s:%d/" % (protocol, address, best_door['port'])
+        """
+        Return the URL of a door with this protocol.  Each door address
+        gets its own connection pool in the calling thread's session; once
+        the list of doors is refreshed, the pools of doors that have gone
+        are closed.
+        """
+        url = self.__doors.select(protocol, tags)
+        session = self.session()
+        (generation, mounted) = getattr(self.__mounted, 'adapters', (0, set()))
+        if generation != self.__doors.generation:
+            generation = self.__doors.generation
+            current = self.__doors.urls()
+            for gone in mounted - current:
+                session.adapters.pop(gone).close()
+            mounted &= current
+        if url not in mounted:
+            session.mount(url, HTTPAdapter())
+            mounted.add(url)
+        self.__mounted.adapters = (generation, mounted)
+        return url
 
 
     def close(self):
+        self.__doors.close()
         super(TransferringActivity, self).close()
 
 
@@ -164,74 +435,336 @@ class PrintActivity(BaseActivity):
     def onEventLoss(self):
         print("EVENT LOSS")
 
+    MESSAGES = {'NEW_FILE': "NEW FILE %s",
+                'DELETED_FILE': "DELETED FILE %s",
+                'FILE_METADATA_CHANGED': "FILE METADATA CHANGED %s",
+                'MOVED_FILE': "FILE MOVED FROM %s TO %s",
+                'NEW_DIR': "NEW DIRECTORY %s/",
+                'DELETED_DIR': "DELETED DIRECTORY %s/",
+                'DIR_METADATA_CHANGED': "DIRECTORY METADATA CHANGED %s",
+                'MOVED_DIR': "DIRECTORY MOVED FROM %s/ TO %s/"}
+
+    def onEvents(self, events):
+        "Print a batch of events with a single write"
+        lines = []
+        for event in events:
+            if event.targetPath is None:
+                lines.append(self.MESSAGES[event.operation] % event.path)
+            else:
+                lines.append(self.MESSAGES[event.operation] % (event.path, event.targetPath))
+        lines.append("")
+        sys.stdout.write("\n".join(lines))
+
+
+def _unpack(local_archive, target_dir, archive_format):
+    "Extract an archive file into target_dir; a module-level function, so it may run in another process"
+    # Python versions with extraction filters warn unless one is given.
+    if archive_format in UnarchiveActivity.TAR_FORMATS and hasattr(tarfile, 'data_filter'):
+        shutil.unpack_archive(local_archive, target_dir, archive_format, filter='data')
+    else:
+        shutil.unpack_archive(local_archive, target_dir, archive_format)
+
+
+def _ready():
+    pass
+
 
 class UnarchiveActivity(TransferringActivity):
-    """Extract newly uploaded archive files to a target directory"""
+    """
+    Extract newly uploaded archive files to a target directory.  Tar
+    archives are extracted while they are downloaded; other archives are
+    downloaded, in chunks of buffer_size bytes, to a temporary file first.
+
+    At most archive_workers archives are processed at any time; any others
+    wait their turn.  Each archive uploads at most upload_workers of its
+    members concurrently.  Archives are transferred through WebDAV doors
+    using door_protocol, which is 'https' unless specified otherwise.
+
+    Archives of at least parallel_threshold bytes are instead downloaded
+    as parts of part_size bytes, download_workers at a time, possibly
+    through different doors, and verified against their checksum before
+    being extracted.  If download_dir is given, these downloads are kept
+    there until extracted, so a restarted client resumes them.
+
+    If download_dir is given, a manifest of the members uploaded so far is
+    kept there for each archive, and archives left unfinished by an earlier
+    run are extracted again when the activity starts, skipping the members
+    already uploaded.  When an archive is extracted again, members already
+    in the target with the same size and checksum are not uploaded again
+    either; the target directories are listed once to find them.
+
+    If extract_processes is given, archives are downloaded to a file and
+    extracted by a pool of that many worker processes, so decompression
+    does not compete for the interpreter lock with reading events.  The
+    extracted members are handed back through the temporary directory.
+    """
+
+    TAR_FORMATS = ['tar', 'gztar', 'bztar', 'xztar']
 
     def __init__(self, *args, **kwargs):
         super(UnarchiveActivity, self).__init__(*args, **kwargs)
+        self.__processes = None
+        if kwargs.get('extract_processes'):
+            # The workers are forked, all at once, on the first submission.
+            # Doing this now means they are forked before this activity
+            # starts any threads of its own.
+            self.__processes = ProcessPoolExecutor(max_workers=kwargs['extract_processes'],
+                                                   mp_context=multiprocessing.get_context('fork'))
+            self.__processes.submit(_ready).result()
         targetPath = args[0]
         print("Extracting archives into %s" % targetPath)
-        self.__threads = []
-        webdav_url = self.doors('https', ['dcache-view'])
-        self.__download_url = webdav_url
-        self.__target_url = urljoin(webdav_url, targetPath + '/')
-        self.__extensions = [e for f in shutil.get_unpack_formats() for e in f[1]]
+        archive_workers = kwargs.get('archive_workers') or 4
+        self.__upload_workers = kwargs.get('upload_workers') or 4
+        self.__archives = ThreadPoolExecutor(max_workers=archive_workers,
+                                             thread_name_prefix="unarchive")
+        self.__uploads = ThreadPoolExecutor(max_workers=archive_workers * self.__upload_workers,
+                                            thread_name_prefix="upload")
+        self.__pending = {}
+        self.__pending_lock = Lock()
+        self.__door_protocol = kwargs.get('door_protocol') or 'https'
+        self.doors(self.__door_protocol, ['dcache-view']) # Fail early if there is no suitable door.
+        self.__target_path = targetPath + '/'
+        self.__formats = {e: f[0] for f in shutil.get_unpack_formats() for e in f[1]}
+        self.__buffer_size = kwargs.get('buffer_size') or 1024*1024
+        self.__parallel_threshold = kwargs.get('parallel_threshold') or 256*1024*1024
+        self.__part_size = kwargs.get('part_size') or 64*1024*1024
+        self.__download_dir = kwargs.get('download_dir')
+        self.__download_workers = kwargs.get('download_workers') or 4
+        self.__downloads = ThreadPoolExecutor(max_workers=archive_workers * self.__download_workers,
+                                              thread_name_prefix="download")
+        if self.__download_dir:
+            for (path, extension) in transfer.Manifest.pending(self.__download_dir):
+                print("Resuming extraction of archive: %s" % path)
+                self.__submit(path, extension)
 
 
     def onNewFile(self, path):
-        for extension in self.__extensions:
+        for extension in self.__formats:
             if path.endswith(extension):
                 print("Extracting files from archive: %s (%s)" % (path,extension))
-                thread = Thread(target = self.extract, args = (path,extension))
-                thread.start()
-                self.__threads.append(thread)
+                self.__submit(path, extension)
                 break
 
+    def __submit(self, path, extension):
+        with self.__pending_lock:
+            if path in self.__pending:
+                print("Archive %s is already being extracted" % path)
+                return
+            future = self.__archives.submit(self.extract, path, extension)
+            self.__pending[path] = future
+        started = time.monotonic()
+        future.add_done_callback(lambda f, path=path, started=started: self.__extracted(f, path, started))
+
+    def __extracted(self, future, path, started):
+        with self.__pending_lock:
+            del self.__pending[path]
+        ARCHIVE_SECONDS.observe(time.monotonic() - started)
+        if future.exception():
+            ARCHIVES.inc('failed')
+            print("Failed to extract %s: %s" % (path, future.exception()))
+        else:
+            ARCHIVES.inc('extracted')
+
 
     def extract(self, path, extension):
         name = os.path.basename(path)[:-len(extension)] # REVISIT: shouldn't this be OS independent?
         localname = 'archive' + extension
-        upload_base_url = urljoin(self.__target_url, name + '/');
+        upload_base_path = self.__target_path + name + '/'
 
         with tempfile.TemporaryDirectory() as tmpdirname:
             local_archive = os.path.join(tmpdirname, localname)
-
-            url = urljoin(self.__download_url, path)
-            print("Downloading %s into %s" % (url, local_archive))
-            r = self.session().get(url, allow_redirects=True)
-            open(local_archive, 'wb').write(r.content)
-
             target_dir = os.path.join(tmpdirname, 'contents')
-            shutil.unpack_archive(local_archive, target_dir)
-
-            for r, d, f in os.walk(target_dir):
-                for file in f:
-                    abs_path = os.path.join(r, file)
-                    rel_path = os.path.relpath(abs_path, target_dir)
-                    upload_url = urljoin(upload_base_url, rel_path)
 
-                    print("    UPLOADING %s to %s" % (abs_path, upload_url))
-                    with open(abs_path, 'rb') as data:
-                        self.session().put(upload_url, data=data)
+            (size, checksum) = transfer.file_info(self.session(), self.rest_url("namespace" + path))
+            parallel = size >= self.__parallel_threshold
+            manifest = None
+            if self.__download_dir:
+                manifest = transfer.Manifest(self.__download_dir, path, extension, size, checksum)
+            if parallel:
+                if self.__download_dir:
+                    local_archive = os.path.join(self.__download_dir, transfer.local_name(path))
+                self.__download(path, local_archive, size, checksum)
+                print("Extracting %s into %s" % (local_archive, target_dir))
+                self.__unpack(local_archive, target_dir, extension)
+            else:
+                url = urljoin(self.doors(self.__door_protocol, ['dcache-view']), path)
+                with self.session().get(url, allow_redirects=True, stream=True) as r:
+                    r.raise_for_status()
+                    if self.__formats[extension] in self.TAR_FORMATS and not self.__processes:
+                        print("Extracting %s into %s" % (url, target_dir))
+                        self.__extract_tar_stream(r, target_dir)
+                    else:
+                        print("Downloading %s into %s" % (url, local_archive))
+                        with open(local_archive, 'wb') as f:
+                            for chunk in r.iter_content(chunk_size=self.__buffer_size):
+                                f.write(chunk)
+                        self.__unpack(local_archive, target_dir, extension)
+
+            try:
+                self.__upload_all(target_dir, upload_base_path, manifest)
+            finally:
+                if manifest:
+                    manifest.close()
+            if manifest:
+                manifest.remove()
+            if parallel and self.__download_dir:
+                os.remove(local_archive)
+
+    def __download(self, path, local_archive, size, checksum):
+        "Download an archive in parallel ranges, resuming any earlier attempt"
+        print("Downloading %s (%d bytes) into %s in parts of %d bytes"
+              % (path, size, local_archive, self.__part_size))
+        download = transfer.Download(self.session, lambda: self.doors(self.__door_protocol, ['dcache-view']),
+                                     path, local_archive, size, checksum,
+                                     part_size=self.__part_size, workers=self.__download_workers,
+                                     buffer_size=self.__buffer_size)
+        download.run(self.__downloads)
+
+    def __unpack(self, local_archive, target_dir, extension):
+        "Extract a downloaded archive, in a worker process if there are any"
+        if self.__processes:
+            self.__processes.submit(_unpack, local_archive, target_dir, self.__formats[extension]).result()
+        else:
+            _unpack(local_archive, target_dir, self.__formats[extension])
+
+    def __upload_all(self, target_dir, upload_base_path, manifest=None):
+        """
+        Upload the extracted members of an archive, upload_workers at a
+        time, skipping those the manifest records and, if this is a
+        further attempt, those already in the target with the same size
+        and checksum.
+        """
+        members = []
+        for r, d, f in os.walk(target_dir):
+            for file in f:
+                abs_path = os.path.join(r, file)
+                members.append((abs_path, os.path.relpath(abs_path, target_dir).replace(os.sep, '/')))
+
+        if manifest:
+            members = [(abs_path, rel_path) for (abs_path, rel_path) in members
+                       if manifest.uploaded.get(rel_path) != os.path.getsize(abs_path)]
+        existing = {}
+        if manifest and manifest.resumed:
+            existing = self.__existing(upload_base_path, [rel_path for (_, rel_path) in members])
+        remaining = []
+        for (abs_path, rel_path) in members:
+            if self.__unchanged(abs_path, existing.get(rel_path)):
+                if manifest:
+                    manifest.done(rel_path, os.path.getsize(abs_path))
+            else:
+                remaining.append((abs_path, rel_path))
+        if (manifest and manifest.uploaded) or len(remaining) < len(members):
+            print("Uploading %d members to %s; the others were uploaded before"
+                  % (len(remaining), upload_base_path))
+
+        slots = BoundedSemaphore(self.__upload_workers)
+        uploads = []
+        for (abs_path, rel_path) in remaining:
+            slots.acquire()
+            upload = self.__uploads.submit(self.__upload, abs_path, upload_base_path + rel_path)
+            upload.add_done_callback(lambda f: slots.release())
+            if manifest:
+                upload.add_done_callback(lambda f, rel_path=rel_path, size=os.path.getsize(abs_path):
+                                         self.__uploaded(f, manifest, rel_path, size))
+            uploads.append(upload)
+
+        wait(uploads)
+        failures = [u.exception() for u in uploads if u.exception()]
+        if failures:
+            raise Exception('%d of %d uploads failed, first: %s'
+                            % (len(failures), len(uploads), failures[0]))
+
+    def __uploaded(self, future, manifest, rel_path, size):
+        if not future.exception():
+            manifest.done(rel_path, size)
+
+    def __existing(self, upload_base_path, members):
+        "Return the namespace entries of those members already in the target, listing each directory once"
+        directories = {member.rpartition('/')[0] for member in members}
+        existing = {}
+        for directory in directories:
+            prefix = directory + '/' if directory else ''
+            try:
+                for item in bootstrap.iter_children(self.session(), self.api_url(),
+                                                    (upload_base_path + directory).rstrip('/'), checksums=True):
+                    existing[prefix + item["fileName"]] = item
+            except requests.exceptions.HTTPError as e:
+                if e.response.status_code != 404:
+                    raise
+        return existing
+
+    def __unchanged(self, abs_path, item):
+        "Whether a namespace entry has the same size and checksum as a local file"
+        if item is None or item["fileType"] != "REGULAR" or item.get("size") != os.path.getsize(abs_path):
+            return False
+        checksum = transfer.supported_checksum(item)
+        return checksum is not None and transfer.checksum_of(abs_path, checksum[0], self.__buffer_size) == checksum[1]
+
+    def __upload(self, abs_path, upload_path):
+        upload_url = urljoin(self.doors(self.__door_protocol, ['dcache-view']), upload_path)
+        print("    UPLOADING %s to %s" % (abs_path, upload_url))
+        with open(abs_path, 'rb') as data:
+            r = self.session().put(upload_url, data=data)
+            r.raise_for_status()
+        UPLOADED_BYTES.inc(amount=os.path.getsize(abs_path))
+
+    def __extract_tar_stream(self, response, target_dir):
+        "Extract a (possibly compressed) tar archive as it is downloaded"
+        response.raw.decode_content = True
+        # Python versions with extraction filters warn unless one is given.
+        options = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+        with tarfile.open(fileobj=response.raw, mode='r|*', bufsize=self.__buffer_size) as tar:
+            tar.extractall(target_dir, **options)
 
     def close(self):
-        isFirst = True
-        for thread in self.__threads:
-            if thread.isAlive():
-                if isFirst:
-                    print("Waiting for background tasks to finish")
-                    isFirst = False
-                thread.join()
+        with self.__pending_lock:
+            if self.__pending:
+                print("Waiting for background tasks to finish")
+        self.__archives.shutdown(wait=True)
+        self.__uploads.shutdown(wait=True)
+        self.__downloads.shutdown(wait=True)
+        if self.__processes:
+            self.__processes.shutdown(wait=True)
         super(UnarchiveActivity, self).close()
 
 
 class ExecuteActivity(BaseActivity):
-    """Run arbitrary command on events"""
+    """
+    Run arbitrary command on events.
+
+    In 'event' mode (the default) the command is run once per event, with
+    the operation and path(s) as arguments.  In 'batch' mode it is run once
+    per batch of events, with the argument BATCH; in 'stream' mode a single,
+    long-lived instance is run with the argument STREAM.  In both cases the
+    events are written to the command's stdin as newline-delimited JSON.  A
+    batch is sent once batch_size events are waiting, or once the oldest
+    has waited batch_latency seconds.
+
+    At most max_processes commands run concurrently.  Finished commands are
+    reaped as new ones are started.
+    """
+
+    MODES = ['event', 'batch', 'stream']
 
     def __init__(self, *args, **kwargs):
         self.command = args[0]
         self.__invocations = []
+        self.__mode = kwargs.get('mode') or 'event'
+        if self.__mode not in self.MODES:
+            raise Exception('Unknown execute mode: ' + str(self.__mode))
+        self.__max_processes = kwargs.get('max_processes') or 16
+        self.__batch_size = kwargs.get('batch_size') or 100
+        self.__batch_latency = kwargs.get('batch_latency') or 1.0
+        self.__batch = []
+        self.__batch_started = None
+        self.__batch_number = None
+        self.__stream = None
+        self.__condition = Condition()
+        self.__closing = False
+        if self.__mode != 'event':
+            self.__flusher = Thread(target=self.__flush_periodically,
+                                    name="execute-flusher", daemon=True)
+            self.__flusher.start()
 
     def onNewFile(self, path):
         self._runCommand("NEW_FILE", path)
@@ -257,18 +790,137 @@ class ExecuteActivity(BaseActivity):
     def onMovedDirectory(self, fromPath, toPath):
         self._runCommand("MOVED_DIR", fromPath, toPath)
 
+    def onEvents(self, events):
+        "In batch and stream modes, queue all events at once; otherwise run the command for each"
+        if self.__mode == 'event':
+            super(ExecuteActivity, self).onEvents(events)
+            return
+
+        with self.__condition:
+            for event in events:
+                self.__queue(event.operation, event.path, event.targetPath)
+
     def _runCommand(self, operation, path, targetPath=None):
+        if self.__mode == 'event':
+            if targetPath:
+                self.__start([self.command, operation, path, targetPath])
+            else:
+                self.__start([self.command, operation, path])
+            return
+
+        with self.__condition:
+            self.__queue(operation, path, targetPath)
+
+    def __queue(self, operation, path, targetPath):
+        "Add an event to the waiting batch; the caller must hold the condition"
+        record = {"operation": operation, "path": path}
         if targetPath:
-            invocation = subprocess.Popen([self.command, operation, path, targetPath])
-        else:
-            invocation = subprocess.Popen([self.command, operation, path])
+            record["targetPath"] = targetPath
+        self.__batch.append(record)
+        if len(self.__batch) == 1:
+            self.__batch_started = time.monotonic()
+            self.__batch_number = EVENT_NUMBERS.current()
+            self.__condition.notify_all()
+        if len(self.__batch) >= self.__batch_size:
+            self.__flush()
+
+    def __start(self, argv, stdin=None):
+        "Run a command once fewer than max_processes commands are running"
+        self.__reap()
+        delay = 0.001
+        while len(self.__invocations) >= self.__max_processes:
+            # Whichever command finishes first frees a slot.  Waiting for
+            # any child with os.wait could also reap processes that are not
+            # commands, so the commands are polled instead.
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+            self.__reap()
+        invocation = subprocess.Popen(argv, stdin=stdin)
+        COMMANDS.inc(self.__mode)
         self.__invocations.append(invocation)
+        return invocation
 
-    def close(self):
-        isFirst = True
+    def __reap(self):
+        running = []
         for invocation in self.__invocations:
-            if invocation.poll() == None:
-                if isFirst:
-                    print("Waiting for command to finish")
-                    isFirst = False
-                thread.wait() # REVISIT add timeout?
+            status = invocation.poll()
+            if status is None:
+                running.append(invocation)
+            elif status != 0:
+                COMMAND_FAILURES.inc()
+                print("Command \"%s\" failed with status %d" % (" ".join(invocation.args), status))
+        self.__invocations = running
+
+    def __flush(self):
+        "Send all waiting events to the command; the caller must hold the condition"
+        if not self.__batch:
+            return
+        data = "".join(json.dumps(record) + "\n" for record in self.__batch).encode()
+        self.__batch = []
+        try:
+            self.__send(data)
+        finally:
+            self.__batch_number = None
+
+    def __send(self, data):
+        "Send events to the command; the caller must hold the condition"
+        if self.__mode == 'batch':
+            invocation = self.__start([self.command, "BATCH"], stdin=subprocess.PIPE)
+            try:
+                invocation.stdin.write(data)
+                invocation.stdin.close()
+            except BrokenPipeError:
+                print("Command \"%s\" did not read all events" % self.command)
+            return
+
+        for attempt in range(2):
+            if self.__stream is None or self.__stream.poll() is not None:
+                if self.__stream is not None:
+                    print("Command \"%s\" exited with status %d, restarting"
+                          % (self.command, self.__stream.returncode))
+                self.__stream = subprocess.Popen([self.command, "STREAM"], stdin=subprocess.PIPE)
+                COMMANDS.inc(self.__mode)
+            try:
+                self.__stream.stdin.write(data)
+                self.__stream.stdin.flush()
+                return
+            except BrokenPipeError:
+                self.__stream.wait()
+        print("Unable to send %d bytes of events to command \"%s\"" % (len(data), self.command))
+
+    def oldest_held(self):
+        return self.__batch_number
+
+    def __flush_periodically(self):
+        with self.__condition:
+            while not self.__closing:
+                if not self.__batch:
+                    self.__condition.wait()
+                    continue
+                remaining = self.__batch_started + self.__batch_latency - time.monotonic()
+                if remaining > 0:
+                    self.__condition.wait(remaining)
+                else:
+                    self.__flush()
+
+    def close(self):
+        if self.__mode != 'event':
+            with self.__condition:
+                self.__closing = True
+                self.__condition.notify_all()
+            self.__flusher.join()
+            with self.__condition:
+                self.__flush()
+            if self.__stream is not None:
+                try:
+                    self.__stream.stdin.close()
+                except BrokenPipeError:
+                    pass
+                self.__invocations.append(self.__stream)
+
+        self.__reap()
+        if self.__invocations:
+            print("Waiting for command to finish")
+            for invocation in self.__invocations:
+                invocation.wait() # REVISIT add timeout?
+            self.__reap()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Measure the client's performance against a local fake dCache frontend.
+
+Each benchmark starts a fake frontend (see fakefrontend.py) in this
+process and runs simple-client.py against it as a separate process.
+Progress is taken from the client's output, its metrics endpoint and the
+fake frontend's counters.
+"""
+import fakefrontend
+import requests
+import subprocess
+import argparse
+import threading
+import tarfile
+import signal
+import socket
+import queue
+import time
+import sys
+import io
+import os
+import re
+
+CLIENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "simple-client.py")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Client:
+    """The client, running in a separate process with its metrics published."""
+
+    def __init__(self, server, *options, root="/data"):
+        self.metrics_port = free_port()
+        self.lines = queue.Queue()
+        argv = [sys.executable, "-u", CLIENT, "--endpoint", server.frontend.base_url + fakefrontend.API,
+                "--password", "benchmark", "--metrics-port", str(self.metrics_port)] + list(options) + [root]
+        self.process = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        universal_newlines=True, bufsize=1)
+        self.__reader = threading.Thread(target=self.__read, daemon=True)
+        self.__reader.start()
+
+    def __read(self):
+        for line in self.process.stdout:
+            self.lines.put((time.time_ns(), line.rstrip("\n")))
+        self.lines.put((time.time_ns(), None))
+
+    def wait_for(self, pattern, timeout=600):
+        "Return the match of the first line of output matching pattern"
+        deadline = time.monotonic() + timeout
+        while True:
+            (_, line) = self.lines.get(timeout=max(0, deadline - time.monotonic()))
+            if line is None:
+                raise Exception('Client exited with status %s' % self.process.wait())
+            match = re.search(pattern, line)
+            if match:
+                return match
+
+    def metric(self, name):
+        "Return the sum of all samples of a metric"
+        text = requests.get("http://127.0.0.1:%d/metrics" % self.metrics_port).text
+        total = 0
+        for line in text.splitlines():
+            if line.startswith("dcache_sse_" + name + " ") or line.startswith("dcache_sse_" + name + "{"):
+                total += float(line.rsplit(" ", 1)[1])
+        return total
+
+    def wait_for_metric(self, name, value, timeout=600):
+        deadline = time.monotonic() + timeout
+        while self.metric(name) < value:
+            if time.monotonic() > deadline:
+                raise Exception('Timed out waiting for %s to reach %d' % (name, value))
+            time.sleep(0.05)
+
+    def stop(self):
+        self.process.send_signal(signal.SIGINT)
+        try:
+            self.process.wait(60)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+def started(depth, fanout, **options):
+    return fakefrontend.start(fakefrontend.Tree(depth=depth, fanout=fanout), **options)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def bench_bootstrap(sizes, fanout, latency, workers):
+    "Time to establish watches on trees of increasing size"
+    print("%-8s %-12s %-10s %s" % ("depth", "directories", "seconds", "watches/s"))
+    for depth in sizes:
+        server = started(depth, fanout, latency=latency)
+        client = Client(server, "-r", "--bootstrap-workers", str(workers))
+        match = client.wait_for(r"Established (\d+) watches in ([\d.]+) seconds")
+        client.stop()
+        server.shutdown()
+        (watches, seconds) = (int(match.group(1)), float(match.group(2)))
+        print("%-8d %-12d %-10.1f %.0f" % (depth, server.frontend.tree.directories(), seconds,
+                                           watches / seconds if seconds else float('inf')))
+
+
+def bench_throughput(activities, count):
+    "Sustained events per second, with events published as fast as possible"
+    print("%-10s %-8s %-10s %s" % ("activity", "events", "seconds", "events/s"))
+    for activity in activities:
+        server = started(2, 4)
+        options = {'print': ["--activity", "print"],
+                   'execute': ["--activity", "execute", "--execute-command", "true",
+                               "--execute-mode", "batch"]}[activity]
+        client = Client(server, "-r", *options)
+        client.wait_for(r"Established \d+ watches")
+        begin = time.monotonic()
+        server.frontend.burst(count)
+        client.wait_for_metric("inotify_events_total", 2 * count)
+        elapsed = time.monotonic() - begin
+        client.stop()
+        server.shutdown()
+        print("%-10s %-8d %-10.2f %.0f" % (activity, 2 * count, elapsed, 2 * count / elapsed))
+
+
+def bench_latency(rate, duration):
+    "Time from an event being published until the activity reports it"
+    server = started(2, 4)
+    client = Client(server, "-r", "--activity", "print")
+    client.wait_for(r"Established \d+ watches")
+    generator = threading.Thread(target=server.frontend.generate, kwargs={'limit': rate * duration},
+                                 daemon=True)
+    server.frontend.rate = rate
+    generator.start()
+    latencies = []
+    while len(latencies) < rate * duration:
+        (received, line) = client.lines.get(timeout=60)
+        match = line and re.search(r"^NEW FILE .*/f-(\d+)$", line)
+        if match:
+            latencies.append((received - int(match.group(1))) / 1e6)
+    client.stop()
+    server.shutdown()
+    print("%d events at %.0f/s: latency p50 %.2f ms, p99 %.2f ms, max %.2f ms"
+          % (len(latencies), rate, percentile(latencies, 50), percentile(latencies, 99), max(latencies)))
+
+
+def archive(members, member_size):
+    "Return a tar archive of members files of member_size bytes each"
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w") as tar:
+        for i in range(members):
+            info = tarfile.TarInfo("member-%d" % i)
+            info.size = member_size
+            tar.addfile(info, io.BytesIO(os.urandom(member_size)))
+    return data.getvalue()
+
+
+def bench_unarchive(archives, members, member_size, workers):
+    "Rate at which archive members are extracted and uploaded"
+    server = started(1, 1)
+    client = Client(server, "--activity", "unarchive", "--target-path", "/extracted",
+                    "--door-protocol", "http", "--unarchive-workers", str(workers))
+    client.wait_for(r"Established \d+ watches")
+    data = archive(members, member_size)
+    begin = time.monotonic()
+    for i in range(archives):
+        server.frontend.new_archive("/data/archive-%d.tar" % i, data)
+    client.wait_for_metric("archives_total", archives)
+    elapsed = time.monotonic() - begin
+    client.stop()
+    server.shutdown()
+    print("%d archives of %d x %d bytes: %.2f seconds, %.0f files/s, %.1f MB/s, %d failed"
+          % (archives, members, member_size, elapsed, server.frontend.uploads / elapsed,
+             server.frontend.uploaded_bytes / elapsed / 1e6, archives * members - server.frontend.uploads))
+
+
+BENCHMARKS = ['bootstrap', 'throughput', 'latency', 'unarchive']
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the client against a fake dCache frontend")
+    parser.add_argument('benchmarks', metavar="BENCHMARK", nargs='*',
+                        help="Which benchmarks to run: %s.  Defaults to all." % ", ".join(BENCHMARKS))
+    parser.add_argument('--depths', metavar="DEPTH", type=int, nargs='+', default=[2, 3, 4],
+                        help="Tree depths for the bootstrap benchmark.")
+    parser.add_argument('--fanout', metavar="COUNT", type=int, default=5,
+                        help="Subdirectories per directory for the bootstrap benchmark.")
+    parser.add_argument('--latency', metavar="SECONDS", type=float, default=0.01,
+                        help="Delay added to each request by the fake frontend in the bootstrap benchmark.")
+    parser.add_argument('--bootstrap-workers', metavar="COUNT", type=int, default=16)
+    parser.add_argument('--activities', nargs='+', choices=['print', 'execute'], default=['print', 'execute'],
+                        help="Activities for the throughput benchmark.")
+    parser.add_argument('--events', metavar="COUNT", type=int, default=5000,
+                        help="New files published in the throughput benchmark.")
+    parser.add_argument('--rate', metavar="PER_SECOND", type=float, default=200,
+                        help="New files per second in the latency benchmark.")
+    parser.add_argument('--duration', metavar="SECONDS", type=float, default=10)
+    parser.add_argument('--archives', metavar="COUNT", type=int, default=8)
+    parser.add_argument('--members', metavar="COUNT", type=int, default=50)
+    parser.add_argument('--member-size', metavar="BYTES", type=int, default=256*1024)
+    parser.add_argument('--unarchive-workers', metavar="COUNT", type=int, default=4)
+    args = parser.parse_args()
+    for benchmark in args.benchmarks:
+        if benchmark not in BENCHMARKS:
+            parser.error("unknown benchmark: " + benchmark)
+
+    for benchmark in args.benchmarks or BENCHMARKS:
+        print("== %s ==" % benchmark)
+        if benchmark == 'bootstrap':
+            bench_bootstrap(args.depths, args.fanout, args.latency, args.bootstrap_workers)
+        elif benchmark == 'throughput':
+            bench_throughput(args.activities, args.events)
+        elif benchmark == 'latency':
+            bench_latency(args.rate, args.duration)
+        elif benchmark == 'unarchive':
+            bench_unarchive(args.archives, args.members, args.member_size, args.unarchive_workers)
@@ -0,0 +1,395 @@
+"""Establish inotify watches on directory trees using concurrent requests."""
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import threading
+import requests
+import codecs
+import json
+import time
+import re
+
+JSON = json.JSONDecoder()
+
+WATCH_FLAGS = ["IN_CLOSE_WRITE", "IN_CREATE", "IN_DELETE", "IN_DELETE_SELF",
+               "IN_MOVE_SELF", "IN_MOVE", "IN_ATTRIB"]
+
+# Needed to notice a watched directory going away.
+SELF_FLAGS = ["IN_DELETE_SELF", "IN_MOVE_SELF"]
+
+# Needed to keep the watches of a directory tree up to date.
+RECURSIVE_FLAGS = ["IN_CREATE", "IN_DELETE", "IN_MOVED_FROM", "IN_MOVED_TO"]
+
+
+def watch_flags(needed, recursive):
+    "Return the flags to subscribe with, given those needed by the activity"
+    flags = set(needed) | set(SELF_FLAGS)
+    if recursive:
+        flags |= set(RECURSIVE_FLAGS)
+    if "IN_MOVED_FROM" in flags and "IN_MOVED_TO" in flags:
+        flags -= {"IN_MOVED_FROM", "IN_MOVED_TO"}
+        flags.add("IN_MOVE")
+    return [flag for flag in WATCH_FLAGS + ["IN_MOVED_FROM", "IN_MOVED_TO"] if flag in flags]
+
+
+def add_watch(session, channel, path, flags=WATCH_FLAGS):
+    "Subscribe to inotify events for path, returning the new watch's URL"
+    w = session.post(format(channel) + "/subscriptions/inotify",
+                     json={"path": path, "flags": flags})
+    w.raise_for_status()
+    return w.headers['Location']
+
+
+WHITESPACE = " \t\n\r"
+DELIMITERS = WHITESPACE + ",:]}"
+SPACE = re.compile(r"[ \t\n\r]*")
+SEPARATOR = re.compile(r"[ \t\n\r]*([,\]])")
+
+
+class IncompleteListing(Exception):
+    pass
+
+
+def iter_children(session, endpoint, path, chunk_size=64*1024, checksums=False):
+    """
+    Yield the namespace entries of the children of directory path as the
+    listing arrives.  The response is parsed incrementally, one value at a
+    time, and text is discarded once parsed, so memory use depends on the
+    size of one entry rather than of the directory.  The REST API offers
+    neither paging nor filtering by type, so the whole listing is read.
+    If checksums is True, the entries of files include their checksums.
+    """
+    query = "?children=true&checksum=true" if checksums else "?children=true"
+    with session.get(endpoint + "/namespace" + path + query, stream=True) as r:
+        r.raise_for_status()
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        chunks = r.iter_content(chunk_size=chunk_size)
+        state = {'buffer': "", 'position': 0, 'eof': False}
+
+        def more():
+            "Read the next chunk, dropping text already parsed"
+            for chunk in chunks:
+                text = decoder.decode(chunk)
+                if text:
+                    state['buffer'] = state['buffer'][state['position']:] + text
+                    state['position'] = 0
+                    return
+            state['buffer'] = state['buffer'][state['position']:] + decoder.decode(b"", final=True)
+            state['position'] = 0
+            if state['eof']:
+                raise IncompleteListing('Listing of %s ended unexpectedly' % path)
+            state['eof'] = True
+
+        def token():
+            "Skip whitespace, returning the next character"
+            while True:
+                buffer = state['buffer']
+                position = state['position']
+                while position < len(buffer) and buffer[position] in WHITESPACE:
+                    position += 1
+                state['position'] = position
+                if position < len(buffer):
+                    return buffer[position]
+                more()
+
+        def value():
+            "Decode the next complete JSON value"
+            while True:
+                token()
+                try:
+                    (decoded, end) = JSON.raw_decode(state['buffer'], state['position'])
+                    # A number may continue in the next chunk, so only a delimiter ends one.
+                    if state['eof'] or (end < len(state['buffer']) and state['buffer'][end] in DELIMITERS):
+                        state['position'] = end
+                        return decoded
+                except ValueError:
+                    if state['eof']:
+                        raise
+                more()
+
+        def expect(characters):
+            character = token()
+            if character not in characters:
+                raise IncompleteListing('Unexpected "%s" in listing of %s' % (character, path))
+            state['position'] += 1
+            return character
+
+        def entries():
+            "Yield the entries of the children array, up to and including its closing bracket"
+            while True:
+                buffer = state['buffer']
+                try:
+                    (entry, end) = JSON.raw_decode(buffer, SPACE.match(buffer, state['position']).end())
+                    separator = SEPARATOR.match(buffer, end)
+                except ValueError:
+                    separator = None
+                if separator is None:
+                    more()
+                    continue
+                state['position'] = separator.end()
+                yield entry
+                if separator.group(1) == "]":
+                    return
+
+        expect("{")
+        if token() == "}":
+            return
+        while True:
+            key = value()
+            expect(":")
+            if key != "children":
+                value()
+            else:
+                expect("[")
+                if token() == "]":
+                    state['position'] += 1
+                else:
+                    yield from entries()
+            if expect(",}") == "}":
+                return
+
+
+def list_children(session, endpoint, path):
+    "Return the namespace entries of all children of directory path"
+    return list(iter_children(session, endpoint, path))
+
+
+def list_subdirectories(session, endpoint, path):
+    "Return the names of all subdirectories of path"
+    return [item["fileName"] for item in iter_children(session, endpoint, path) if item["fileType"] == "DIR"]
+
+
+class Bootstrap:
+    """
+    Watch a set of directory trees, breadth-first, using a bounded pool of
+    worker threads.  Watching a directory and listing its children are
+    independent requests, so both are issued at the same time.  The time
+    taken is therefore governed by the depth of the tree, rather than the
+    number of directories.
+
+    Each worker has its own session, but all sessions share a single
+    connection pool.
+    """
+
+    def __init__(self, session_factory, args, workers=16, progress_interval=5, flags=WATCH_FLAGS):
+        self.__session_factory = session_factory
+        self.__flags = flags
+        self.__args = args
+        self.__workers = workers
+        self.__progress_interval = progress_interval
+        self.__local = threading.local()
+        self.__adapter = HTTPAdapter(pool_maxsize=workers)
+        self.__lock = threading.Condition()
+        self.__pending = 0
+        self.__watched = 0
+        self.__listed = 0
+        self.__failed = 0
+
+    def session(self):
+        "Return this worker's session"
+        session = getattr(self.__local, 'session', None)
+        if session is None:
+            session = self.__session_factory(self.__args)
+            session.mount('https://', self.__adapter)
+            session.mount('http://', self.__adapter)
+            self.__local.session = session
+        return session
+
+    def run(self, channel, paths, recursive, on_watch, on_listing=None):
+        """
+        Watch all paths, and all their subdirectories if recursive is True.
+        The on_watch callback is called, one at a time, with the watch URL
+        and path of each new watch.  If on_listing is given, every watched
+        directory is listed, even if not recursive, and on_listing is called
+        with its path and namespace entries.
+        """
+        self.__channel = channel
+        self.__recursive = recursive
+        self.__on_watch = on_watch
+        self.__on_listing = on_listing
+        started = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=self.__workers,
+                                thread_name_prefix="bootstrap") as executor:
+            self.__executor = executor
+            for path in paths:
+                self.__submit(path)
+            with self.__lock:
+                while self.__pending > 0:
+                    if not self.__lock.wait(self.__progress_interval) and self.__pending > 0:
+                        print("Bootstrap: %d watches, %d directories listed, %d requests pending"
+                              % (self.__watched, self.__listed, self.__pending))
+        self.__adapter.close()
+
+        print("Established %d watches in %.1f seconds (%d failures)"
+              % (self.__watched, time.monotonic() - started, self.__failed))
+
+    def revalidate(self, channel, watches, recursive, on_watch, on_vanished):
+        """
+        Check watches restored from saved state, given as (watch, path)
+        pairs, against the subscriptions channel actually has, with a single
+        request.  Returns None if the channel no longer exists.
+
+        Otherwise, watches the channel lacks are established again,
+        concurrently, and on_watch is called with each new watch and its
+        path; on_vanished is called with the path of any directory that can
+        no longer be watched.  Subscriptions that were not saved, such as
+        one made just before a crash, are adopted if their directory is not
+        otherwise watched and removed if it is.  Events in directories
+        whose watch was lost may have been missed, so, if recursive, these
+        are listed and a list of their subdirectories that are not watched
+        is returned, for the caller to watch.
+        """
+        started = time.monotonic()
+        r = self.session().get(format(channel) + "/subscriptions")
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+        subscribed = set(r.json())
+        saved = {watch for (watch, _) in watches}
+        watched = {path for (_, path) in watches}
+        missing = [path for (watch, path) in watches if watch not in subscribed]
+        unknown = [watch for watch in subscribed if watch not in saved]
+
+        def rewatch(path):
+            try:
+                return add_watch(self.session(), channel, path, self.__flags)
+            except requests.exceptions.HTTPError as e:
+                if e.response.status_code in (400, 404):
+                    return None
+                print("Failed to watch path %s: %s" % (path, str(e)))
+            except requests.exceptions.RequestException as e:
+                print("Failed to watch path %s: %s" % (path, str(e)))
+            return False
+
+        def describe(watch):
+            try:
+                r = self.session().get(watch)
+                r.raise_for_status()
+                return r.json().get("path")
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print("Failed to check watch %s: %s" % (watch, str(e)))
+                return None
+
+        def subdirectories(path):
+            try:
+                return [path.rstrip("/") + "/" + item["fileName"]
+                        for item in iter_children(self.session(), self.__args["endpoint"], path)
+                        if item["fileType"] == "DIR"]
+            except (requests.exceptions.RequestException, ValueError, IncompleteListing) as e:
+                print("Failed to list directory %s: %s" % (path, str(e)))
+                return []
+
+        rewatched = []
+        vanished = 0
+        adopted = 0
+        duplicates = []
+        with ThreadPoolExecutor(max_workers=self.__workers,
+                                thread_name_prefix="bootstrap") as executor:
+            for (path, watch) in zip(missing, executor.map(rewatch, missing)):
+                if watch:
+                    on_watch(watch, path)
+                    rewatched.append(path)
+                elif watch is None:
+                    vanished += 1
+                    on_vanished(path)
+            for (watch, path) in zip(unknown, executor.map(describe, unknown)):
+                if path is None:
+                    continue
+                if path in watched:
+                    duplicates.append(watch)
+                else:
+                    watched.add(path)
+                    on_watch(watch, path)
+                    adopted += 1
+            unwatched = []
+            if recursive:
+                for children in executor.map(subdirectories, rewatched):
+                    unwatched += [child for child in children if child not in watched]
+        if duplicates:
+            self.unwatch(duplicates)
+        self.__adapter.close()
+
+        print("Validated %d watches in %.1f seconds: %d re-established, %d vanished, %d adopted, %d duplicates removed"
+              % (len(watches), time.monotonic() - started, len(rewatched), vanished, adopted, len(duplicates)))
+        return unwatched
+
+    def unwatch(self, watches):
+        "Remove these watches from the server"
+        def remove(watch):
+            try:
+                r = self.session().delete(watch)
+                if r.status_code != 404:
+                    r.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                print("Failed to remove watch %s: %s" % (watch, str(e)))
+
+        with ThreadPoolExecutor(max_workers=self.__workers,
+                                thread_name_prefix="bootstrap") as executor:
+            list(executor.map(remove, watches))
+        self.__adapter.close()
+
+    def __submit(self, path):
+        listing = self.__recursive or self.__on_listing is not None
+        with self.__lock:
+            self.__pending += 2 if listing else 1
+        self.__executor.submit(self.__watch, path)
+        if listing:
+            self.__executor.submit(self.__list, path)
+
+    def __done(self, counter):
+        with self.__lock:
+            if counter == 'watched':
+                self.__watched += 1
+            elif counter == 'listed':
+                self.__listed += 1
+            else:
+                self.__failed += 1
+            self.__pending -= 1
+            self.__lock.notify_all()
+
+    def __watch(self, path):
+        outcome = 'failed'
+        try:
+            watch = add_watch(self.session(), self.__channel, path, self.__flags)
+            with self.__lock:
+                self.__on_watch(watch, path)
+            outcome = 'watched'
+
+        except requests.exceptions.HTTPError as e:
+            r = e.response
+            if r.status_code == 400:
+                print("Watch for path %s request failed: %s" % (path, r.json()["errors"][0]["message"]))
+            else:
+                print("Server rejected watch for path %s: %s" % (path, str(e)))
+
+        except requests.exceptions.RequestException as e:
+            print("Failed to watch path %s: %s" % (path, str(e)))
+
+        finally:
+            self.__done(outcome)
+
+    def __list(self, path):
+        outcome = 'failed'
+        try:
+            children = iter_children(self.session(), self.__args["endpoint"], path)
+            if self.__on_listing:
+                children = list(children)
+                self.__on_listing(path, children)
+            if self.__recursive:
+                for item in children:
+                    if item["fileType"] == "DIR":
+                        self.__submit(path.rstrip("/") + "/" + item["fileName"])
+            outcome = 'listed'
+
+        except requests.exceptions.HTTPError as e:
+            r = e.response
+            if r.status_code == 400:
+                print("Directory listing for path %s failed: %s" % (path, r.json()["errors"][0]["message"]))
+            else:
+                print("Server rejected directory listing for path %s: %s" % (path, str(e)))
+
+        except (requests.exceptions.RequestException, ValueError, IncompleteListing) as e:
+            print("Failed to list directory %s: %s" % (path, str(e)))
+
+        finally:
+            self.__done(outcome)
@@ -0,0 +1,221 @@
+"""Persist the channel state incrementally, so it survives a crash."""
+from threading import Lock
+from urllib.parse import quote, unquote
+from watchindex import WatchIndex
+import collections
+import os
+import time
+
+
+class Checkpointer:
+    """
+    Keep the state needed to resume a channel (its URL, the ID of the last
+    processed event and the watches) up to date on disk.
+
+    The state is stored as a snapshot file, in the same format as the
+    original state file, plus an append-only log of changes made since the
+    snapshot was written.  Changes are written as they happen, but only
+    forced to disk (fsync) once sync_events events have been processed or
+    sync_interval seconds have passed.  Once the log holds compact_records
+    records, a new snapshot is written and atomically renamed into place
+    and the log is started afresh.  Snapshot and log carry a generation
+    number so a log that outlived its snapshot is never replayed.
+
+    Activities may hold events back (see activities.BaseActivity) after
+    they are processed.  If given, held returns the number of the oldest
+    event still held, or None, and the saved ID is that of the newest
+    processed event older than it, so events still held are read again
+    after a crash.
+    """
+
+    def __init__(self, path, sync_interval=1.0, sync_events=1000, compact_records=100000, held=None):
+        self.__path = path
+        self.__log_path = path + ".log"
+        self.__sync_interval = sync_interval
+        self.__sync_events = sync_events
+        self.__compact_records = compact_records
+        self.__held = held
+        self.__lock = Lock()
+        self.__log = None
+        self.__generation = 0
+        self.__channel = None
+        self.__last_id = None
+        self.__processed = collections.deque()
+        self.__synced_id = None
+        self.__watches = WatchIndex()
+        self.__records = 0
+        self.__unsynced_events = 0
+        self.__last_sync = time.monotonic()
+
+    def restore(self):
+        """
+        Read the saved state, returning a (channel, last_id, watches) tuple,
+        or None if there is no saved state.
+        """
+        try:
+            with open(self.__path) as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return None
+
+        header = lines[0].split()
+        channel = header[0]
+        last_id = None if header[1] == "-" else header[1]
+        generation = int(header[2]) if len(header) > 2 else 0
+        watches = WatchIndex()
+        for line in lines[1:]:
+            (watch, encoded_path) = line.split()
+            watches.add(watch, unquote(encoded_path))
+
+        try:
+            with open(self.__log_path) as f:
+                # The final line is either empty or was cut short by a crash.
+                log = f.read().split("\n")[:-1]
+        except FileNotFoundError:
+            log = []
+
+        if log and log[0] == "G %d" % generation:
+            for line in log[1:]:
+                record = line.split()
+                if record[0] == "I":
+                    last_id = record[1]
+                elif record[0] == "+":
+                    watches.add(record[1], unquote(record[2]))
+                elif record[0] == "-":
+                    watches.remove(record[1])
+                elif record[0] == "R":
+                    watches.rename(unquote(record[1]), unquote(record[2]))
+
+        self.__generation = generation
+        self.__reset(channel, last_id, watches.items())
+        return (channel, last_id, dict(watches.items()))
+
+    def start(self, channel, last_id=None, watches=[]):
+        "Start checkpointing a channel, replacing any saved state"
+        with self.__lock:
+            self.__reset(channel, last_id, watches)
+
+    def __reset(self, channel, last_id, watches):
+        "Adopt this state, given watches as (watch, path) pairs"
+        self.__channel = channel
+        self.__last_id = last_id
+        self.__processed.clear()
+        self.__watches = WatchIndex()
+        for watch, path in watches:
+            self.__watches.add(watch, path)
+        self.__compact()
+
+    def watch_added(self, watch, path):
+        with self.__lock:
+            self.__watches.add(watch, path)
+            self.__append("+ %s %s" % (watch, quote(path)))
+
+    def watch_removed(self, watch):
+        with self.__lock:
+            if self.__watches.remove(watch) is not None:
+                self.__append("- %s" % watch)
+
+    def watches_renamed(self, fromPath, toPath):
+        "Record that the watches at or below fromPath are now below toPath"
+        with self.__lock:
+            self.__watches.rename(fromPath, toPath)
+            self.__append("R %s %s" % (quote(fromPath), quote(toPath)))
+
+    def processed(self, event_id, number=None):
+        "Record that the event with this ID and number has been processed"
+        with self.__lock:
+            if event_id:
+                self.__processed.append((number, event_id))
+            self.__unsynced_events += 1
+            due = self.__unsynced_events >= self.__sync_events
+        if due:
+            self.__sync_processed()
+
+    def tick(self):
+        "Sync the log if sync_interval has passed since the last sync"
+        with self.__lock:
+            due = time.monotonic() - self.__last_sync >= self.__sync_interval
+        if due:
+            self.__sync_processed()
+
+    def close(self, last_id=None):
+        "Write a final snapshot"
+        held = self.__held() if self.__held else None
+        with self.__lock:
+            self.__release(held)
+            if last_id and held is None:
+                self.__last_id = last_id
+            self.__compact()
+            self.__log.close()
+            self.__log = None
+
+    def discard(self):
+        "Remove all saved state"
+        with self.__lock:
+            if self.__log is not None:
+                self.__log.close()
+                self.__log = None
+            for path in [self.__path, self.__log_path]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def __append(self, record):
+        self.__log.write(record + "\n")
+        self.__records += 1
+
+    def __sync_processed(self):
+        # Activities may call back into the checkpointer, so they are asked
+        # what they hold without holding the lock.
+        held = self.__held() if self.__held else None
+        with self.__lock:
+            self.__release(held)
+            self.__sync()
+
+    def __release(self, held):
+        "Advance the saved ID past processed events older than held"
+        while self.__processed and (held is None or self.__processed[0][0] < held):
+            self.__last_id = self.__processed.popleft()[1]
+
+    def __sync(self):
+        if self.__last_id != self.__synced_id:
+            self.__append("I %s" % self.__last_id)
+            self.__synced_id = self.__last_id
+        self.__log.flush()
+        os.fsync(self.__log.fileno())
+        self.__unsynced_events = 0
+        self.__last_sync = time.monotonic()
+        if self.__records >= self.__compact_records:
+            self.__compact()
+
+    def __compact(self):
+        "Write a new snapshot and start a new, empty log"
+        self.__generation += 1
+        last_id = self.__last_id if self.__last_id else "-"
+        lines = ["%s %s %d\n" % (self.__channel, last_id, self.__generation)]
+        lines += ["%s %s\n" % (watch, quote(path)) for watch, path in self.__watches.items()]
+        self.__replace(self.__path, "".join(lines))
+
+        if self.__log is not None:
+            self.__log.close()
+        self.__replace(self.__log_path, "G %d\n" % self.__generation)
+        self.__log = open(self.__log_path, 'a')
+        self.__records = 0
+        self.__synced_id = self.__last_id
+        self.__unsynced_events = 0
+        self.__last_sync = time.monotonic()
+
+    def __replace(self, path, contents):
+        "Atomically replace the contents of a file"
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
@@ -0,0 +1,187 @@
+"""Merge bursts of related events before they reach an activity."""
+from activities import BaseActivity, EVENT_NUMBERS, oldest_of
+from threading import Lock
+import collections
+import time
+
+NEW = 'new'
+METADATA = 'metadata'
+DELETED = 'deleted'
+MOVED = 'moved'
+
+CALLBACKS = {(NEW, False): 'onNewFile', (NEW, True): 'onNewDirectory',
+             (METADATA, False): 'onFileMetadataChanged', (METADATA, True): 'onDirMetadataChanged',
+             (DELETED, False): 'onDeletedFile', (DELETED, True): 'onDeletedDirectory',
+             (MOVED, False): 'onMovedFile', (MOVED, True): 'onMovedDirectory'}
+
+
+class CoalescingActivity(BaseActivity):
+    """
+    Hold events for up to window seconds, keyed by path, and pass the net
+    result to the wrapped activity.  While an event is held:
+
+      * further metadata changes, and rewrites of a new file, are merged
+        into it,
+      * a file or directory that is created and then deleted vanishes
+        without trace,
+      * a chain of renames (A to B, then B to C) becomes a single rename
+        and renaming something new becomes creating it under the new name.
+
+    Events for different paths may be reordered by up to window seconds.
+    Before a directory is moved or deleted, all held events for paths
+    within it are passed on, after any held events for the directory and
+    its ancestors, so the directory's own event is no longer merged with
+    the move or deletion.  Held events must be released by calling
+    flush_expired regularly.
+    """
+
+    def __init__(self, activity, window=1.0):
+        self.__activity = activity
+        self.__window = window
+        self.__held = collections.OrderedDict()
+        self.__lock = Lock()
+
+    def onNewFile(self, path):
+        self.__new(path, False)
+
+    def onDeletedFile(self, path):
+        self.__deleted(path, False)
+
+    def onFileMetadataChanged(self, path):
+        self.__metadata(path, False)
+
+    def onMovedFile(self, fromPath, toPath):
+        self.__moved(fromPath, toPath, False)
+
+    def onNewDirectory(self, path):
+        self.__new(path, True)
+
+    def onDeletedDirectory(self, path):
+        self.__deleted(path, True)
+
+    def onDirMetadataChanged(self, path):
+        self.__metadata(path, True)
+
+    def onMovedDirectory(self, fromPath, toPath):
+        self.__moved(fromPath, toPath, True)
+
+    def onEventLoss(self):
+        with self.__lock:
+            self.__release_all()
+        self.__activity.onEventLoss()
+
+    def flush_expired(self):
+        "Pass on all events held for at least window seconds"
+        now = time.monotonic()
+        with self.__lock:
+            while self.__held:
+                (path, (kind, isDir, fromPath, deadline, number)) = next(iter(self.__held.items()))
+                if deadline > now:
+                    break
+                self.__release(path)
+
+    def oldest_held(self):
+        "An event merged with later ones keeps the number of the oldest"
+        with self.__lock:
+            held = min((number for (_, _, _, _, number) in self.__held.values()), default=None)
+        return oldest_of(held, self.__activity.oldest_held())
+
+    def close(self):
+        with self.__lock:
+            self.__release_all()
+        self.__activity.close()
+
+    def __new(self, path, isDir):
+        with self.__lock:
+            held = self.__held.get(path)
+            if held is not None and held[0] in (NEW, METADATA):
+                self.__replace(path, NEW, isDir)
+            else:
+                self.__release(path)
+                self.__hold(path, NEW, isDir)
+
+    def __metadata(self, path, isDir):
+        with self.__lock:
+            held = self.__held.get(path)
+            if held is None or held[0] == DELETED:
+                self.__release(path)
+                self.__hold(path, METADATA, isDir)
+
+    def __deleted(self, path, isDir):
+        with self.__lock:
+            if isDir:
+                self.__release_within(path)
+            held = self.__held.get(path)
+            if held is None:
+                self.__hold(path, DELETED, isDir)
+            elif held[0] == NEW:
+                del self.__held[path]
+            elif held[0] == METADATA:
+                self.__replace(path, DELETED, isDir)
+            elif held[0] == MOVED:
+                del self.__held[path]
+                self.__release(held[2])
+                self.__hold(held[2], DELETED, isDir, number=held[4])
+
+    def __moved(self, fromPath, toPath, isDir):
+        with self.__lock:
+            if isDir:
+                self.__release_within(fromPath)
+            held = self.__held.get(fromPath)
+            self.__release(toPath)
+            if held is not None and held[0] == NEW:
+                del self.__held[fromPath]
+                self.__hold(toPath, NEW, isDir, number=held[4])
+            elif held is not None and held[0] == MOVED:
+                del self.__held[fromPath]
+                if held[2] != toPath:
+                    self.__hold(toPath, MOVED, isDir, held[2], held[4])
+            else:
+                self.__release(fromPath)
+                self.__hold(toPath, MOVED, isDir, fromPath)
+
+    def __hold(self, path, kind, isDir, fromPath=None, number=None):
+        if number is None:
+            number = EVENT_NUMBERS.current()
+        self.__held[path] = (kind, isDir, fromPath, time.monotonic() + self.__window, number)
+
+    def __replace(self, path, kind, isDir):
+        "Change the kind of a held event, keeping its place in the queue"
+        (_, _, fromPath, deadline, number) = self.__held[path]
+        self.__held[path] = (kind, isDir, fromPath, deadline, number)
+
+    def __release_within(self, directory):
+        """
+        Pass on all held events for paths within directory.  These are
+        preceded by any held events for the directory itself and for its
+        ancestors, so a path is never reported before its parent.
+        """
+        prefix = directory + "/"
+        within = [p for p in self.__held if p.startswith(prefix)]
+        if not within:
+            return
+        ancestors = []
+        parent = directory
+        while parent:
+            ancestors.append(parent)
+            parent = parent.rpartition("/")[0]
+        for path in reversed(ancestors):
+            self.__release(path)
+        for path in within:
+            self.__release(path)
+
+    def __release_all(self):
+        while self.__held:
+            self.__release(next(iter(self.__held)))
+
+    def __release(self, path):
+        held = self.__held.pop(path, None)
+        if held is None:
+            return
+        (kind, isDir, fromPath, _, number) = held
+        callback = getattr(self.__activity, CALLBACKS[(kind, isDir)])
+        with EVENT_NUMBERS.handling(number):
+            if kind == MOVED:
+                callback(fromPath, path)
+            else:
+                callback(path)
@@ -0,0 +1,281 @@
+"""Decouple reading events from the SSE stream from acting on them."""
+from activities import BaseActivity, EVENT_NUMBERS, oldest_of
+from threading import Thread, Condition
+import collections
+import traceback
+import time
+
+POLICIES = ['block', 'drop-newest', 'drop-oldest']
+
+
+class EventQueue:
+    """
+    A bounded FIFO queue of events.  The policy describes what happens when
+    adding an event to a full queue: 'block' waits until there is space,
+    'drop-newest' discards the new event and 'drop-oldest' discards the
+    event at the head of the queue.  If given, on_dequeue is called with
+    the number of seconds each item spent in the queue.
+    """
+
+    def __init__(self, depth=10000, policy='block', on_dequeue=None):
+        if policy not in POLICIES:
+            raise Exception('Unknown queue policy: ' + str(policy))
+        self.__items = collections.deque()
+        self.__max_depth = depth
+        self.__policy = policy
+        self.__on_dequeue = on_dequeue
+        self.__condition = Condition()
+        self.__closed = False
+        self.__unfinished = 0
+        self.__processing = None
+        self.__unreported_drops = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def put(self, item):
+        "Add an item, returning False if an event was dropped as a result"
+        with self.__condition:
+            accepted = True
+            if len(self.__items) >= self.__max_depth:
+                if self.__policy == 'block':
+                    while len(self.__items) >= self.__max_depth and not self.__closed:
+                        self.__condition.wait()
+                elif self.__policy == 'drop-newest':
+                    self.__dropped()
+                    return False
+                else:
+                    self.__items.popleft()
+                    self.__unfinished -= 1
+                    self.__dropped()
+                    accepted = False
+            self.__items.append((time.monotonic(), item))
+            self.__unfinished += 1
+            self.high_water = max(self.high_water, len(self.__items))
+            self.__condition.notify_all()
+            return accepted
+
+    def __dropped(self):
+        self.dropped += 1
+        self.__unreported_drops += 1
+
+    def get(self, timeout=None):
+        """
+        Remove and return the item at the head of the queue.  Returns None
+        if timeout expired or the queue is closed and empty.
+        """
+        with self.__condition:
+            if not self.__items and not self.__closed:
+                self.__condition.wait(timeout)
+            if not self.__items:
+                return None
+            (enqueued, item) = self.__items.popleft()
+            self.__processing = item
+            self.__condition.notify_all()
+        if self.__on_dequeue:
+            self.__on_dequeue(time.monotonic() - enqueued)
+        return item
+
+    def task_done(self):
+        "Record that an item returned by get has been processed"
+        with self.__condition:
+            self.__unfinished -= 1
+            self.__processing = None
+            self.__condition.notify_all()
+
+    def oldest(self):
+        "Return the item being processed, or else the item at the head of the queue, or None"
+        with self.__condition:
+            if self.__processing is not None:
+                return self.__processing
+            return self.__items[0][1] if self.__items else None
+
+    def join(self):
+        "Wait until all added items have been processed"
+        with self.__condition:
+            while self.__unfinished > 0:
+                self.__condition.wait()
+
+    def take_drops(self):
+        "Return the number of events dropped since the last call"
+        with self.__condition:
+            drops = self.__unreported_drops
+            self.__unreported_drops = 0
+            return drops
+
+    def depth(self):
+        return len(self.__items)
+
+    def close(self):
+        "Accept no more blocking puts; get returns None once the queue is empty"
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+
+    def is_closed(self):
+        return self.__closed
+
+
+class Dispatcher:
+    """
+    Hand each queued event to a handler, in order, in a background thread.
+    Events are (type, id, data) tuples.  If the queue dropped any events,
+    on_loss is called before the next event is handled.  The optional tick
+    callback is called, from the same thread, at least every tick_interval
+    seconds, even when no events arrive.
+    """
+
+    def __init__(self, queue, handler, on_loss, stats_interval=0, tick=None, tick_interval=0.1):
+        self.__queue = queue
+        self.__handler = handler
+        self.__on_loss = on_loss
+        self.__stats_interval = stats_interval
+        self.__tick = tick
+        self.__tick_interval = tick_interval
+        self.__thread = Thread(target=self.__run, name="dispatcher", daemon=True)
+        self.last_id = None
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        "Handle any remaining events, then stop"
+        self.__queue.close()
+        self.__thread.join()
+
+    def wait_until_idle(self):
+        "Wait until all queued events have been handled"
+        self.__queue.join()
+
+    def __run(self):
+        next_stats = time.monotonic() + self.__stats_interval
+        next_tick = time.monotonic() + self.__tick_interval
+        intervals = [i for i in [self.__stats_interval, self.__tick and self.__tick_interval] if i]
+        timeout = min(intervals) if intervals else None
+        while True:
+            item = self.__queue.get(timeout)
+
+            if self.__queue.take_drops() > 0:
+                self.__call(self.__on_loss)
+
+            if item is not None:
+                (event_type, event_id, data) = item
+                self.__call(self.__handler, event_type, event_id, data)
+                if event_id:
+                    self.last_id = event_id
+                self.__queue.task_done()
+            elif self.__queue.is_closed():
+                break
+
+            if self.__tick and time.monotonic() >= next_tick:
+                next_tick = time.monotonic() + self.__tick_interval
+                self.__call(self.__tick)
+
+            if self.__stats_interval and time.monotonic() >= next_stats:
+                next_stats = time.monotonic() + self.__stats_interval
+                print("Event queue: depth %d, high-water %d, dropped %d"
+                      % (self.__queue.depth(), self.__queue.high_water, self.__queue.dropped))
+
+    def __call(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception:
+            print("Failed to process event:")
+            traceback.print_exc()
+
+
+class FanOutActivity(BaseActivity):
+    """
+    Pass every event to several activities, each with its own bounded
+    queue and worker thread.  Events are queued as (event number, callback
+    name, arguments) tuples, and a batch passed to onEvents is queued as a
+    single item.  The queues follow policy when full; an activity whose
+    queue dropped events is told of the loss before its next event.
+
+    By default a slow activity loses events rather than holding up the
+    others.  With the 'block' policy, a full queue blocks the caller, and
+    with it every other activity, until the slow activity catches up.
+    """
+
+    def __init__(self, activities, names, depth=10000, policy='drop-newest'):
+        self.__activities = activities
+        self.__queues = [EventQueue(depth, policy) for activity in activities]
+        self.__threads = [Thread(target=self.__run, args=(activity, queue),
+                                 name="activity-" + name, daemon=True)
+                          for (activity, queue, name) in zip(activities, self.__queues, names)]
+        for thread in self.__threads:
+            thread.start()
+
+    def onNewFile(self, path):
+        self.__put('onNewFile', path)
+
+    def onDeletedFile(self, path):
+        self.__put('onDeletedFile', path)
+
+    def onFileMetadataChanged(self, path):
+        self.__put('onFileMetadataChanged', path)
+
+    def onMovedFile(self, fromPath, toPath):
+        self.__put('onMovedFile', fromPath, toPath)
+
+    def onNewDirectory(self, path):
+        self.__put('onNewDirectory', path)
+
+    def onDeletedDirectory(self, path):
+        self.__put('onDeletedDirectory', path)
+
+    def onDirMetadataChanged(self, path):
+        self.__put('onDirMetadataChanged', path)
+
+    def onMovedDirectory(self, fromPath, toPath):
+        self.__put('onMovedDirectory', fromPath, toPath)
+
+    def onEventLoss(self):
+        self.__put('onEventLoss')
+
+    def onEvents(self, events):
+        self.__put('onEvents', events)
+
+    def depths(self):
+        "Return the number of events waiting for each activity"
+        return [queue.depth() for queue in self.__queues]
+
+    def oldest_held(self):
+        "Events are held until each activity has handled them, and no longer holds them itself"
+        held = []
+        for (activity, queue) in zip(self.__activities, self.__queues):
+            item = queue.oldest()
+            held += [item[0] if item else None, activity.oldest_held()]
+        return oldest_of(*held)
+
+    def __put(self, callback, *args):
+        number = EVENT_NUMBERS.current()
+        for queue in self.__queues:
+            queue.put((number, callback, args))
+
+    def __run(self, activity, queue):
+        while True:
+            item = queue.get()
+            if queue.take_drops() > 0:
+                self.__call(activity.onEventLoss)
+            if item is None:
+                break
+            (number, callback, args) = item
+            with EVENT_NUMBERS.handling(number):
+                self.__call(getattr(activity, callback), *args)
+            queue.task_done()
+
+    def __call(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception:
+            print("Failed to process event:")
+            traceback.print_exc()
+
+    def close(self):
+        "Let each activity handle its remaining events, then close them all"
+        for queue in self.__queues:
+            queue.close()
+        for thread in self.__threads:
+            thread.join()
+        for activity in self.__activities:
+            activity.close()
@@ -0,0 +1,104 @@
+"""Discover dCache doors and choose between them."""
+from threading import Thread, Event, Lock
+import itertools
+import bisect
+import random
+
+
+class Door:
+    """A door, with the information needed to select it precomputed."""
+
+    def __init__(self, info):
+        self.protocol = info['protocol']
+        self.tags = frozenset(info.get('tags') or [])
+        self.load = info.get('load', 0)
+        # Lightly loaded doors are proportionally more likely to be chosen,
+        # but even a fully loaded door is chosen occasionally.
+        self.weight = max(0.05, 1.0 - min(self.load, 1.0))
+        self.urls = ["%s://%s:%d/" % (self.protocol, address, info['port'])
+                     for address in sorted(info['addresses'])]
+        self.__next_address = itertools.count()
+
+    def url(self):
+        "Return the URL of this door, cycling through its addresses"
+        return self.urls[next(self.__next_address) % len(self.urls)]
+
+
+class DoorRegistry:
+    """
+    The doors available in dCache.  The list of doors is fetched, using the
+    discover callable, when first needed and refreshed in the background
+    every ttl seconds; a ttl of zero disables refreshing.  Doors are indexed
+    by protocol when the list is fetched.
+
+    Each selection picks one of the matching doors at random, weighted by
+    how lightly loaded it is, and the door's addresses are used in turn.
+    The generation counts the lists fetched, so callers can tell when the
+    URLs of the doors may have changed.
+    """
+
+    def __init__(self, discover, ttl=60):
+        self.__discover = discover
+        self.__ttl = ttl
+        self.__lock = Lock()
+        self.__index = None
+        self.__stopped = Event()
+        self.__refresher = None
+        self.generation = 0
+
+    def select(self, protocol, tags):
+        """Return the URL of a door with this protocol and all these tags"""
+        if self.__index is None:
+            with self.__lock:
+                if self.__index is None:
+                    self.__update(self.__discover())
+                    if self.__ttl > 0:
+                        self.__refresher = Thread(target=self.__refresh,
+                                                  name="door-refresh", daemon=True)
+                        self.__refresher.start()
+
+        key = (protocol, frozenset(tags or []))
+        with self.__lock:
+            (by_protocol, selections) = self.__index
+            selection = selections.get(key)
+            if selection is None:
+                selection = selections[key] = self.__select(by_protocol, *key)
+
+        (doors, cumulative_weights) = selection
+        if not doors:
+            raise Exception('No doors match protocol=' + protocol + ', tags=' + str(tags))
+
+        i = bisect.bisect(cumulative_weights, random.random() * cumulative_weights[-1])
+        return doors[min(i, len(doors) - 1)].url()
+
+    def urls(self):
+        "Return the URLs of all known doors"
+        with self.__lock:
+            if self.__index is None:
+                return set()
+            return {url for doors in self.__index[0].values() for door in doors for url in door.urls}
+
+    def __select(self, by_protocol, protocol, tags):
+        doors = [d for d in by_protocol.get(protocol, []) if tags <= d.tags]
+        return (doors, list(itertools.accumulate(d.weight for d in doors)))
+
+    def __update(self, door_info):
+        "Index a new list of doors; the caller must hold the lock"
+        by_protocol = {}
+        for info in door_info:
+            door = Door(info)
+            by_protocol.setdefault(door.protocol, []).append(door)
+        self.__index = (by_protocol, {})
+        self.generation += 1
+
+    def __refresh(self):
+        while not self.__stopped.wait(self.__ttl):
+            try:
+                door_info = self.__discover()
+                with self.__lock:
+                    self.__update(door_info)
+            except Exception as e:
+                print("Failed to refresh list of doors: %s" % e)
+
+    def close(self):
+        self.__stopped.set()
@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+"""
+A local stand-in for the parts of a dCache frontend and WebDAV door that
+the client uses.  The namespace is a synthetic, regular directory tree and
+events are generated at a configurable rate.  This allows measuring the
+client's performance without a production dCache.
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+import collections
+import argparse
+import threading
+import random
+import json
+import time
+import zlib
+
+API = "/api/v1"
+
+
+class Tree:
+    """
+    A synthetic directory tree of the given depth.  Every directory has
+    fanout subdirectories (named d0, d1, ...) and files (f0, f1, ...).
+    """
+    def __init__(self, root="/data", depth=3, fanout=4, files=2, file_size=1024):
+        self.root = root
+        self.depth = depth
+        self.fanout = fanout
+        self.files = files
+        self.file_size = file_size
+
+    def level(self, path):
+        "Return the depth of directory path, or None if it isn't a directory"
+        if path == self.root:
+            return 0
+        if not path.startswith(self.root + "/"):
+            return None
+        names = path[len(self.root) + 1:].split("/")
+        for name in names:
+            if not name.startswith("d") or not name[1:].isdigit() or int(name[1:]) >= self.fanout:
+                return None
+        return len(names) if len(names) <= self.depth else None
+
+    def directories(self):
+        "Return the number of directories in the tree"
+        return sum(self.fanout ** i for i in range(self.depth + 1))
+
+    def children(self, path):
+        level = self.level(path)
+        if level is None:
+            return None
+        children = []
+        if level < self.depth:
+            children += [{"fileName": "d%d" % i, "fileType": "DIR", "size": 512,
+                          "mtime": 0} for i in range(self.fanout)]
+        children += [{"fileName": "f%d" % i, "fileType": "REGULAR",
+                      "size": self.file_size, "mtime": 0} for i in range(self.files)]
+        return children
+
+    def random_directory(self):
+        path = self.root
+        for _ in range(random.randint(0, self.depth)):
+            path += "/d%d" % random.randrange(self.fanout)
+        return path
+
+
+def subscribed(flags, action):
+    "Whether a subscription with these flags receives events for action"
+    return (not flags or action in flags or action == "IN_IGNORED"
+            or (action in ("IN_MOVED_FROM", "IN_MOVED_TO") and "IN_MOVE" in flags))
+
+
+class Channel:
+    """The state of one SSE channel"""
+    def __init__(self, url):
+        self.url = url
+        self.subscriptions = {}
+        self.by_path = {}
+        self.history = collections.deque(maxlen=100000)
+        self.next_id = 0
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def publish(self, event_type, data):
+        with self.condition:
+            self.next_id += 1
+            self.history.append((self.next_id, event_type, json.dumps(data)))
+            self.condition.notify_all()
+
+    def since(self, last_id):
+        return [e for e in self.history if e[0] > last_id]
+
+
+class Frontend:
+    """All server-side state"""
+    def __init__(self, tree, rate=0, latency=0, door_protocol="http"):
+        self.tree = tree
+        self.rate = rate
+        self.latency = latency
+        self.door_protocol = door_protocol
+        self.channels = {}
+        self.objects = {}
+        self.uploaded_bytes = 0
+        self.uploads = 0
+        self.subscription_requests = 0
+        self.listing_requests = 0
+        self.published = 0
+        self.lock = threading.Lock()
+        self.next_channel = 0
+        self.next_subscription = 0
+        self.base_url = None
+
+    def new_channel(self):
+        with self.lock:
+            self.next_channel += 1
+            url = "%s%s/events/channels/%d" % (self.base_url, API, self.next_channel)
+            channel = Channel(url)
+            self.channels[str(self.next_channel)] = channel
+        return channel
+
+    def subscribe(self, channel, path, flags):
+        with self.lock:
+            self.next_subscription += 1
+            self.subscription_requests += 1
+            url = "%s/subscriptions/inotify/%d" % (channel.url, self.next_subscription)
+            channel.subscriptions[url] = {"path": path, "flags": flags}
+            channel.by_path[path] = url
+        channel.publish("SYSTEM", {"type": "NEW_SUBSCRIPTION", "id": url})
+        return url
+
+    def publish_inotify(self, path, name, mask, cookie=None):
+        "Send an inotify event to every channel watching directory path"
+        event = {"name": name, "mask": mask}
+        if cookie is not None:
+            event["cookie"] = cookie
+        action = [flag for flag in mask if flag != "IN_ISDIR"][-1]
+        for channel in list(self.channels.values()):
+            watch = channel.by_path.get(path)
+            if watch and subscribed(channel.subscriptions[watch]["flags"], action):
+                channel.publish("inotify", {"subscription": watch, "event": event})
+                self.published += 1
+
+    def new_file_event(self):
+        "Publish the events for a newly written file, named after the current time"
+        directory = self.tree.random_directory()
+        name = "f-%d" % time.time_ns()
+        self.publish_inotify(directory, name, ["IN_CREATE"])
+        self.publish_inotify(directory, name, ["IN_CLOSE_WRITE"])
+
+    def burst(self, count):
+        "Publish the events for count new files as quickly as possible"
+        for _ in range(count):
+            self.new_file_event()
+
+    def new_archive(self, path, data):
+        "Store an archive and publish the events for it being written"
+        with self.lock:
+            self.objects[path] = data
+        directory, _, name = path.rpartition("/")
+        self.publish_inotify(directory, name, ["IN_CREATE"])
+        self.publish_inotify(directory, name, ["IN_CLOSE_WRITE"])
+
+    def event_loss(self):
+        "Tell every channel that events were lost"
+        for channel in list(self.channels.values()):
+            channel.publish("SYSTEM", {"type": "EVENT_LOSS"})
+
+    def generate(self, limit=None):
+        "Publish new-file events at the configured rate, for limit files or forever"
+        interval = 1.0 / self.rate
+        deadline = time.monotonic()
+        for _ in (range(int(limit)) if limit else iter(int, 1)):
+            deadline += interval
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.new_file_event()
+
+    def listing(self, path):
+        children = self.tree.children(path)
+        stored = {}
+        prefix = path.rstrip("/") + "/"
+        for name, data in list(self.objects.items()):
+            if name.startswith(prefix):
+                rest = name[len(prefix):]
+                if "/" in rest:
+                    stored[rest.split("/")[0]] = {"fileName": rest.split("/")[0],
+                                                  "fileType": "DIR", "size": 512, "mtime": 0}
+                else:
+                    stored[rest] = {"fileName": rest, "fileType": "REGULAR", "size": len(data),
+                                    "mtime": 0, "checksums": [{"type": "ADLER32",
+                                                               "value": "%08x" % zlib.adler32(data)}]}
+        if children is None and not stored:
+            return None
+        return (children or []) + list(stored.values())
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def frontend(self):
+        return self.server.frontend
+
+    def reply(self, status, body=None, headers={}):
+        data = b"" if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if body is not None:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def error(self, status, message):
+        self.reply(status, {"errors": [{"message": message}]})
+
+    def body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def delay(self):
+        if self.frontend.latency:
+            time.sleep(self.frontend.latency)
+
+    def split(self):
+        url = urlsplit(self.path)
+        return unquote(url.path), parse_qs(url.query)
+
+    def channel(self, path):
+        parts = path[len(API + "/events/channels/"):].split("/")
+        return self.frontend.channels.get(parts[0]), parts[1:]
+
+    def do_POST(self):
+        self.delay()
+        path, _ = self.split()
+        data = self.body()
+        if path == API + "/events/channels":
+            channel = self.frontend.new_channel()
+            self.reply(201, headers={"Location": channel.url})
+        elif path.startswith(API + "/events/channels/"):
+            channel, rest = self.channel(path)
+            if channel is None:
+                self.error(404, "Unknown channel")
+                return
+            selector = json.loads(data)
+            if self.frontend.tree.level(selector["path"]) is None \
+                    and self.frontend.listing(selector["path"]) is None:
+                self.error(400, "Not a directory: " + selector["path"])
+                return
+            url = self.frontend.subscribe(channel, selector["path"], selector.get("flags", []))
+            self.reply(201, headers={"Location": url})
+        else:
+            self.error(404, "Not found")
+
+    def do_DELETE(self):
+        path, _ = self.split()
+        if path.startswith(API + "/events/channels/"):
+            channel, rest = self.channel(path)
+            if channel is None:
+                self.error(404, "Unknown channel")
+                return
+            if rest:
+                url = channel.url + "/" + "/".join(rest)
+                selector = channel.subscriptions.pop(url, None)
+                if selector is None:
+                    self.error(404, "Unknown subscription")
+                    return
+                channel.by_path.pop(selector["path"], None)
+            else:
+                with self.frontend.lock:
+                    del self.frontend.channels[path[len(API + "/events/channels/"):]]
+                with channel.condition:
+                    channel.closed = True
+                    channel.condition.notify_all()
+            self.reply(204)
+        else:
+            self.error(404, "Not found")
+
+    def do_PUT(self):
+        path, _ = self.split()
+        data = self.body()
+        with self.frontend.lock:
+            self.frontend.objects[path] = data
+            self.frontend.uploads += 1
+            self.frontend.uploaded_bytes += len(data)
+        self.reply(201)
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        path, query = self.split()
+        if path.startswith(API + "/events/channels/"):
+            channel, rest = self.channel(path)
+            if channel is None:
+                self.error(404, "Unknown channel")
+            elif not rest:
+                self.stream(channel)
+            elif rest == ["subscriptions"]:
+                self.reply(200, list(channel.subscriptions))
+            else:
+                selector = channel.subscriptions.get(channel.url + "/" + "/".join(rest))
+                if selector is None:
+                    self.error(404, "Unknown subscription")
+                else:
+                    self.reply(200, selector)
+        elif path == API + "/doors":
+            self.delay()
+            host, port = self.server.server_address[:2]
+            self.reply(200, [{"protocol": self.frontend.door_protocol, "tags": ["dcache-view"],
+                              "load": 0.0, "addresses": [host], "port": port}])
+        elif path.startswith(API + "/namespace"):
+            self.delay()
+            self.frontend.listing_requests += 1
+            target = path[len(API + "/namespace"):] or "/"
+            data = self.frontend.objects.get(target)
+            if data is not None:
+                self.reply(200, {"fileName": target.split("/")[-1], "fileType": "REGULAR",
+                                 "size": len(data), "mtime": 0,
+                                 "checksums": [{"type": "ADLER32",
+                                                "value": "%08x" % zlib.adler32(data)}]})
+                return
+            children = self.frontend.listing(target)
+            if children is None:
+                self.error(404, "No such file or directory: " + target)
+            else:
+                self.reply(200, {"fileType": "DIR", "children": children})
+        else:
+            self.download(path, head)
+
+    def download(self, path, head):
+        data = self.frontend.objects.get(path)
+        if data is None:
+            self.error(404, "Not found")
+            return
+        status = 200
+        start, end = 0, len(data)
+        requested = self.headers.get("Range")
+        if requested and requested.startswith("bytes="):
+            first, _, last = requested[6:].partition("-")
+            start = int(first)
+            end = int(last) + 1 if last else len(data)
+            status = 206
+        self.send_response(status)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start))
+        if status == 206:
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end - 1, len(data)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(data[start:end])
+
+    def stream(self, channel):
+        last_id = int(self.headers.get("Last-Event-ID") or 0)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            while True:
+                with channel.condition:
+                    while channel.next_id <= last_id and not channel.closed:
+                        channel.condition.wait(1)
+                    if channel.closed:
+                        return
+                    pending = channel.since(last_id)
+                frames = []
+                for event_id, event_type, data in pending:
+                    frames.append("event: %s\nid: %d\ndata: %s\n\n" % (event_type, event_id, data))
+                    last_id = event_id
+                self.wfile.write("".join(frames).encode())
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def start(tree, rate=0, latency=0, port=0, door_protocol="http"):
+    "Start a fake frontend in background threads, returning the server"
+    frontend = Frontend(tree, rate=rate, latency=latency, door_protocol=door_protocol)
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.frontend = frontend
+    frontend.base_url = "http://127.0.0.1:%d" % server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    if rate:
+        threading.Thread(target=frontend.generate, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fake dCache frontend')
+    parser.add_argument('--port', type=int, default=3880)
+    parser.add_argument('--depth', type=int, default=3, help="Depth of the synthetic tree.")
+    parser.add_argument('--fanout', type=int, default=4, help="Subdirectories per directory.")
+    parser.add_argument('--files', type=int, default=2, help="Files per directory.")
+    parser.add_argument('--rate', type=float, default=10, help="New-file events per second.")
+    parser.add_argument('--latency', type=float, default=0, help="Delay, in seconds, added to each request.")
+    parser.add_argument('--door-protocol', choices=['http', 'https'], default='http',
+                        help="The protocol advertised for the WebDAV door.  This server only speaks http.")
+    args = parser.parse_args()
+    tree = Tree(depth=args.depth, fanout=args.fanout, files=args.files)
+    server = start(tree, rate=args.rate, latency=args.latency, port=args.port,
+                   door_protocol=args.door_protocol)
+    print("Serving %d directories on %s%s" % (tree.directories(), server.frontend.base_url, API))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
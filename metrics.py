@@ -0,0 +1,240 @@
+"""Counters and latency histograms describing the client's performance."""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock
+from urllib.parse import urlsplit
+import bisect
+import time
+
+PREFIX = "dcache_sse_"
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class Metric:
+    """A family of values, one per combination of label values."""
+
+    def __init__(self, kind, name, help, labels=()):
+        self.kind = kind
+        self.name = PREFIX + name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = Lock()
+
+    def _labels(self, values, extra=""):
+        pairs = ['%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                 for n, v in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{%s}" % ",".join(pairs) if pairs else ""
+
+    def total(self):
+        with self._lock:
+            return sum(self._values.values())
+
+    def samples(self):
+        with self._lock:
+            if not self._values and not self.labels:
+                return [(self.name, 0)]
+            return [(self.name + self._labels(k), v) for k, v in sorted(self._values.items())]
+
+
+class Counter(Metric):
+    def __init__(self, name, help, labels=()):
+        super(Counter, self).__init__('counter', name, help, labels)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that is read from a function whenever it is reported."""
+
+    def __init__(self, name, help, function):
+        super(Gauge, self).__init__('gauge', name, help)
+        self.__function = function
+
+    def total(self):
+        return self.__function()
+
+    def samples(self):
+        return [(self.name, self.__function())]
+
+
+class Histogram(Metric):
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__('histogram', name, help, labels)
+        self.__buckets = list(buckets)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.__buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.__buckets, value)] += 1
+            counts[-1] += value
+
+    def time(self, *labels):
+        "Return a context manager that observes the time spent within it"
+        return Timer(self, labels)
+
+    def count_and_sum(self):
+        with self._lock:
+            return (sum(sum(c[:-1]) for c in self._values.values()),
+                    sum(c[-1] for c in self._values.values()))
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for labels, counts in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.__buckets + ["+Inf"], counts[:-1]):
+                    cumulative += count
+                    samples.append((self.name + "_bucket" + self._labels(labels, 'le="%s"' % bound),
+                                    cumulative))
+                samples.append((self.name + "_sum" + self._labels(labels), counts[-1]))
+                samples.append((self.name + "_count" + self._labels(labels), cumulative))
+        return samples
+
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.__histogram = histogram
+        self.__labels = labels
+
+    def __enter__(self):
+        self.__started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.__histogram.observe(time.monotonic() - self.__started, *self.__labels)
+
+
+class Registry:
+    """All metrics, in the order they were created."""
+
+    def __init__(self):
+        self.__metrics = []
+
+    def counter(self, name, help, labels=()):
+        return self.__add(Counter(name, help, labels))
+
+    def gauge(self, name, help, function):
+        return self.__add(Gauge(name, help, function))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.__add(Histogram(name, help, labels, buckets))
+
+    def __add(self, metric):
+        self.__metrics.append(metric)
+        return metric
+
+    def render(self):
+        "Return all metrics in the Prometheus text exposition format"
+        lines = []
+        for metric in self.__metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            lines += ["%s %s" % (name, value) for name, value in metric.samples()]
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+RECEIVED = REGISTRY.counter('events_received_total', 'SSE messages read from the channel, by event type', ['type'])
+INOTIFY = REGISTRY.counter('inotify_events_total', 'inotify events processed, by action', ['action'])
+EVENT_LOSS = REGISTRY.counter('event_loss_total', 'Event-loss notifications, from the server or the event queue')
+DISPATCH_DELAY = REGISTRY.histogram('dispatch_delay_seconds', 'Time events wait in the event queue')
+CALLBACKS = REGISTRY.histogram('activity_callback_seconds', 'Time spent in activity callbacks', ['callback'])
+HTTP = REGISTRY.histogram('http_request_seconds', 'Time until response headers are received, by operation', ['operation'])
+HTTP_ERRORS = REGISTRY.counter('http_errors_total', 'HTTP requests answered with an error status, by operation', ['operation'])
+
+__last_received = [None]
+
+
+def received(event_type):
+    "Record that an SSE message was read"
+    RECEIVED.inc(event_type)
+    __last_received[0] = time.monotonic()
+
+
+REGISTRY.gauge('seconds_since_last_event', 'Time since an SSE message was last read',
+               lambda: time.monotonic() - __last_received[0] if __last_received[0] else -1)
+
+
+def classify(request):
+    "Describe the purpose of a request to the frontend or a door"
+    path = urlsplit(request.url).path
+    if '/subscriptions/' in path:
+        return 'watch' if request.method == 'POST' else 'subscription'
+    if path.endswith('/events/channels') or '/events/channels/' in path:
+        return 'channel'
+    if '/namespace' in path:
+        return 'namespace'
+    if path.endswith('/doors'):
+        return 'doors'
+    if request.method == 'PUT':
+        return 'upload'
+    if request.method == 'GET':
+        return 'download'
+    return request.method.lower()
+
+
+def instrument_session(session):
+    "Record the latency and errors of all requests made with this session"
+    def observe(response, *args, **kwargs):
+        operation = classify(response.request)
+        HTTP.observe(response.elapsed.total_seconds(), operation)
+        if response.status_code >= 400:
+            HTTP_ERRORS.inc(operation)
+    session.hooks['response'].append(observe)
+    return session
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, address='127.0.0.1'):
+    "Publish the metrics on http://address:port/metrics"
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print("Publishing metrics on http://%s:%d/metrics" % (address, server.server_address[1]))
+    return server
+
+
+def log_periodically(interval):
+    "Print a summary line every interval seconds"
+    def run():
+        def sample():
+            return (RECEIVED.total(), INOTIFY.total(), CALLBACKS.count_and_sum(),
+                    DISPATCH_DELAY.count_and_sum(), time.monotonic())
+        previous = sample()
+        while True:
+            time.sleep(interval)
+            current = sample()
+            elapsed = current[4] - previous[4]
+            calls = current[2][0] - previous[2][0]
+            call_time = current[2][1] - previous[2][1]
+            delays = current[3][0] - previous[3][0]
+            delay_sum = current[3][1] - previous[3][1]
+            print("Stats: received %.1f/s, processed %.1f/s, callbacks %.1f/s (mean %.2f ms),"
+                  " mean queue delay %.2f ms, event losses %d"
+                  % ((current[0] - previous[0]) / elapsed, (current[1] - previous[1]) / elapsed,
+                     calls / elapsed, 1000 * call_time / calls if calls else 0,
+                     1000 * delay_sum / delays if delays else 0, EVENT_LOSS.total()))
+            previous = current
+    Thread(target=run, name="stats", daemon=True).start()
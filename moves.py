@@ -0,0 +1,72 @@
+"""Pair the two halves of inotify move events."""
+import heapq
+import time
+
+
+class MovePairer:
+    """
+    Match IN_MOVED_FROM and IN_MOVED_TO events using their cookie.  A half
+    that remains unmatched after max_events further events, or after
+    max_age seconds, whichever comes first, is handed to on_expired, with
+    the count of the event that carried it: the file or directory was
+    moved into or out of the watched paths.
+
+    Pending halves are indexed by their expiry in two heaps, so each event
+    costs O(log n) regardless of how many moves are outstanding.  Entries
+    for halves that were matched are discarded lazily, as they reach the
+    top of a heap.
+    """
+
+    def __init__(self, on_expired, max_events=5, max_age=1.0):
+        self.__on_expired = on_expired
+        self.__max_events = max_events
+        self.__max_age = max_age
+        self.__pending = {}
+        self.__by_count = []
+        self.__by_time = []
+        self.__sequence = 0
+
+    def __len__(self):
+        return len(self.__pending)
+
+    def pair(self, cookie, path, action, isDir, eventCount):
+        """
+        Record one half of a move.  Returns the path of the other half, and
+        the count of the event that carried it, if it has already been seen,
+        otherwise None.
+        """
+        other = self.__pending.pop(cookie, None)
+        if other is not None:
+            return (other[0], other[4])
+
+        self.__sequence += 1
+        self.__pending[cookie] = (path, action, isDir, self.__sequence, eventCount)
+        heapq.heappush(self.__by_count, (eventCount + self.__max_events, self.__sequence, cookie))
+        heapq.heappush(self.__by_time, (time.monotonic() + self.__max_age, self.__sequence, cookie))
+        return None
+
+    def expire(self, eventCount):
+        "Flush all halves whose event-count or time window has passed"
+        self.__expire(self.__by_count, eventCount)
+        if self.__by_time:
+            self.__expire(self.__by_time, time.monotonic())
+
+    def oldest(self):
+        "Return the count of the event carrying the oldest pending half, or None"
+        return min((pending[4] for pending in self.__pending.values()), default=None)
+
+    def flush(self):
+        "Flush all pending halves"
+        for cookie in list(self.__pending):
+            self.__flush(cookie)
+
+    def __expire(self, heap, now):
+        while heap and heap[0][0] <= now:
+            (_, sequence, cookie) = heapq.heappop(heap)
+            pending = self.__pending.get(cookie)
+            if pending is not None and pending[3] == sequence:
+                self.__flush(cookie)
+
+    def __flush(self, cookie):
+        (path, action, isDir, _, eventCount) = self.__pending.pop(cookie)
+        self.__on_expired(path, action, isDir, eventCount)
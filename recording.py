@@ -0,0 +1,93 @@
+"""Record the events read from a channel, and replay them later."""
+from threading import Lock
+from urllib.parse import quote, unquote
+import time
+
+
+class Recorder:
+    """
+    Write everything needed to replay a session to a file, replacing any
+    earlier recording: the paths being watched, each watch as it is
+    established and each message read from the channel, with the time it
+    arrived.  Records are one line each:
+
+        P <recursive> <path>
+        W <time> <watch> <path>
+        E <time> <event type> <id, or -> <data>
+
+    Paths are URL-encoded.  Writes are buffered and flushed at least every
+    flush_interval seconds.
+    """
+
+    def __init__(self, path, flush_interval=1.0):
+        self.__file = open(path, 'w')
+        self.__lock = Lock()
+        self.__flush_interval = flush_interval
+        self.__last_flush = time.monotonic()
+
+    def roots(self, paths, recursive):
+        for path in paths:
+            self.__write("P %d %s\n" % (recursive, quote(path)))
+
+    def watch(self, watch, path):
+        self.__write("W %.6f %s %s\n" % (time.time(), watch, quote(path)))
+
+    def event(self, event_type, event_id, data):
+        self.__write("E %.6f %s %s %s\n" % (time.time(), event_type, event_id or "-",
+                                           data.replace("\n", " ")))
+
+    def __write(self, line):
+        with self.__lock:
+            self.__file.write(line)
+            if time.monotonic() - self.__last_flush >= self.__flush_interval:
+                self.__file.flush()
+                self.__last_flush = time.monotonic()
+
+    def close(self):
+        with self.__lock:
+            self.__file.close()
+
+
+class Replay:
+    """
+    Read a recording.  The paths that were watched are available as roots
+    and recursive once the recording is opened.  Iterating yields
+    ('watch', watch, path) and ('event', type, id, data) tuples, spaced out
+    as they originally arrived, divided by speed.  A speed of zero yields
+    them as quickly as possible.
+    """
+
+    def __init__(self, path, speed=1.0):
+        self.__path = path
+        self.__speed = speed
+        self.roots = []
+        self.recursive = False
+        with open(path) as f:
+            for line in f:
+                if line.startswith("P "):
+                    (_, recursive, encoded_path) = line.split()
+                    self.roots.append(unquote(encoded_path))
+                    self.recursive = recursive == "1"
+
+    def __iter__(self):
+        started = None
+        with open(self.__path) as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break # Cut short while being recorded.
+                record = line[:-1].split(" ", 4)
+                if record[0] == "P":
+                    continue
+
+                recorded = float(record[1])
+                if started is None:
+                    started = (time.monotonic(), recorded)
+                elif self.__speed:
+                    delay = started[0] + (recorded - started[1]) / self.__speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                if record[0] == "W":
+                    yield ('watch', record[2], unquote(record[3]))
+                elif record[0] == "E":
+                    yield ('event', record[2], None if record[3] == "-" else record[3], record[4])
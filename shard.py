@@ -0,0 +1,124 @@
+"""Spread watches over several channels, each read by its own process."""
+import collections
+import multiprocessing
+import queue
+import bootstrap
+import requests
+import time
+
+
+def partition(paths, recursive, count, list_subdirectories):
+    """
+    Divide the paths to watch between count shards, returning a list of
+    (path, recursive) work units for each shard.  When watching
+    recursively, trees are split into their top directory and the trees
+    below it until there are several units per shard, so that one large
+    tree is not left to a single shard.
+    """
+    pending = collections.deque((path, recursive) for path in paths)
+    units = []
+    while pending and len(pending) + len(units) < count * 4:
+        (path, is_recursive) = pending.popleft()
+        if not is_recursive:
+            units.append((path, False))
+            continue
+        try:
+            subdirectories = list_subdirectories(path)
+        except (requests.exceptions.RequestException, ValueError, bootstrap.IncompleteListing) as e:
+            print("Failed to list directory %s: %s" % (path, str(e)))
+            units.append((path, True))
+            continue
+        units.append((path, False))
+        pending.extend((path.rstrip("/") + "/" + name, True) for name in subdirectories)
+    units.extend(pending)
+
+    assignments = [[] for i in range(count)]
+    for i, unit in enumerate(units):
+        assignments[i % count].append(unit)
+    return assignments
+
+
+class Shards:
+    """
+    Run one worker process per shard and merge their messages into a
+    single stream.  The worker is called as worker(index, units, send)
+    and must send ('exit', index) as its final message.  Messages from
+    any one worker are received in the order they were sent, so events
+    for a path, which always belongs to one shard, stay in order.
+
+    Workers are forked, so they must be started before the process starts
+    any threads.
+    """
+
+    def __init__(self, worker, assignments, queue_depth=10000):
+        context = multiprocessing.get_context('fork')
+        self.__queue = context.Queue(maxsize=queue_depth)
+        self.__processes = [context.Process(target=worker, args=(i, units, self.__queue.put),
+                                            name="shard-%d" % i, daemon=True)
+                            for i, units in enumerate(assignments)]
+
+    def __len__(self):
+        return len(self.__processes)
+
+    def start(self):
+        for process in self.__processes:
+            process.start()
+
+    def messages(self, poll=1.0):
+        """
+        Yield messages from the workers until they have all exited.  A
+        worker that dies without sending its exit message, for example
+        because it was killed, is noticed within two quiet periods of poll
+        seconds, the second letting anything it sent arrive, and an exit
+        message is yielded on its behalf.
+        """
+        exited = set()
+        dead = set()
+        while len(exited) < len(self.__processes):
+            try:
+                message = self.__queue.get(timeout=poll)
+            except queue.Empty:
+                for index, process in enumerate(self.__processes):
+                    if index in exited or process.exitcode is None:
+                        continue
+                    if index in dead:
+                        print("Shard %d died with exit code %d" % (index, process.exitcode))
+                        exited.add(index)
+                        yield ('exit', index)
+                    else:
+                        dead.add(index)
+                continue
+            if message[0] == 'exit':
+                exited.add(message[1])
+            yield message
+
+    def stop(self, interrupted=False, grace=1.0, timeout=10):
+        """
+        Stop the workers.  If this process was interrupted, the workers may
+        have been interrupted along with it, so they are given grace
+        seconds to exit; any still running are then sent SIGTERM, so that
+        they clean up.  Any still running timeout seconds later are killed.
+        Messages sent meanwhile are discarded, so no worker is left blocked
+        on a full queue, unable to delete its channel.
+        """
+        if interrupted:
+            self.__join(time.monotonic() + grace)
+        for process in self.__processes:
+            if process.is_alive():
+                process.terminate()
+        self.__join(time.monotonic() + timeout)
+        for process in self.__processes:
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+    def __join(self, deadline):
+        "Wait until all workers have exited or deadline passes, draining the queue"
+        while any(process.is_alive() for process in self.__processes):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                self.__queue.get(timeout=min(remaining, 0.05))
+            except queue.Empty:
+                pass
@@ -1,14 +1,27 @@
 #!/usr/bin/env python3
 """test application to demonstrate dCache inotify"""
-from sseclient import SSEClient
 import requests
 import urllib3
 import getpass
 import argparse
-import json
+import sys
 import activities
+import bootstrap
+import dispatch
+import moves
+import checkpoint
+import coalesce
+import shard
+import watchindex
+import metrics
+import recording
 import liboidcagent as oidc
 import os
+import signal
+import sse
+import snapshot
+import time
+from threading import Thread, Lock
 
 ##
 ##  This util needs liboidcagent, which may be installed via
@@ -21,18 +34,73 @@ import os
 ##
 
 class OidcAuth(requests.auth.AuthBase):
-    """Support for authenticating with OIDC access token"""
-    def __init__(self, account):
+    """
+    Support for authenticating with OIDC access token.  The token is
+    reused until refresh_margin seconds before it expires, and a background
+    thread fetches a new one from oidc-agent ahead of that, so requests
+    rarely wait for the agent.  One instance is shared by all sessions.
+    Without refresh, no thread is started and tokens are fetched as needed.
+    While the agent cannot be reached, the thread retries after 2, 4, 8...
+    seconds, up to max_backoff.
+    """
+    def __init__(self, account, refresh_margin=60, default_lifetime=300, refresh=True, max_backoff=60):
         self.account = account
+        self.__refresh_margin = refresh_margin
+        self.__default_lifetime = default_lifetime
+        self.__max_backoff = max_backoff
+        self.__background = refresh
+        self.__lock = Lock()
+        self.__cached = (None, 0)
+        self.__refresher_pid = None
 
     def __call__(self, r):
-        token = oidc.get_access_token(self.account)
-        r.headers.update({'Authorization': "Bearer %s" % (token)})
+        r.headers.update({'Authorization': "Bearer %s" % (self.token())})
         return r
 
+    def token(self):
+        "Return a token valid for at least refresh_margin seconds"
+        (token, expires) = self.__cached
+        if token is None or time.time() >= expires - self.__refresh_margin:
+            with self.__lock:
+                (token, expires) = self.__cached
+                if token is None or time.time() >= expires - self.__refresh_margin:
+                    (token, expires) = self.__fetch()
+        if self.__background and self.__refresher_pid != os.getpid(): # None yet, or lost by forking.
+            with self.__lock:
+                if self.__refresher_pid != os.getpid():
+                    self.__refresher_pid = os.getpid()
+                    Thread(target=self.__refresh, name="oidc-refresh", daemon=True).start()
+        return token
+
+    def __fetch(self):
+        (token, issuer, expires_at) = oidc.get_token_response(self.account,
+                                                             min_valid_period=3 * self.__refresh_margin)
+        if not expires_at:
+            expires_at = time.time() + self.__default_lifetime
+        self.__cached = (token, expires_at)
+        return self.__cached
+
+    def __refresh(self):
+        backoff = 1
+        while True:
+            (_, expires) = self.__cached
+            time.sleep(max(backoff, expires - 2 * self.__refresh_margin - time.time()))
+            try:
+                with self.__lock:
+                    if time.time() >= self.__cached[1] - 2 * self.__refresh_margin:
+                        self.__fetch()
+                backoff = 1
+            except Exception as e:
+                print("Failed to refresh OIDC access token: %s" % e)
+                backoff = min(2 * backoff, self.__max_backoff)
+
 parser = argparse.ArgumentParser(description='Sample dCache SSE consumer')
 parser.add_argument('--state', metavar="PATH",
                     help='Path of a file in which information is stored to avoid loosing events.')
+parser.add_argument('--checkpoint-interval', metavar="SECONDS", type=float, default=1.0,
+                    help="The longest time between forcing state changes to disk.")
+parser.add_argument('--checkpoint-events', metavar="COUNT", type=int, default=1000,
+                    help="The most events processed between forcing state changes to disk.")
 parser.add_argument('--endpoint',
                     default="https://prometheus.desy.de:3880/api/v1",
                     help="The events endpoint.  This should be a URL like 'https://frontend.example.org:3880/api/v1'.")
@@ -42,6 +110,10 @@ parser.add_argument('--user', metavar="NAME", default=getpass.getuser(),
                     help="The dCache username.  Defaults to the current user's name.")
 parser.add_argument('--oidc-account', metavar="NAME", help="The oidc-agent account name")
 parser.add_argument('--recursive', '-r', action='store_const', const='recursive', default='single')
+parser.add_argument('--shards', metavar="COUNT", type=int, default=1,
+                    help="Spread the watches over this many channels, each read by its own process.")
+parser.add_argument('--bootstrap-workers', metavar="COUNT", type=int, default=16,
+                    help="How many concurrent requests to make when establishing watches.")
 parser.add_argument('--password', default=None,
                     help="The dCache password.  Defaults to prompting the user.")
 parser.add_argument('--x509-trust', choices=['path', 'builtin', 'any'],
@@ -52,13 +124,85 @@ parser.add_argument('--x509-trust-path', metavar="PATH", default='/etc/grid-secu
 parser.add_argument('--x509-proxy', metavar="PATH", dest='proxy',
                     default=os.environ.get('X509_USER_PROXY', '/tmp/x509up_u' + str(os.getuid())),
                     help='Client X509 proxy file.')
-parser.add_argument('paths', metavar='PATH', nargs='+',
+parser.add_argument('paths', metavar='PATH', nargs='*',
                     help='The paths to watch.')
-parser.add_argument('--activity', metavar="ACTIVITY", choices=['print', 'unarchive', 'execute'], default="print",
-                    help='What to do with the inotify events.')
+parser.add_argument('--record', metavar="PATH",
+                    help="Write the events read, and the watches established, to this file, replacing its contents.")
+parser.add_argument('--replay', metavar="PATH",
+                    help="Instead of contacting dCache, take the watches and events from a recording made with --record.")
+parser.add_argument('--replay-speed', metavar="FACTOR", type=float, default=1.0,
+                    help="How much faster than real time to replay events.  Zero replays them as quickly as possible.")
+parser.add_argument('--activity', metavar="ACTIVITY", choices=['print', 'unarchive', 'execute'], action='append',
+                    help='What to do with the inotify events.  May be repeated to run several activities, each with its own queue.  The default is print.')
+parser.add_argument('--queue-depth', metavar="COUNT", type=int, default=10000,
+                    help="The maximum number of received events waiting to be processed.")
+parser.add_argument('--queue-policy', choices=dispatch.POLICIES, default='block',
+                    help="What to do with a new event when the queue is full.  Dropping events triggers an event-loss notification.")
+parser.add_argument('--activity-queue-policy', choices=dispatch.POLICIES, default='drop-newest',
+                    help="What to do with a new event when an activity's own queue is full.  With several activities, blocking holds up all of them until the slowest catches up; dropping events tells only that activity of the loss.")
+parser.add_argument('--queue-stats-interval', metavar="SECONDS", type=float, default=0,
+                    help="How often to report the event queue's depth.  Zero disables reporting.")
+parser.add_argument('--reconcile', action='store_true',
+                    help="Keep a snapshot of the watched directories and, after event loss, report the differences as events.")
+parser.add_argument('--metrics-port', metavar="PORT", type=int, default=0,
+                    help="Publish Prometheus metrics on this port, at /metrics.  Zero disables publishing.")
+parser.add_argument('--metrics-address', metavar="ADDRESS", default='127.0.0.1',
+                    help="The address on which metrics are published.")
+parser.add_argument('--stats-interval', metavar="SECONDS", type=float, default=0,
+                    help="How often to log event throughput and latency.  Zero disables logging.")
+parser.add_argument('--move-window', metavar="SECONDS", type=float, default=1.0,
+                    help="How long to wait for the other half of a move before treating it as a create or delete.")
+parser.add_argument('--move-window-events', metavar="COUNT", type=int, default=5,
+                    help="How many events to wait for the other half of a move before treating it as a create or delete.")
+parser.add_argument('--coalesce-window', metavar="SECONDS", type=float, default=0,
+                    help="How long to hold events so that related ones may be merged.  Zero disables merging.")
+parser.add_argument('--batch-size', metavar="COUNT", type=int, default=1,
+                    help="The maximum number of events passed to the activity at once.  One passes events one at a time.")
+parser.add_argument('--batch-latency', metavar="SECONDS", type=float, default=0.1,
+                    help="The maximum time an event waits before its batch is passed to the activity.")
 parser.add_argument('--target-path', metavar="PATH", default=None, help="The path for unarchive activity");
+parser.add_argument('--download-buffer-size', metavar="BYTES", type=int, default=1024*1024,
+                    help="Size of the chunks in which the unarchive activity downloads archives.")
+parser.add_argument('--parallel-download-threshold', metavar="BYTES", type=int, default=256*1024*1024,
+                    help="Archives at least this large are downloaded in parallel ranges, then verified against their checksum.")
+parser.add_argument('--download-part-size', metavar="BYTES", type=int, default=64*1024*1024,
+                    help="The size of each range of a parallel download.")
+parser.add_argument('--download-workers', metavar="COUNT", type=int, default=4,
+                    help="How many ranges of each archive are downloaded concurrently.")
+parser.add_argument('--download-dir', metavar="PATH", default=None,
+                    help="Keep parallel downloads, and a manifest of each archive's uploaded members, in this directory so that unfinished archives are resumed after a restart.")
+parser.add_argument('--door-ttl', metavar="SECONDS", type=float, default=60,
+                    help="How often to refresh the list of doors, and their load.  Zero disables refreshing.")
+parser.add_argument('--door-protocol', choices=['https', 'http'], default='https',
+                    help="Which kind of WebDAV door the unarchive activity uses.")
+parser.add_argument('--unarchive-workers', metavar="COUNT", type=int, default=4,
+                    help="How many archives the unarchive activity processes concurrently.")
+parser.add_argument('--extract-processes', metavar="COUNT", type=int, default=0,
+                    help="Extract archives in a pool of this many worker processes.  Zero extracts them in the unarchive activity's threads.")
+parser.add_argument('--upload-workers', metavar="COUNT", type=int, default=4,
+                    help="How many members of each archive are uploaded concurrently.")
 parser.add_argument('--execute-command', metavar="CMD", default=None, help="Command to execute");
+parser.add_argument('--execute-mode', choices=activities.ExecuteActivity.MODES, default='event',
+                    help="Whether the command is run per event, per batch of events or once, reading events from stdin.")
+parser.add_argument('--execute-max-processes', metavar="COUNT", type=int, default=16,
+                    help="The maximum number of commands running at any time.")
+parser.add_argument('--execute-batch-size', metavar="COUNT", type=int, default=100,
+                    help="The maximum number of events sent to the command in one batch.")
+parser.add_argument('--execute-batch-latency', metavar="SECONDS", type=float, default=1.0,
+                    help="The maximum time an event waits before its batch is sent to the command.")
 args = vars(parser.parse_args())
+# Each activity is run once, in the order given.
+args["activity"] = list(dict.fromkeys(args["activity"] or ['print']))
+
+replay = None
+if args["replay"]:
+    if args["state"] or args["shards"] > 1 or args["record"]:
+        raise Exception('--replay may not be used together with --state, --shards or --record')
+    replay = recording.Replay(args["replay"], speed=args["replay_speed"])
+    args["paths"] = replay.roots
+    args["recursive"] = 'recursive' if replay.recursive else 'single'
+elif not args["paths"]:
+    parser.error("at least one PATH is required")
 
 state_path = args["state"]
 auth = args["auth"]
@@ -66,20 +210,29 @@ user = args["user"]
 pw = args["password"]
 oidc_account = args["oidc_account"]
 isRecursive = args["recursive"] == 'recursive'
-if auth == 'userpw' and not pw:
+if auth == 'userpw' and not pw and not replay:
     pw = getpass.getpass("Please enter dCache password for user " + user + ": ")
     args["password"] = pw
 if auth == 'oidc' and not oidc_account:
     raise Exception('Missing oidc-agent account name.  Please specify --oidc-account')
-
-def configure_session(args):
+if args["shards"] > 1 and state_path:
+    raise Exception('--state may not be used together with --shards')
+if args["reconcile"] and (args["shards"] > 1 or replay):
+    raise Exception('--reconcile may not be used together with --shards or --replay')
+oidc_auth = OidcAuth(oidc_account) if auth == 'oidc' else None
+
+def configure_session(args, threads=True):
+    """
+    Return a new session.  Without threads, the session starts no
+    background threads, so the process may still be forked safely.
+    """
     s = requests.Session()
 
     auth = args.get("auth")
     if auth == 'userpw':
         s.auth = (args.get("user"),args.get("password"))
     elif auth == 'oidc':
-        s.auth = OidcAuth(oidc_account)
+        s.auth = oidc_auth if threads else OidcAuth(oidc_account, refresh=False)
     else:
         s.cert = args.get("proxy")
 
@@ -92,7 +245,7 @@ def configure_session(args):
         s.verify = args.get("x509-trust-path")
     elif trust != 'builtin':
         raise Exception('Unknown trust value: ' + str(trust))
-    return s
+    return metrics.instrument_session(s)
 
 def request_channel(session):
     print("Creating a new channel")
@@ -100,156 +253,311 @@ def request_channel(session):
     response.raise_for_status()
     return response.headers['Location']
 
-eventCount = 0
-activity_name = args.get("activity")
-
-if activity_name == 'print':
-    activity = activities.PrintActivity()
-elif activity_name == 'unarchive':
-    target = args.get("target_path")
-    if not target:
-        raise Exception('Missing --target-path argument')
-    activity = activities.UnarchiveActivity(target, args=args, session_factory=configure_session, api_url=args["endpoint"])
-elif activity_name == 'execute':
-    cmd = args.get("execute_command")
-    if not cmd:
-        raise Exception('Missing --execute-command argument')
-    activity = activities.ExecuteActivity(cmd)
-else:
-    raise Exception('Unknown activity: ' + activity)
-
-def watch(channel, path):
-    "Add a watch and update watches list if successful"
-    w = s.post(format(channel) + "/subscriptions/inotify",
-               json={"path": path, "flags": ["IN_CLOSE_WRITE", "IN_CREATE",
-                                             "IN_DELETE", "IN_DELETE_SELF",
-                                             "IN_MOVE_SELF", "IN_MOVE",
-                                             "IN_ATTRIB"]})
-    w.raise_for_status()
-    watch = w.headers['Location']
-    print("Watching %s" % path)
-    watches[watch] = path
+def channel_of(watch):
+    "Return the URL of the channel to which a watch belongs"
+    return watch[:watch.rindex("/subscriptions/")]
 
-def single_watch(channel, path):
-    "Watch a single path (i.e., non-recursive)"
-    try:
-        watch(channel, path)
-    except requests.exceptions.HTTPError as e:
-        r = e.response
-        if r.status_code == 400:
-            print("Watch for path %s request failed: %s" % (path, r.json()["errors"][0]["message"]))
-        else:
-            print("Server rejected watch for path %s: %s" % (path, str(e)))
+def follow_channel(session, channel, last_id, deliver, recreate):
+    """
+    Pass each message in channel to deliver, until an HTTP error occurs.
+    If the channel no longer exists, recreate is called to establish a
+    new one.
+    """
+    while True:
+        try:
+            messages = sse.EventStream(session, channel, last_id)
+            for msg in messages:
+                deliver(msg)
+
+        except requests.exceptions.HTTPError as e:
+            r = e.response
+            if r.status_code == 404:
+                print("Recovering from unknown channel")
+                channel = recreate(channel)
+                last_id = None
+            else:
+                print("HTTP error {} {}".format(r.status_code, r.reason))
+                return
 
-    except requests.exceptions.RequestException as e:
-        print("Failed to watch path %s: %s" % (path, str(e)))
+def normalise_path(path):
+    "Strip off any trailing '/' in any non-root path"
+    return path if path == "/" or not path.endswith("/") else path[:-1]
 
 
-def watch_subdirectories(path):
-    "Recursively watch all subdirectories of the given path"
-    try:
-        r = s.get(args["endpoint"] + "/namespace" + path + "?children=true")
-        r.raise_for_status()
-        dir_list = r.json()
-        children = dir_list["children"]
-
-        for item in children:
-            if item["fileType"] == "DIR":
-                recursive_watch(channel, path + "/" + item["fileName"])
-
-    except requests.exceptions.HTTPError as e:
-        r = e.response
-        if r.status_code == 400:
-            print("Directory listing for path %s failed: %s" % (path, r.json()["errors"][0]["message"]))
+def remove_redundant_paths(paths):
+    "Return a list of paths where any subdirectories have been removed"
+    non_redundant_paths = []
+    for path in paths:
+        paths_to_remove = []
+        for non_redundant_path in non_redundant_paths:
+            if path.startswith(non_redundant_path + "/"):
+                print("Skipping redundant path: %s" % path)
+                break
+            elif non_redundant_path.startswith(path + "/"):
+                print("Skipping redundant path: %s" % non_redundant_path)
+                paths_to_remove.append(non_redundant_path)
         else:
-            print("Server rejected directory listing for path %s: %s" % (path, str(e)))
+            non_redundant_paths.append(path)
+        for remove_path in paths_to_remove:
+            non_redundant_paths.remove(remove_path)
+    return non_redundant_paths
 
-    except requests.exceptions.RequestException as e:
-        print("Failed to list directory %s: %s" % (path, str(e)))
 
 
-def recursive_watch(channel, path):
-    "Watch path and any subdirectories, recursively"
-    try:
-        watch(channel, path)
-        watch_subdirectories(path)
+roots = list(map(normalise_path, args["paths"]))
+if isRecursive:
+    roots = remove_redundant_paths(roots)
+
+recorder = None
+if args["record"]:
+    recorder = recording.Recorder(args["record"])
+    recorder.roots(roots, isRecursive)
+
+ACTIVITIES = {'print': activities.PrintActivity,
+              'unarchive': activities.UnarchiveActivity,
+              'execute': activities.ExecuteActivity}
+
+# Subscribe only to the events that the activities, and keeping track of the
+# watched directories, depend on.
+needed_flags = set()
+for name in args["activity"]:
+    needed_flags |= ACTIVITIES[name].inotifyFlags()
+if args["reconcile"]:
+    needed_flags |= snapshot.ReconcilingActivity.inotifyFlags()
+watch_flags = bootstrap.watch_flags(needed_flags, isRecursive)
+print("Subscribing to %s" % ", ".join(watch_flags))
+
+def new_bootstrap():
+    return bootstrap.Bootstrap(configure_session, args, workers=args["bootstrap_workers"], flags=watch_flags)
+
+def run_shard(index, units, send):
+    "Worker process: establish one shard's channel and watches, then forward its events"
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    session = configure_session(args)
+    channel = None
+
+    def establish(old_channel=None):
+        nonlocal channel
+        if old_channel:
+            send(('reset', old_channel))
+        channel = request_channel(session)
+        walker = new_bootstrap()
+        for recursive in [False, True]:
+            paths = [path for (path, is_recursive) in units if is_recursive == recursive]
+            if paths:
+                walker.run(channel, paths, recursive, lambda watch, path: send(('watch', watch, path)))
+        send(('ready', index))
+        return channel
 
-    except requests.exceptions.HTTPError as e:
-        r = e.response
-        if r.status_code == 400:
-            print("Watch for path %s request failed: %s" % (path, r.json()["errors"][0]["message"]))
-        else:
-            print("Server rejected watch for path %s: %s" % (path, str(e)))
+    try:
+        channel = establish()
+        follow_channel(session, channel, None,
+                       lambda msg: send(('event', msg.event, msg.id, msg.data)),
+                       establish)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if channel:
+            session.delete(channel)
+        send(('exit', index))
+
+# Worker processes are forked, so they are started before any threads.
+shards = None
+if args["shards"] > 1:
+    with configure_session(args, threads=False) as session:
+        assignments = shard.partition(roots, isRecursive, args["shards"],
+                                      lambda path: bootstrap.list_subdirectories(session, args["endpoint"], path))
+    shards = shard.Shards(run_shard, assignments, queue_depth=args["queue_depth"])
+    shards.start()
 
-    except requests.exceptions.RequestException as e:
-        print("Failed to watch path %s: %s" % (path, str(e)))
+eventCount = 0
 
+def create_activity(activity_name):
+    "Create an activity, configured from the command-line options"
+    if activity_name == 'print':
+        return activities.PrintActivity()
+    elif activity_name == 'unarchive':
+        target = args.get("target_path")
+        if not target:
+            raise Exception('Missing --target-path argument')
+        return activities.UnarchiveActivity(target, args=args, session_factory=configure_session, api_url=args["endpoint"],
+                                            buffer_size=args["download_buffer_size"],
+                                            parallel_threshold=args["parallel_download_threshold"],
+                                            part_size=args["download_part_size"],
+                                            download_workers=args["download_workers"],
+                                            download_dir=args["download_dir"],
+                                            archive_workers=args["unarchive_workers"],
+                                            upload_workers=args["upload_workers"],
+                                            extract_processes=args["extract_processes"],
+                                            door_ttl=args["door_ttl"],
+                                            door_protocol=args["door_protocol"])
+    elif activity_name == 'execute':
+        cmd = args.get("execute_command")
+        if not cmd:
+            raise Exception('Missing --execute-command argument')
+        return activities.ExecuteActivity(cmd, mode=args["execute_mode"],
+                                          max_processes=args["execute_max_processes"],
+                                          batch_size=args["execute_batch_size"],
+                                          batch_latency=args["execute_batch_latency"])
+    else:
+        raise Exception('Unknown activity: ' + activity_name)
 
+if len(args["activity"]) == 1:
+    activity = activities.TimedActivity(create_activity(args["activity"][0]))
+else:
+    # Events are parsed once and then queued for each activity separately.
+    # The unarchive activity forks its extraction processes, so it is
+    # created before any activity that starts threads.
+    created = {}
+    for name in sorted(args["activity"], key=lambda name: name != 'unarchive'):
+        created[name] = activities.TimedActivity(create_activity(name))
+    fan_out = activity = dispatch.FanOutActivity([created[name] for name in args["activity"]],
+                                                 args["activity"],
+                                                 depth=args["queue_depth"], policy=args["activity_queue_policy"])
+    for (index, name) in enumerate(args["activity"]):
+        metrics.REGISTRY.gauge('%s_queue_depth' % name, 'Events waiting for the %s activity' % name,
+                               lambda index=index: fan_out.depths()[index])
+
+# Processes are forked while creating the activities, so the metrics threads
+# are started only now.
+if args["metrics_port"]:
+    metrics.serve(args["metrics_port"], args["metrics_address"])
+if args["stats_interval"] > 0:
+    metrics.log_periodically(args["stats_interval"])
+
+batcher = None
+if args["batch_size"] > 1:
+    batcher = activity = activities.BatchingActivity(activity, max_size=args["batch_size"],
+                                                     max_latency=args["batch_latency"])
+coalescer = None
+if args["coalesce_window"] > 0:
+    coalescer = activity = coalesce.CoalescingActivity(activity, window=args["coalesce_window"])
+
+def watch_directories(paths):
+    "Watch directories found while reconciling"
+    walker = new_bootstrap()
+    walker.run(channel, paths, False, add_to_watches)
+
+reconciler = None
+if args["reconcile"]:
+    reconciler = activity = snapshot.ReconcilingActivity(activity, configure_session, args,
+                                                         recursive=isRecursive,
+                                                         workers=args["bootstrap_workers"],
+                                                         on_new_directories=watch_directories,
+                                                         on_deleted_directory=lambda path: remove_watched_tree(path, True))
+listed = reconciler.listed if reconciler else None
+
+def add_to_watches(watch, path):
+    "Record a newly established watch"
+    print("Watching %s" % path)
+    watches.add(watch, path)
+    if recorder:
+        recorder.watch(watch, path)
+    if checkpointer:
+        checkpointer.watch_added(watch, path)
+
+def remove_from_watches(watch):
+    "Forget a watch that no longer exists"
+    if watches.remove(watch) is not None and checkpointer:
+        checkpointer.watch_removed(watch)
+
+def remove_watched_tree(path, unsubscribe):
+    "Forget all watches at or below path, optionally removing them from the server"
+    removed = [watch for (watch, _) in watches.remove_subtree(path)]
+    if checkpointer:
+        for watch in removed:
+            checkpointer.watch_removed(watch)
+    if unsubscribe and removed and not replay:
+        print("Removing %d watches below %s" % (len(removed), path))
+        new_bootstrap().unwatch(removed)
+
+def rename_watched_tree(fromPath, toPath):
+    "Update the watches of a directory tree that was moved"
+    replaced = watches.rename(fromPath, toPath)
+    if checkpointer:
+        for (watch, _) in replaced:
+            checkpointer.watch_removed(watch)
+        checkpointer.watches_renamed(fromPath, toPath)
+
+def watch_tree(path):
+    "Watch a directory tree that appeared within a watched directory"
+    parent = watches.watch_for(os.path.dirname(path))
+    if parent is None or replay or watches.watch_for(path) is not None:
+        return
+    walker = new_bootstrap()
+    walker.run(channel_of(parent), [path], True, add_to_watches, listed)
+
+def expired_move(path, action, isDir, eventCount):
+    "Handle a move into, or out of, the watched paths"
+    with activities.EVENT_NUMBERS.handling(eventCount):
+        if action == 'IN_MOVED_FROM':
+            if isDir:
+                remove_watched_tree(path, True)
+                activity.onDeletedDirectory(path)
+            else:
+                activity.onDeletedFile(path)
+        else:
+            if isDir:
+                if isRecursive:
+                    watch_tree(path)
+                activity.onNewDirectory(path)
+            else:
+                activity.onNewFile(path)
 
-def checkMoveEvents():
-    pop_list = []
-    for cookie, (path, action, removeAt) in mvCookie.items():
-        if removeAt <= eventCount:
-            pop_list.append(cookie)
 
-    for c in pop_list:
-        (path,action,_) = mvCookie.pop(c)
-        if action == 'IN_MOVE_FROM':
-            activity.onDeletedFile(path)
-        else:
-            activity.onNewFile(path)
+masks = {}
 
+def decode_mask(mask):
+    "Return the action and whether the target is a directory, caching the result for each mask"
+    key = tuple(mask)
+    decoded = masks.get(key)
+    if decoded is None:
+        isDir = 'IN_ISDIR' in key
+        action = sys.intern([flag for flag in key if flag != 'IN_ISDIR'][-1])
+        decoded = masks[key] = (action, isDir)
+    return decoded
 
 def inotify(type, sub, event):
     mask = event['mask']
 
+    watched = watches.get(sub)
+    if watched is None:
+        return # An event for a watch that was removed recently.
+
     if 'name' in event:
-        path = watches[sub] + '/' + event['name']
+        path = watched + '/' + event['name']
     else:
-        path = watches[sub]
-        if path in paths and isRecursive:
+        path = watched
+        if path in roots and isRecursive:
             return
 
-    isDir = False
-    for flag in mask:
-        if flag == 'IN_ISDIR':
-            isDir = True
-        else:
-            action = flag
+    (action, isDir) = decode_mask(mask)
+    metrics.INOTIFY.inc(action)
 
+    # The new directory may already have subdirectories, for example if it
+    # was created while the client was down, so the whole tree is walked.
     if action == 'IN_CREATE' and isDir and isRecursive:
-        single_watch(channel, path)
-
-    if action == 'IN_IGNORED' and isDir:
-        watches.pop(path)
-
-    if action == 'IN_MOVED_FROM':
-        mvFrom = path
-        cookie = event['cookie']
-        if cookie in mvCookie:
-            (mvTo, _, _) = mvCookie[cookie]
-            del mvCookie[cookie]
-            if isDir:
-                activity.onMovedDirectory(mvFrom, mvTo)
-            else:
-                activity.onMovedFile(mvFrom, mvTo)
-        else:
-            mvCookie[cookie] = (path,action, eventCount+5)
-
-    elif action == 'IN_MOVED_TO':
-        mvTo = path
-        cookie = event['cookie']
-        if cookie in mvCookie:
-            (mvFrom, _, _) = mvCookie[cookie]
-            del mvCookie[cookie]
-            if isDir:
-                activity.onMovedDirectory(mvFrom, mvTo)
-            else:
-                activity.onMovedFile(mvFrom, mvTo)
-        else:
-            mvCookie[cookie] = (path, action, eventCount+5)
+        watch_tree(path)
+
+    if action == 'IN_IGNORED':
+        remove_from_watches(sub)
+
+    if action == 'IN_DELETE' and isDir:
+        remove_watched_tree(path, False)
+
+    if action == 'IN_MOVED_FROM' or action == 'IN_MOVED_TO':
+        other = pairer.pair(event['cookie'], path, action, isDir, eventCount)
+        if other is not None:
+            (otherPath, otherCount) = other
+            (mvFrom, mvTo) = (path, otherPath) if action == 'IN_MOVED_FROM' else (otherPath, path)
+            # The move is as old as its first half.
+            with activities.EVENT_NUMBERS.handling(otherCount):
+                if isDir:
+                    rename_watched_tree(mvFrom, mvTo)
+                    activity.onMovedDirectory(mvFrom, mvTo)
+                else:
+                    activity.onMovedFile(mvFrom, mvTo)
     else:
-        checkMoveEvents()
         if isDir:
             if action == 'IN_CREATE':
                 activity.onNewDirectory(path)
@@ -273,46 +581,23 @@ def inotify(type, sub, event):
             else:
                 print("Suppressing %s %s" % (action, path))
 
-mvCookie = {}
-watches = {}
+checkpointer = None
+pairer = moves.MovePairer(expired_move, max_events=args["move_window_events"],
+                          max_age=args["move_window"])
+watches = watchindex.WatchIndex()
 
-
-def normalise_path(path):
-    "Strip off any trailing '/' in any non-root path"
-    return path if path == "/" or not path.endswith("/") else path[:-1]
-
-
-def remove_redundant_paths(paths):
-    "Return a list of paths where any subdirectories have been removed"
-    non_redundant_paths = []
-    for path in paths:
-        paths_to_remove = []
-        for non_redundant_path in non_redundant_paths:
-            if path.startswith(non_redundant_path + "/"):
-                print("Skipping redundant path: %s" % path)
-                break
-            elif non_redundant_path.startswith(path + "/"):
-                print("Skipping redundant path: %s" % non_redundant_path)
-                paths_to_remove.append(non_redundant_path)
-        else:
-            non_redundant_paths.append(path)
-        for remove_path in paths_to_remove:
-            non_redundant_paths.remove(remove_path)
-    return non_redundant_paths
+metrics.REGISTRY.gauge('watches', 'Established watches', lambda: len(watches))
+metrics.REGISTRY.gauge('pending_moves', 'Halves of moves waiting for their other half', lambda: len(pairer))
 
 
 def create_channel_and_watches(s):
     "Create a channel and include all watches"
     channel = request_channel(s)
+    if checkpointer:
+        checkpointer.start(channel)
 
-    paths = map(normalise_path, args["paths"])
-    if isRecursive:
-        paths = remove_redundant_paths(paths)
-        for path in paths:
-            recursive_watch(channel, path)
-    else:
-        for path in paths:
-            single_watch(channel, path)
+    walker = new_bootstrap()
+    walker.run(channel, roots, isRecursive, add_to_watches, listed)
 
     if not watches:
         exit("No watches established, exiting...")
@@ -320,91 +605,186 @@ def create_channel_and_watches(s):
     return channel
 
 
-def restore_channel_and_watches(path):
-    try:
-        with open(path) as f:
-            is_first = True
-            for line in f.readlines():
-                if is_first:
-                    (channel,last_id) = line.split()
-                    print("Restoring channel")
-                    is_first = False
-                else:
-                    (watch,encoded_path) = line.split()
-                    path = requests.utils.unquote(encoded_path)
-                    print("Restoring watch %s" % path)
-                    watches[watch] = path
-
-    except FileNotFoundError:
-        channel = create_channel_and_watches(s)
-        last_id = None
-
-    return (channel,last_id)
+def restore_channel_and_watches():
+    """
+    Resume the saved channel, if the server still has it, re-establishing
+    only the watches it lost.  Otherwise start afresh.
+    """
+    state = checkpointer.restore()
+    if state is None:
+        return (create_channel_and_watches(s), None)
+
+    (channel, last_id, restored) = state
+    for watch, path in restored.items():
+        watches.add(watch, path)
+        if recorder:
+            recorder.watch(watch, path)
+    print("Restored channel with %d watches" % len(watches))
+
+    walker = new_bootstrap()
+    unwatched = walker.revalidate(channel, watches.items(), isRecursive, add_to_watches,
+                                  lambda path: remove_watched_tree(path, True))
+    if unwatched is None:
+        print("Restored channel no longer exists; events since it was saved are lost")
+        watches.clear()
+        metrics.EVENT_LOSS.inc()
+        activity.onEventLoss()
+        return (create_channel_and_watches(s), None)
+    if unwatched:
+        print("Watching %d directories created while watches were missing" % len(unwatched))
+        new_bootstrap().run(channel, unwatched, True, add_to_watches)
+
+    if reconciler:
+        reconciler.populate([path for (_, path) in watches.items()])
+    return (channel, last_id)
 
 s = configure_session(args)
 
-if state_path:
-    (channel,last_id) = restore_channel_and_watches(state_path)
+if shards or replay:
+    channel = None
+    last_id = None
+elif state_path:
+    checkpointer = checkpoint.Checkpointer(state_path, sync_interval=args["checkpoint_interval"],
+                                           sync_events=args["checkpoint_events"],
+                                           held=lambda: activities.oldest_of(pairer.oldest(), activity.oldest_held()))
+    (channel,last_id) = restore_channel_and_watches()
 else:
     channel = create_channel_and_watches(s)
     last_id = None
 
-try:
-    while True:
-        try:
-            if last_id:
-                messages = SSEClient(channel, session=s, last_id=last_id)
-            else:
-                messages = SSEClient(channel, session=s)
+def event_loss():
+    "Tell the activity that events were lost, by the server or by the event queue"
+    metrics.EVENT_LOSS.inc()
+    activity.onEventLoss()
+
+def handle_event(eventType, event_id, raw_data):
+    "Act on a single event taken from the event queue"
+    global eventCount
+    eventCount = activities.EVENT_NUMBERS.next()
+    pairer.expire(eventCount)
+    data = sse.loads(raw_data)
+    if eventType == "SYSTEM":
+        type = data["type"]
+        if type == "EVENT_LOSS":
+            event_loss()
+        elif type != "NEW_SUBSCRIPTION" and type != "SUBSCRIPTION_CLOSED":
+            print("SYSTEM: %s" % raw_data)
+    else:
+        sub = data["subscription"]
+        event = data["event"]
+        if eventType == 'inotify':
+            inotify(eventType, sub, event)
+        else:
+            print("Unknown event: %s" % eventType)
+            print("    Subscription: %s" % sub)
+            print("    Data: %s" % event)
+    if checkpointer:
+        checkpointer.processed(event_id, eventCount)
+
+def tick():
+    "Periodic housekeeping, in the dispatcher thread"
+    pairer.expire(eventCount)
+    if reconciler:
+        reconciler.flush()
+    if coalescer:
+        coalescer.flush_expired()
+    if batcher:
+        batcher.flush_expired()
+    if checkpointer:
+        checkpointer.tick()
+
+events = dispatch.EventQueue(depth=args["queue_depth"], policy=args["queue_policy"],
+                             on_dequeue=metrics.DISPATCH_DELAY.observe)
+dispatcher = dispatch.Dispatcher(events, handle_event, event_loss,
+                                 stats_interval=args["queue_stats_interval"],
+                                 tick=tick)
+dispatcher.start()
+
+metrics.REGISTRY.gauge('queue_depth', 'Events waiting in the event queue', events.depth)
+metrics.REGISTRY.gauge('queue_high_water', 'Most events ever waiting in the event queue', lambda: events.high_water)
+metrics.REGISTRY.gauge('queue_dropped', 'Events dropped because the event queue was full', lambda: events.dropped)
+
+def receive(msg):
+    "Queue a message read from the channel"
+    global last_id
+    metrics.received(msg.event)
+    if recorder:
+        recorder.event(msg.event, msg.id, msg.data)
+    events.put((msg.event, msg.id, msg.data))
+    if msg.id:
+        last_id = msg.id
+
+def recover_channel(old_channel):
+    "Replace a channel that the server no longer knows about"
+    global channel
+    dispatcher.wait_until_idle()
+    watches.clear()
+    channel = create_channel_and_watches(s)
+    return channel
 
-            for msg in messages:
-                eventCount = eventCount + 1
-                eventType = msg.event
-                data = json.loads(msg.data)
-                if eventType == "SYSTEM":
-                    type = data["type"]
-                    if type == "EVENT_LOSS":
-                        activity.onEventLoss()
-                    elif type != "NEW_SUBSCRIPTION" and type != "SUBSCRIPTION_CLOSED":
-                        print("SYSTEM: %s" % msg.data)
-                else:
-                    sub = data["subscription"]
-                    event = data["event"]
-                    if eventType == 'inotify':
-                        inotify(eventType, sub, event)
-                    else:
-                        print("Unknown event: %s", type)
-                        print("    Subscription: %s", sub)
-                        print("    Data: %s", event)
-
-                if msg.id:
-                    last_id = msg.id
+def receive_from_shards():
+    "Queue events from all shards, tracking the watches they establish"
+    ready = 0
+    for message in shards.messages():
+        kind = message[0]
+        if kind == 'event':
+            metrics.received(message[1])
+            if recorder:
+                recorder.event(*message[1:])
+            events.put(message[1:])
+        elif kind == 'watch':
+            add_to_watches(message[1], message[2])
+        elif kind == 'reset':
+            dispatcher.wait_until_idle()
+            for watch in [w for w in watches if channel_of(w) == message[1]]:
+                remove_from_watches(watch)
+        elif kind == 'ready':
+            ready += 1
+            if ready == len(shards) and not watches:
+                print("No watches established, exiting...")
+                return
+
+def receive_from_recording():
+    "Queue the events of a recording, adding its watches as they were established"
+    for record in replay:
+        if record[0] == 'watch':
+            add_to_watches(record[1], record[2])
+        else:
+            metrics.received(record[1])
+            events.put(record[1:])
+    print("Replay finished")
 
-        except requests.exceptions.HTTPError as e:
-            r = e.response
-            if r.status_code == 404:
-                print("Recovering from unknown channel")
-                channel = create_channel_and_watches(s)
-                last_id = None
-            else:
-                print("HTTP error {} {}".format(r.status_code, r.reason))
-                break
+interrupted = False
+try:
+    if replay:
+        receive_from_recording()
+    elif shards:
+        receive_from_shards()
+    else:
+        follow_channel(s, channel, last_id, receive, recover_channel)
 
 except KeyboardInterrupt:
     print("Interrupting...")
+    interrupted = True
 
 finally:
-    if state_path != None and last_id != None:
+    dispatcher.stop()
+    pairer.flush()
+    # Activities pass on the events they hold before the state is saved.
+    activity.close()
+    if dispatcher.last_id:
+        last_id = dispatcher.last_id
+    if replay:
+        pass
+    elif shards:
+        shards.stop(interrupted)
+    elif state_path != None and last_id != None:
         print("Saving state for resumption")
-        with open(state_path, 'w') as f:
-            f.write("{} {}\n".format(channel, last_id))
-            for watch,path in watches.items():
-                f.write("{} {}\n".format(watch, requests.utils.quote(path)))
+        checkpointer.close(last_id)
     else:
         print("Deleting channel")
         s.delete(channel)
-        try:
-            os.remove(state_path)
-        except FileNotFoundError:
-            pass
-    activity.close()
+        if checkpointer:
+            checkpointer.discard()
+    if recorder:
+        recorder.close()
@@ -0,0 +1,307 @@
+"""Recover from lost events by comparing directory listings with a snapshot."""
+from activities import BaseActivity, EVENT_NUMBERS, oldest_of
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from threading import Thread, Lock, local
+import bootstrap
+import collections
+import requests
+import time
+
+
+def entry(item):
+    "Return the snapshot entry of a namespace listing item: (isDir, size, mtime)"
+    return (item["fileType"] == "DIR", item.get("size"), item.get("mtime"))
+
+
+class ReconcilingActivity(BaseActivity):
+    """
+    Keep a snapshot of the watched directories (the name, type, size and
+    modification time of each child) and pass events to the wrapped
+    activity.  The snapshot is built from the listings made while
+    establishing watches and kept up to date from the events themselves.
+
+    After event loss, all directories in the snapshot are listed again,
+    concurrently, and the differences are passed on as events: new and
+    rewritten files as onNewFile, missing files as onDeletedFile, and
+    similarly for directories.  Moves that were missed appear as a delete
+    and a create.  Files last seen in an event, whose size and modification
+    time are not known, are reported again as they may have been rewritten.
+    If recursive, new directories are walked in the same way, their
+    contents reported as new, and on_new_directories is called with each
+    level of new directories so they may be watched.  on_deleted_directory
+    is called for each directory that vanished.
+
+    The listing is done in the background.  Events that arrive meanwhile
+    are held, in memory, and passed on after the differences, by the next
+    event or call to flush, which must be called regularly.
+
+    The snapshot costs about 250 bytes per child of every watched
+    directory: some 250MB per million files.
+    """
+
+    # The snapshot is kept up to date from these events.
+    INOTIFY_FLAGS = ['IN_CLOSE_WRITE', 'IN_CREATE', 'IN_DELETE', 'IN_MOVED_FROM', 'IN_MOVED_TO']
+
+    def __init__(self, activity, session_factory, args, recursive=False, workers=16,
+                 on_new_directories=None, on_deleted_directory=None):
+        self.__activity = activity
+        self.__session_factory = session_factory
+        self.__args = args
+        self.__recursive = recursive
+        self.__workers = workers
+        self.__on_new_directories = on_new_directories
+        self.__on_deleted_directory = on_deleted_directory
+        self.__directories = {}
+        self.__lock = Lock()
+        self.__local = local()
+        self.__reconciler = None
+        self.__loss_number = None
+        self.__differences = []
+        self.__deferred = collections.deque()
+
+    def listed(self, path, children):
+        "Replace the snapshot of directory path with these namespace entries"
+        with self.__lock:
+            self.__directories[path] = {item["fileName"]: entry(item) for item in children}
+
+    def populate(self, paths):
+        "List these directories, replacing their snapshots without reporting differences"
+        self.__reconcile(paths, False)
+
+    def onNewFile(self, path):
+        self.__event(self.__newFile, path)
+
+    def onDeletedFile(self, path):
+        self.__event(self.__deletedFile, path)
+
+    def onFileMetadataChanged(self, path):
+        self.__event(self.__activity.onFileMetadataChanged, path)
+
+    def onMovedFile(self, fromPath, toPath):
+        self.__event(self.__movedFile, fromPath, toPath)
+
+    def onNewDirectory(self, path):
+        self.__event(self.__newDirectory, path)
+
+    def onDeletedDirectory(self, path):
+        self.__event(self.__deletedDirectory, path)
+
+    def onDirMetadataChanged(self, path):
+        self.__event(self.__activity.onDirMetadataChanged, path)
+
+    def onMovedDirectory(self, fromPath, toPath):
+        self.__event(self.__movedDirectory, fromPath, toPath)
+
+    def onEventLoss(self):
+        self.__event(self.__lost)
+
+    def flush(self):
+        """
+        Once a reconcile has finished, pass on the differences it found,
+        then the events held meanwhile
+        """
+        if self.__reconciler is None or self.__reconciler.is_alive():
+            return
+        self.__reconciler.join()
+        self.__reconciler = None
+        with EVENT_NUMBERS.handling(self.__loss_number):
+            for (callback, args) in self.__differences:
+                callback(*args)
+        self.__differences = []
+        self.__loss_number = None
+        # A further loss among the held events starts another reconcile.
+        while self.__deferred and self.__reconciler is None:
+            (number, callback, args) = self.__deferred.popleft()
+            with EVENT_NUMBERS.handling(number):
+                callback(*args)
+
+    def oldest_held(self):
+        deferred = self.__deferred[0][0] if self.__deferred else None
+        return oldest_of(self.__loss_number, deferred, self.__activity.oldest_held())
+
+    def close(self):
+        while self.__reconciler is not None:
+            self.__reconciler.join()
+            self.flush()
+        self.__activity.close()
+
+    def __event(self, callback, *args):
+        "Handle a live event, unless a reconcile is running"
+        self.flush()
+        if self.__reconciler is None:
+            callback(*args)
+        else:
+            self.__deferred.append((EVENT_NUMBERS.current(), callback, args))
+
+    def __newFile(self, path):
+        self.__add(path, False)
+        self.__activity.onNewFile(path)
+
+    def __deletedFile(self, path):
+        self.__remove(path)
+        self.__activity.onDeletedFile(path)
+
+    def __movedFile(self, fromPath, toPath):
+        self.__move(fromPath, toPath)
+        self.__activity.onMovedFile(fromPath, toPath)
+
+    def __newDirectory(self, path):
+        self.__add(path, True)
+        self.__activity.onNewDirectory(path)
+
+    def __deletedDirectory(self, path):
+        self.__remove(path)
+        self.__activity.onDeletedDirectory(path)
+
+    def __movedDirectory(self, fromPath, toPath):
+        self.__move(fromPath, toPath)
+        self.__activity.onMovedDirectory(fromPath, toPath)
+
+    def __lost(self):
+        self.__activity.onEventLoss()
+        self.__loss_number = EVENT_NUMBERS.current()
+        self.__reconciler = Thread(target=self.__reconcile_all, name="reconciler", daemon=True)
+        self.__reconciler.start()
+
+    def __reconcile_all(self):
+        with self.__lock:
+            paths = list(self.__directories)
+        print("Reconciling %d directories after event loss" % len(paths))
+        started = time.monotonic()
+        changes = self.__reconcile(paths, True)
+        print("Reconciled %d directories in %.1f seconds, %d changes found"
+              % (len(paths), time.monotonic() - started, changes))
+
+    def __split(self, path):
+        (parent, _, name) = path.rpartition("/")
+        return (parent or "/", name)
+
+    def __add(self, path, isDir):
+        (parent, name) = self.__split(path)
+        with self.__lock:
+            children = self.__directories.get(parent)
+            if children is not None:
+                children[name] = (isDir, None, None)
+            if isDir and self.__recursive:
+                self.__directories.setdefault(path, {})
+
+    def __remove(self, path):
+        (parent, name) = self.__split(path)
+        with self.__lock:
+            children = self.__directories.get(parent)
+            if children is not None:
+                children.pop(name, None)
+            self.__remove_tree(path)
+
+    def __remove_tree(self, path):
+        "Forget the snapshots of path and all directories below it; the caller must hold the lock"
+        prefix = path.rstrip("/") + "/"
+        for directory in [d for d in self.__directories if d == path or d.startswith(prefix)]:
+            del self.__directories[directory]
+
+    def __move(self, fromPath, toPath):
+        (old_parent, old_name) = self.__split(fromPath)
+        (new_parent, new_name) = self.__split(toPath)
+        with self.__lock:
+            children = self.__directories.get(old_parent)
+            moved = children.pop(old_name, None) if children is not None else None
+            children = self.__directories.get(new_parent)
+            if children is not None and moved is not None:
+                children[new_name] = moved
+            self.__remove_tree(toPath)
+            prefix = fromPath.rstrip("/") + "/"
+            for directory in [d for d in self.__directories if d == fromPath or d.startswith(prefix)]:
+                self.__directories[toPath + directory[len(fromPath):]] = self.__directories.pop(directory)
+
+    def __session(self):
+        session = getattr(self.__local, 'session', None)
+        if session is None:
+            session = self.__session_factory(self.__args)
+            session.mount('https://', self.__adapter)
+            session.mount('http://', self.__adapter)
+            self.__local.session = session
+        return session
+
+    def __list(self, path):
+        try:
+            return {item["fileName"]: entry(item)
+                    for item in bootstrap.iter_children(self.__session(), self.__args["endpoint"], path)}
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code == 404:
+                return None
+            print("Failed to list directory %s: %s" % (path, str(e)))
+        except (requests.exceptions.RequestException, ValueError, bootstrap.IncompleteListing) as e:
+            print("Failed to list directory %s: %s" % (path, str(e)))
+        return False
+
+    def __reconcile(self, paths, report):
+        """
+        List paths concurrently, a level at a time, and compare each with
+        its snapshot, returning the number of differences.  Listings that
+        fail leave the snapshot unchanged.
+        """
+        changes = 0
+        self.__adapter = HTTPAdapter(pool_maxsize=self.__workers)
+        self.__local = local()
+        with ThreadPoolExecutor(max_workers=self.__workers, thread_name_prefix="reconcile") as executor:
+            while paths:
+                new_directories = []
+                for path, listed in zip(paths, executor.map(self.__list, paths)):
+                    if listed is False:
+                        continue
+                    if listed is None:
+                        with self.__lock:
+                            self.__remove_tree(path)
+                        continue
+                    with self.__lock:
+                        old = self.__directories.get(path)
+                        self.__directories[path] = listed
+                    if report:
+                        (count, created) = self.__compare(path, old or {}, listed)
+                        changes += count
+                        new_directories += created
+                if new_directories and self.__on_new_directories:
+                    self.__on_new_directories(new_directories)
+                paths = new_directories
+        self.__adapter.close()
+        return changes
+
+    def __compare(self, path, old, listed):
+        "Report the differences in one directory, returning their count and any new directories to walk"
+        prefix = path.rstrip("/") + "/"
+        changes = 0
+        created = []
+        for name, (isDir, size, mtime) in old.items():
+            current = listed.get(name)
+            if current is None or current[0] != isDir:
+                changes += 1
+                if isDir:
+                    with self.__lock:
+                        self.__remove_tree(prefix + name)
+                    if self.__on_deleted_directory:
+                        self.__report(self.__on_deleted_directory, prefix + name)
+                    self.__report(self.__activity.onDeletedDirectory, prefix + name)
+                else:
+                    self.__report(self.__activity.onDeletedFile, prefix + name)
+
+        for name, (isDir, size, mtime) in listed.items():
+            previous = old.get(name)
+            if previous is not None and previous[0] == isDir:
+                if isDir or previous[1:] == (size, mtime):
+                    continue
+                changes += 1
+                self.__report(self.__activity.onNewFile, prefix + name)
+            elif isDir:
+                changes += 1
+                self.__report(self.__activity.onNewDirectory, prefix + name)
+                if self.__recursive:
+                    created.append(prefix + name)
+            else:
+                changes += 1
+                self.__report(self.__activity.onNewFile, prefix + name)
+        return (changes, created)
+
+    def __report(self, callback, *args):
+        "Record a difference, to be passed on by flush"
+        self.__differences.append((callback, args))
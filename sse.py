@@ -0,0 +1,149 @@
+"""Read Server-Sent Events from a dCache channel."""
+import http.client
+import requests
+import urllib3
+import time
+import sys
+import re
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        loads = ujson.loads
+    except ImportError:
+        import json
+        loads = json.loads
+
+# Event types are looked up by their encoded form, so the common ones are
+# neither decoded nor allocated for each message.
+EVENT_TYPES = {name.encode(): sys.intern(name) for name in ['inotify', 'SYSTEM', 'message']}
+
+
+class Message:
+    """One event read from the stream."""
+    __slots__ = ('event', 'id', 'data')
+
+    def __init__(self, event, id, data):
+        self.event = event
+        self.id = id
+        self.data = data
+
+
+# The usual shape of a whole message, which is parsed in one step.
+SIMPLE_MESSAGE = re.compile(rb"(?:event: ?([^\r\n:]*)\n)?(?:id: ?([^\r\n]*)\n)?data: ?([^\r\n]*)\n\n")
+
+
+def parse(chunks, on_retry=None):
+    """
+    Yield the Messages in a stream that arrives as chunks of bytes.  Each
+    chunk is appended to a single buffer, and only complete messages are
+    taken from it.  Messages with the usual shape (optional event and id
+    fields, then one data field) are matched whole; anything else is parsed
+    line by line.  Lines may end in LF or CRLF.
+    The optional on_retry callable is given the reconnection delay, in
+    seconds, whenever the server sets it.
+    """
+    buffer = bytearray()
+    event_type = None
+    event_id = None
+    data = []
+    for chunk in chunks:
+        buffer += chunk
+        # The end of the last complete message, after its blank line.
+        lf = buffer.rfind(b"\n\n")
+        crlf = buffer.rfind(b"\n\r\n")
+        complete = max(lf + 2 if lf >= 0 else 0, crlf + 3 if crlf >= 0 else 0)
+        position = 0
+        while position < complete:
+            if not data and event_type is None:
+                match = SIMPLE_MESSAGE.match(buffer, position)
+                if match:
+                    (event, id, value) = match.groups()
+                    if id is not None:
+                        event_id = id.decode('utf-8', 'replace') if id else None
+                    yield Message(EVENT_TYPES.get(event) or event.decode('utf-8', 'replace') if event else 'message',
+                                  event_id, value.decode('utf-8', 'replace'))
+                    position = match.end()
+                    continue
+
+            end = buffer.find(b"\n", position)
+            if end < 0:
+                break
+            line = bytes(buffer[position:end])
+            position = end + 1
+            if line.endswith(b"\r"):
+                line = line[:-1]
+
+            if not line:
+                if data:
+                    yield Message(event_type or 'message', event_id,
+                                  b"\n".join(data).decode('utf-8', 'replace'))
+                    data = []
+                event_type = None
+                continue
+
+            (field, colon, value) = line.partition(b":")
+            if not field:
+                continue # A comment.
+            if value.startswith(b" "):
+                value = value[1:]
+            if field == b"data":
+                data.append(value)
+            elif field == b"event":
+                event_type = EVENT_TYPES.get(value) or value.decode('utf-8', 'replace')
+            elif field == b"id":
+                event_id = value.decode('utf-8', 'replace') if value else None
+            elif field == b"retry" and value.isdigit() and on_retry:
+                on_retry(int(value) / 1000)
+        del buffer[:position]
+
+
+def chunks(response, size):
+    "Yield bytes from a streamed response as soon as they arrive"
+    # urllib3 2.x provides read1; older versions' underlying http.client response does.
+    read1 = getattr(response.raw, 'read1', None) or response.raw._fp.read1
+    while True:
+        chunk = read1(size)
+        if not chunk:
+            return
+        yield chunk
+
+
+class EventStream:
+    """
+    Iterate over the events of a channel, reconnecting with the ID of the
+    last event received if the connection is lost.  HTTP errors, such as
+    the channel no longer existing, are raised as HTTPError.
+    """
+
+    def __init__(self, session, url, last_id=None, chunk_size=64*1024, retry=3.0):
+        self.__session = session
+        self.__url = url
+        self.__chunk_size = chunk_size
+        self.__retry = retry
+        self.last_id = last_id
+
+    def __iter__(self):
+        while True:
+            headers = {'Accept': 'text/event-stream', 'Cache-Control': 'no-cache'}
+            if self.last_id:
+                headers['Last-Event-ID'] = self.last_id
+            try:
+                with self.__session.get(self.__url, stream=True, headers=headers) as r:
+                    r.raise_for_status()
+                    for msg in parse(chunks(r, self.__chunk_size), self.__set_retry):
+                        if msg.id:
+                            self.last_id = msg.id
+                        yield msg
+            except requests.exceptions.HTTPError:
+                raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                    urllib3.exceptions.HTTPError, http.client.IncompleteRead) as e:
+                print("Lost connection to channel: %s" % e)
+            time.sleep(self.__retry)
+
+    def __set_retry(self, seconds):
+        self.__retry = seconds
@@ -0,0 +1,135 @@
+import glob
+import json
+import os
+import tempfile
+import time
+import unittest
+import activities
+
+SCRIPT = """#!/bin/sh
+out=$(mktemp "%s/run.XXXXXX") || exit 1
+echo "$@" > "$out.args"
+case "$*" in
+BATCH|STREAM) cat > "$out.stdin" ;;
+*slow*) sleep 2 ;;
+esac
+mv "$out.args" "$out.done"
+"""
+
+
+class ExecuteActivityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.command = os.path.join(self.directory.name, "command")
+        with open(self.command, "w") as f:
+            f.write(SCRIPT % self.directory.name)
+        os.chmod(self.command, 0o755)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def runs(self):
+        "Return the arguments and any input of each finished command"
+        runs = []
+        for done in glob.glob(os.path.join(self.directory.name, "run.*.done")):
+            with open(done) as f:
+                argv = f.read().split()
+            stdin = done[:-len(".done")] + ".stdin"
+            records = []
+            if os.path.exists(stdin):
+                with open(stdin) as f:
+                    records = [json.loads(line) for line in f]
+            runs.append((argv, records))
+        return sorted(runs, key=lambda run: (run[0], [r["path"] for r in run[1]]))
+
+    def test_unknown_mode(self):
+        with self.assertRaises(Exception):
+            activities.ExecuteActivity(self.command, mode='sometimes')
+
+    def test_event_mode(self):
+        activity = activities.ExecuteActivity(self.command)
+        activity.onNewFile("/a")
+        activity.onMovedDirectory("/b", "/c")
+        activity.onEvents([activities.Event('DELETED_FILE', "/d")])
+        activity.close()
+        self.assertEqual(self.runs(), [(["DELETED_FILE", "/d"], []),
+                                       (["MOVED_DIR", "/b", "/c"], []),
+                                       (["NEW_FILE", "/a"], [])])
+
+    def test_slow_command_does_not_hold_up_the_others(self):
+        activity = activities.ExecuteActivity(self.command, max_processes=2)
+        started = time.monotonic()
+        activity.onNewFile("/slow")
+        for i in range(4):
+            activity.onNewFile("/f%d" % i)
+        self.assertLess(time.monotonic() - started, 1.5)
+        activity.close()
+        self.assertEqual(len(self.runs()), 5)
+
+    def test_batch_mode(self):
+        activity = activities.ExecuteActivity(self.command, mode='batch', batch_size=3, batch_latency=60)
+        activity.onNewFile("/a")
+        activity.onMovedFile("/b", "/c")
+        activity.onEvents([activities.Event('NEW_DIR', "/d"), activities.Event('DELETED_DIR', "/e")])
+        activity.onDeletedFile("/f")
+        activity.close()
+        self.assertEqual(self.runs(), [
+            (["BATCH"], [{"operation": "NEW_FILE", "path": "/a"},
+                         {"operation": "MOVED_FILE", "path": "/b", "targetPath": "/c"},
+                         {"operation": "NEW_DIR", "path": "/d"}]),
+            (["BATCH"], [{"operation": "DELETED_DIR", "path": "/e"},
+                         {"operation": "DELETED_FILE", "path": "/f"}])])
+
+    def test_batch_is_sent_after_latency(self):
+        activity = activities.ExecuteActivity(self.command, mode='batch', batch_size=100, batch_latency=0.05)
+        activity.onNewFile("/a")
+        deadline = time.monotonic() + 5
+        while not self.runs() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.runs(), [(["BATCH"], [{"operation": "NEW_FILE", "path": "/a"}])])
+        activity.close()
+
+    def test_stream_mode(self):
+        activity = activities.ExecuteActivity(self.command, mode='stream', batch_size=2, batch_latency=0.01)
+        for i in range(5):
+            activity.onNewFile("/f%d" % i)
+        time.sleep(0.05)
+        activity.onDeletedFile("/f0")
+        activity.close()
+        self.assertEqual(self.runs(), [(["STREAM"], [{"operation": "NEW_FILE", "path": "/f%d" % i} for i in range(5)]
+                                        + [{"operation": "DELETED_FILE", "path": "/f0"}])])
+
+    def test_waiting_batch_is_held(self):
+        numbers = activities.EVENT_NUMBERS
+        activity = activities.ExecuteActivity(self.command, mode='batch', batch_size=2, batch_latency=60)
+        first = numbers.next()
+        activity.onNewFile("/a")
+        self.assertEqual(activity.oldest_held(), first)
+        numbers.next()
+        activity.onNewFile("/b")
+        self.assertIsNone(activity.oldest_held())
+        activity.close()
+
+
+class BatchingActivityTest(unittest.TestCase):
+
+    def test_batch_keeps_the_number_of_its_oldest_event(self):
+        numbers = activities.EVENT_NUMBERS
+        batches = []
+        inner = activities.BaseActivity()
+        inner.onEvents = lambda events: batches.append((list(events), numbers.current()))
+        activity = activities.BatchingActivity(inner, max_size=10, max_latency=0)
+        first = numbers.next()
+        activity.onNewFile("/a")
+        numbers.next()
+        activity.onDeletedFile("/b")
+        self.assertEqual(activity.oldest_held(), first)
+        activity.flush_expired()
+        self.assertIsNone(activity.oldest_held())
+        self.assertEqual(batches, [([activities.Event('NEW_FILE', "/a"),
+                                     activities.Event('DELETED_FILE', "/b")], first)])
+
+
+if __name__ == '__main__':
+    unittest.main()
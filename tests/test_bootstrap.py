@@ -0,0 +1,91 @@
+import json
+import unittest
+import bootstrap
+
+
+class Response:
+
+    def __init__(self, chunks, status=200):
+        self.chunks = chunks
+        self.status = status
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        if self.status != 200:
+            raise Exception('HTTP %d' % self.status)
+
+    def iter_content(self, chunk_size):
+        return iter(self.chunks)
+
+
+class Session:
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.urls = []
+
+    def get(self, url, stream=False):
+        self.urls.append(url)
+        return Response(self.chunks)
+
+
+class IterChildrenTest(unittest.TestCase):
+
+    CHILDREN = [{"fileName": "dé", "fileType": "DIR", "size": 512, "mtime": 1},
+                {"fileName": "f", "fileType": "REGULAR", "size": 12345, "mtime": 1.5,
+                 "checksums": [{"type": "ADLER32", "value": "0a0b0c0d"}]},
+                {"fileName": "g", "fileType": "REGULAR", "size": 0, "mtime": -2}]
+
+    LISTING = json.dumps({"fileType": "DIR", "size": 512,
+                          "children": CHILDREN, "mtime": 100}, indent=1).encode('utf-8')
+
+    def children(self, chunks, **kwargs):
+        session = Session(chunks)
+        return list(bootstrap.iter_children(session, "https://example.org/api/v1", "/data", **kwargs))
+
+    def test_whole_listing(self):
+        self.assertEqual(self.children([self.LISTING]), self.CHILDREN)
+
+    def test_every_split(self):
+        for position in range(1, len(self.LISTING)):
+            with self.subTest(position=position):
+                chunks = [self.LISTING[:position], self.LISTING[position:]]
+                self.assertEqual(self.children(chunks), self.CHILDREN)
+
+    def test_one_byte_at_a_time(self):
+        chunks = [self.LISTING[i:i + 1] for i in range(len(self.LISTING))]
+        self.assertEqual(self.children(chunks), self.CHILDREN)
+
+    def test_empty_and_missing_children(self):
+        self.assertEqual(self.children([b'{"fileType": "DIR", "children": []}']), [])
+        self.assertEqual(self.children([b'{"fileType": "DIR"}']), [])
+        self.assertEqual(self.children([b'{}']), [])
+
+    def test_truncated_listing(self):
+        with self.assertRaises((bootstrap.IncompleteListing, ValueError)):
+            self.children([self.LISTING[:-30]])
+
+    def test_checksums_are_requested(self):
+        session = Session([b'{}'])
+        list(bootstrap.iter_children(session, "https://example.org/api/v1", "/data", checksums=True))
+        self.assertEqual(session.urls, ["https://example.org/api/v1/namespace/data?children=true&checksum=true"])
+
+
+class WatchFlagsTest(unittest.TestCase):
+
+    def test_self_flags_are_always_included(self):
+        self.assertEqual(bootstrap.watch_flags(['IN_CLOSE_WRITE'], False),
+                         ['IN_CLOSE_WRITE', 'IN_DELETE_SELF', 'IN_MOVE_SELF'])
+
+    def test_move_halves_are_combined(self):
+        self.assertEqual(bootstrap.watch_flags(['IN_MOVED_FROM'], True),
+                         ['IN_CREATE', 'IN_DELETE', 'IN_DELETE_SELF', 'IN_MOVE_SELF', 'IN_MOVE'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import os
+import shutil
+import tempfile
+import unittest
+import checkpoint
+
+
+class CheckpointerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "state")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def checkpointer(self, **kwargs):
+        return checkpoint.Checkpointer(self.path, **kwargs)
+
+    def restored(self):
+        "Restore from a copy of the saved state, as restoring starts a new generation"
+        copy = os.path.join(self.directory.name, "copy")
+        for suffix in ["", ".log"]:
+            if os.path.exists(self.path + suffix):
+                shutil.copy(self.path + suffix, copy + suffix)
+            elif os.path.exists(copy + suffix):
+                os.remove(copy + suffix)
+        return checkpoint.Checkpointer(copy).restore()
+
+    def test_nothing_saved(self):
+        self.assertIsNone(self.restored())
+
+    def test_close_writes_a_snapshot(self):
+        checkpointer = self.checkpointer()
+        checkpointer.start("https://example.org/channels/1", "4", [("w1", "/a")])
+        checkpointer.watch_added("w2", "/a/b c")
+        checkpointer.processed("5")
+        checkpointer.close()
+        self.assertEqual(self.restored(), ("https://example.org/channels/1", "5",
+                                           {"w1": "/a", "w2": "/a/b c"}))
+        with open(self.path + ".log") as f:
+            self.assertEqual(f.read().splitlines(), ["G 2"])
+
+    def test_changes_are_replayed_from_the_log(self):
+        checkpointer = self.checkpointer(sync_events=1)
+        checkpointer.start("https://example.org/channels/1", None,
+                           [("w1", "/a"), ("w2", "/a/b"), ("w3", "/a/b/c")])
+        checkpointer.watch_added("w4", "/d")
+        checkpointer.watch_removed("w1")
+        checkpointer.watches_renamed("/a/b", "/e")
+        checkpointer.processed("7")
+        # Not closed, as after a crash.
+        self.assertEqual(self.restored(), ("https://example.org/channels/1", "7",
+                                           {"w2": "/e", "w3": "/e/c", "w4": "/d"}))
+
+    def test_unsynced_event_ids_are_not_replayed(self):
+        checkpointer = self.checkpointer(sync_events=10, sync_interval=60)
+        checkpointer.start("https://example.org/channels/1", "1")
+        checkpointer.processed("2")
+        checkpointer.processed("3")
+        self.assertEqual(self.restored()[1], "1")
+        checkpointer.processed(None)
+        for i in range(7):
+            checkpointer.processed("3")
+        self.assertEqual(self.restored()[1], "3")
+
+    def test_tick_syncs_after_interval(self):
+        checkpointer = self.checkpointer(sync_events=1000, sync_interval=0)
+        checkpointer.start("https://example.org/channels/1", "1")
+        checkpointer.processed("2")
+        checkpointer.tick()
+        self.assertEqual(self.restored()[1], "2")
+
+    def test_events_still_held_are_not_saved(self):
+        held = [None]
+        checkpointer = self.checkpointer(sync_events=1000, sync_interval=0, held=lambda: held[0])
+        checkpointer.start("https://example.org/channels/1", "1")
+        checkpointer.processed("2", 2)
+        held[0] = 3
+        checkpointer.processed("3", 3)
+        checkpointer.processed("4", 4)
+        checkpointer.tick()
+        self.assertEqual(self.restored()[1], "2")
+        held[0] = 4
+        checkpointer.tick()
+        self.assertEqual(self.restored()[1], "3")
+        held[0] = None
+        checkpointer.close("4")
+        self.assertEqual(self.restored()[1], "4")
+
+    def test_close_saves_only_what_is_no_longer_held(self):
+        checkpointer = self.checkpointer(held=lambda: 3)
+        checkpointer.start("https://example.org/channels/1", "1")
+        checkpointer.processed("2", 2)
+        checkpointer.processed("3", 3)
+        checkpointer.close("3")
+        self.assertEqual(self.restored()[1], "2")
+
+    def test_truncated_record_is_ignored(self):
+        checkpointer = self.checkpointer(sync_events=1)
+        checkpointer.start("https://example.org/channels/1", "1", [("w1", "/a")])
+        checkpointer.processed("2")
+        with open(self.path + ".log", "a") as f:
+            f.write("+ w2 /b")
+        self.assertEqual(self.restored(), ("https://example.org/channels/1", "2", {"w1": "/a"}))
+
+    def test_log_of_another_generation_is_ignored(self):
+        checkpointer = self.checkpointer(sync_events=1)
+        checkpointer.start("https://example.org/channels/1", "1", [("w1", "/a")])
+        with open(self.path + ".log", "w") as f:
+            f.write("G 0\nI 9\n+ w2 /b\n")
+        self.assertEqual(self.restored(), ("https://example.org/channels/1", "1", {"w1": "/a"}))
+
+    def test_compaction_starts_a_new_generation(self):
+        checkpointer = self.checkpointer(sync_events=1, compact_records=3)
+        checkpointer.start("https://example.org/channels/1", None)
+        for i in range(3):
+            checkpointer.watch_added("w%d" % i, "/d%d" % i)
+        checkpointer.processed("5")
+        with open(self.path) as f:
+            self.assertEqual(f.readline().split()[1:], ["5", "2"])
+        with open(self.path + ".log") as f:
+            self.assertEqual(f.read(), "G 2\n")
+        self.assertEqual(self.restored(), ("https://example.org/channels/1", "5",
+                                           {"w0": "/d0", "w1": "/d1", "w2": "/d2"}))
+
+    def test_restored_state_continues_in_the_same_files(self):
+        checkpointer = self.checkpointer(sync_events=1)
+        checkpointer.start("https://example.org/channels/1", "1", [("w1", "/a")])
+        checkpointer = self.checkpointer(sync_events=1)
+        self.assertEqual(checkpointer.restore(), ("https://example.org/channels/1", "1", {"w1": "/a"}))
+        checkpointer.watch_added("w2", "/b")
+        checkpointer.processed("2")
+        self.assertEqual(self.restored(), ("https://example.org/channels/1", "2",
+                                           {"w1": "/a", "w2": "/b"}))
+
+    def test_discard(self):
+        checkpointer = self.checkpointer()
+        checkpointer.start("https://example.org/channels/1")
+        checkpointer.discard()
+        self.assertIsNone(self.restored())
+        self.assertFalse(os.path.exists(self.path + ".log"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import unittest
+import activities
+import coalesce
+
+
+class Recorder(activities.BaseActivity):
+
+    def __init__(self):
+        self.events = []
+
+    def onNewFile(self, path):
+        self.events.append(('NEW_FILE', path))
+
+    def onDeletedFile(self, path):
+        self.events.append(('DELETED_FILE', path))
+
+    def onFileMetadataChanged(self, path):
+        self.events.append(('FILE_METADATA_CHANGED', path))
+
+    def onMovedFile(self, fromPath, toPath):
+        self.events.append(('MOVED_FILE', fromPath, toPath))
+
+    def onNewDirectory(self, path):
+        self.events.append(('NEW_DIR', path))
+
+    def onDeletedDirectory(self, path):
+        self.events.append(('DELETED_DIR', path))
+
+    def onMovedDirectory(self, fromPath, toPath):
+        self.events.append(('MOVED_DIR', fromPath, toPath))
+
+    def onEventLoss(self):
+        self.events.append(('EVENT_LOSS',))
+
+
+class CoalescingActivityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.recorder = Recorder()
+        self.activity = coalesce.CoalescingActivity(self.recorder, window=60)
+
+    def released(self):
+        self.activity.close()
+        return self.recorder.events
+
+    def test_nothing_is_released_within_the_window(self):
+        self.activity.onNewFile("/a")
+        self.activity.flush_expired()
+        self.assertEqual(self.recorder.events, [])
+
+    def test_expired_events_are_released(self):
+        activity = coalesce.CoalescingActivity(self.recorder, window=0)
+        activity.onNewFile("/a")
+        activity.flush_expired()
+        self.assertEqual(self.recorder.events, [('NEW_FILE', "/a")])
+
+    def test_rewrites_and_metadata_merge_into_new(self):
+        self.activity.onNewFile("/a")
+        self.activity.onFileMetadataChanged("/a")
+        self.activity.onNewFile("/a")
+        self.assertEqual(self.released(), [('NEW_FILE', "/a")])
+
+    def test_created_then_deleted_vanishes(self):
+        self.activity.onNewFile("/a")
+        self.activity.onDeletedFile("/a")
+        self.assertEqual(self.released(), [])
+
+    def test_chain_of_renames(self):
+        self.activity.onMovedFile("/a", "/b")
+        self.activity.onMovedFile("/b", "/c")
+        self.assertEqual(self.released(), [('MOVED_FILE', "/a", "/c")])
+
+    def test_renaming_something_new(self):
+        self.activity.onNewFile("/a")
+        self.activity.onMovedFile("/a", "/b")
+        self.assertEqual(self.released(), [('NEW_FILE', "/b")])
+
+    def test_directory_is_reported_before_its_contents_when_moved(self):
+        self.activity.onNewDirectory("/e")
+        self.activity.onNewFile("/e/f")
+        self.activity.onMovedDirectory("/e", "/g")
+        self.assertEqual(self.released(), [('NEW_DIR', "/e"), ('NEW_FILE', "/e/f"),
+                                           ('MOVED_DIR', "/e", "/g")])
+
+    def test_directory_is_reported_before_its_contents_when_deleted(self):
+        self.activity.onNewDirectory("/e")
+        self.activity.onNewDirectory("/e/d")
+        self.activity.onNewFile("/e/d/f")
+        self.activity.onDeletedDirectory("/e/d")
+        self.assertEqual(self.released(), [('NEW_DIR', "/e"), ('NEW_DIR', "/e/d"),
+                                           ('NEW_FILE', "/e/d/f"), ('DELETED_DIR', "/e/d")])
+
+    def test_new_empty_directory_moved_becomes_new(self):
+        self.activity.onNewDirectory("/e")
+        self.activity.onMovedDirectory("/e", "/g")
+        self.assertEqual(self.released(), [('NEW_DIR', "/g")])
+
+    def test_event_loss_releases_held_events_first(self):
+        self.activity.onNewFile("/a")
+        self.activity.onEventLoss()
+        self.assertEqual(self.recorder.events, [('NEW_FILE', "/a"), ('EVENT_LOSS',)])
+
+    def test_oldest_held(self):
+        numbers = activities.EVENT_NUMBERS
+        first = numbers.next()
+        self.activity.onNewFile("/a")
+        second = numbers.next()
+        self.activity.onMovedFile("/b", "/c")
+        numbers.next()
+        self.activity.onFileMetadataChanged("/a")
+        self.assertEqual(self.activity.oldest_held(), first)
+        numbers.next()
+        self.activity.onDeletedFile("/a")
+        self.assertEqual(self.activity.oldest_held(), second)
+        numbers.next()
+        self.activity.onMovedFile("/c", "/d")
+        self.assertEqual(self.activity.oldest_held(), second)
+        self.activity.close()
+        self.assertIsNone(self.activity.oldest_held())
+
+    def test_released_events_keep_their_number(self):
+        numbers = activities.EVENT_NUMBERS
+        released = []
+        recorder = Recorder()
+        recorder.onNewFile = lambda path: released.append((path, numbers.current()))
+        activity = coalesce.CoalescingActivity(recorder, window=0)
+        first = numbers.next()
+        activity.onNewFile("/a")
+        numbers.next()
+        activity.flush_expired()
+        self.assertEqual(released, [("/a", first)])
+
+
+if __name__ == '__main__':
+    unittest.main()
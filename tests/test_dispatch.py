@@ -0,0 +1,225 @@
+import threading
+import time
+import unittest
+import activities
+import dispatch
+
+
+class EventQueueTest(unittest.TestCase):
+
+    def test_fifo(self):
+        queue = dispatch.EventQueue(depth=3)
+        for item in "abc":
+            self.assertTrue(queue.put(item))
+        self.assertEqual([queue.get(0) for i in range(3)], list("abc"))
+        self.assertIsNone(queue.get(0))
+        self.assertEqual(queue.high_water, 3)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(Exception):
+            dispatch.EventQueue(policy='drop-everything')
+
+    def test_drop_newest(self):
+        queue = dispatch.EventQueue(depth=2, policy='drop-newest')
+        results = [queue.put(item) for item in "abcd"]
+        self.assertEqual(results, [True, True, False, False])
+        self.assertEqual([queue.get(0), queue.get(0)], ["a", "b"])
+        self.assertEqual(queue.dropped, 2)
+        self.assertEqual(queue.take_drops(), 2)
+        self.assertEqual(queue.take_drops(), 0)
+
+    def test_drop_oldest(self):
+        queue = dispatch.EventQueue(depth=2, policy='drop-oldest')
+        results = [queue.put(item) for item in "abcd"]
+        self.assertEqual(results, [True, True, False, False])
+        self.assertEqual([queue.get(0), queue.get(0)], ["c", "d"])
+        self.assertEqual(queue.take_drops(), 2)
+
+    def test_block_waits_for_space(self):
+        queue = dispatch.EventQueue(depth=1)
+        queue.put("a")
+        putter = threading.Thread(target=queue.put, args=("b",))
+        putter.start()
+        putter.join(0.1)
+        self.assertTrue(putter.is_alive())
+        self.assertEqual(queue.get(0), "a")
+        putter.join(5)
+        self.assertFalse(putter.is_alive())
+        self.assertEqual(queue.get(0), "b")
+        self.assertEqual(queue.dropped, 0)
+
+    def test_close_releases_blocked_put_and_get(self):
+        queue = dispatch.EventQueue(depth=1)
+        queue.put("a")
+        putter = threading.Thread(target=queue.put, args=("b",))
+        putter.start()
+        queue.close()
+        putter.join(5)
+        self.assertFalse(putter.is_alive())
+        self.assertEqual([queue.get(), queue.get(), queue.get()], ["a", "b", None])
+        self.assertTrue(queue.is_closed())
+
+    def test_oldest_includes_the_item_being_processed(self):
+        queue = dispatch.EventQueue()
+        self.assertIsNone(queue.oldest())
+        queue.put(1)
+        queue.put(2)
+        self.assertEqual(queue.oldest(), 1)
+        queue.get()
+        self.assertEqual(queue.oldest(), 1)
+        queue.task_done()
+        self.assertEqual(queue.oldest(), 2)
+
+    def test_join_waits_for_task_done(self):
+        queue = dispatch.EventQueue()
+        queue.put("a")
+        joiner = threading.Thread(target=queue.join)
+        joiner.start()
+        queue.get(0)
+        joiner.join(0.1)
+        self.assertTrue(joiner.is_alive())
+        queue.task_done()
+        joiner.join(5)
+        self.assertFalse(joiner.is_alive())
+
+
+class DispatcherTest(unittest.TestCase):
+
+    def test_events_are_handled_in_order(self):
+        queue = dispatch.EventQueue()
+        handled = []
+        dispatcher = dispatch.Dispatcher(queue, lambda *event: handled.append(event), lambda: handled.append('loss'))
+        dispatcher.start()
+        for i in range(100):
+            queue.put(('inotify', str(i), 'data'))
+        queue.put(('SYSTEM', None, 'data'))
+        dispatcher.wait_until_idle()
+        dispatcher.stop()
+        self.assertEqual(handled, [('inotify', str(i), 'data') for i in range(100)] + [('SYSTEM', None, 'data')])
+        self.assertEqual(dispatcher.last_id, '99')
+
+    def test_loss_is_reported_before_the_next_event(self):
+        queue = dispatch.EventQueue(depth=1, policy='drop-newest')
+        handled = []
+        queue.put(('inotify', '1', 'a'))
+        queue.put(('inotify', '2', 'b'))
+        dispatcher = dispatch.Dispatcher(queue, lambda *event: handled.append(event[1]), lambda: handled.append('loss'))
+        dispatcher.start()
+        dispatcher.stop()
+        self.assertEqual(handled, ['loss', '1'])
+
+    def test_failing_handler_does_not_stop_dispatching(self):
+        queue = dispatch.EventQueue()
+        handled = []
+
+        def handler(event_type, event_id, data):
+            if event_id == '1':
+                raise Exception('failed')
+            handled.append(event_id)
+
+        dispatcher = dispatch.Dispatcher(queue, handler, lambda: None)
+        dispatcher.start()
+        for i in range(3):
+            queue.put(('inotify', str(i), 'data'))
+        dispatcher.stop()
+        self.assertEqual(handled, ['0', '2'])
+
+    def test_tick_without_events(self):
+        queue = dispatch.EventQueue()
+        ticks = []
+        dispatcher = dispatch.Dispatcher(queue, lambda *event: None, lambda: None,
+                                         tick=lambda: ticks.append(1), tick_interval=0.01)
+        dispatcher.start()
+        time.sleep(0.1)
+        dispatcher.stop()
+        self.assertGreater(len(ticks), 1)
+
+
+class Recorder(activities.BaseActivity):
+
+    def __init__(self, delay=0):
+        self.events = []
+        self.closed = False
+        self.delay = delay
+
+    def onNewFile(self, path):
+        time.sleep(self.delay)
+        self.events.append(('NEW_FILE', path))
+
+    def onMovedFile(self, fromPath, toPath):
+        self.events.append(('MOVED_FILE', fromPath, toPath))
+
+    def onEventLoss(self):
+        self.events.append(('EVENT_LOSS',))
+
+    def close(self):
+        self.closed = True
+
+
+class FanOutActivityTest(unittest.TestCase):
+
+    def test_every_activity_sees_every_event(self):
+        recorders = [Recorder(), Recorder()]
+        fan_out = dispatch.FanOutActivity(recorders, ['one', 'two'])
+        for i in range(50):
+            fan_out.onNewFile('/f%d' % i)
+        fan_out.onMovedFile('/a', '/b')
+        fan_out.onEvents([activities.Event('NEW_FILE', '/g')])
+        fan_out.close()
+        expected = [('NEW_FILE', '/f%d' % i) for i in range(50)] + [('MOVED_FILE', '/a', '/b'), ('NEW_FILE', '/g')]
+        for recorder in recorders:
+            self.assertEqual(recorder.events, expected)
+            self.assertTrue(recorder.closed)
+
+    def test_slow_activity_with_dropping_queue_loses_events_alone(self):
+        (slow, fast) = (Recorder(delay=0.05), Recorder())
+        fan_out = dispatch.FanOutActivity([slow, fast], ['slow', 'fast'], depth=2, policy='drop-newest')
+        for i in range(10):
+            fan_out.onNewFile('/f%d' % i)
+            while fan_out.depths()[1] > 0:
+                time.sleep(0.001)
+        self.assertLessEqual(fan_out.depths()[0], 2)
+        fan_out.close()
+        self.assertEqual(fast.events, [('NEW_FILE', '/f%d' % i) for i in range(10)])
+        self.assertIn(('EVENT_LOSS',), slow.events)
+        self.assertLess(len(slow.events), 11)
+
+    def test_stalled_activity_does_not_block_others_by_default(self):
+        gate = threading.Event()
+        (stalled, other) = (Recorder(), Recorder())
+        stalled.onNewFile = lambda path: gate.wait()
+        fan_out = dispatch.FanOutActivity([stalled, other], ['stalled', 'other'], depth=1)
+        for i in range(10):
+            fan_out.onNewFile('/f%d' % i)
+            while fan_out.depths()[1] > 0:
+                time.sleep(0.001)
+        gate.set()
+        fan_out.close()
+        self.assertEqual(other.events, [('NEW_FILE', '/f%d' % i) for i in range(10)])
+        self.assertEqual(stalled.events, [('EVENT_LOSS',)])
+
+    def test_events_are_held_until_handled(self):
+        numbers = activities.EVENT_NUMBERS
+        gate = threading.Event()
+        (blocked, idle) = (Recorder(), Recorder())
+        handled = []
+        def onNewFile(path):
+            handled.append(numbers.current())
+            gate.wait()
+        blocked.onNewFile = onNewFile
+        fan_out = dispatch.FanOutActivity([blocked, idle], ['blocked', 'idle'])
+        first = numbers.next()
+        fan_out.onNewFile('/a')
+        numbers.next()
+        fan_out.onNewFile('/b')
+        while fan_out.depths()[1] > 0 or not handled:
+            time.sleep(0.001)
+        self.assertEqual(handled, [first])
+        self.assertEqual(fan_out.oldest_held(), first)
+        gate.set()
+        fan_out.close()
+        self.assertIsNone(fan_out.oldest_held())
+
+
+if __name__ == '__main__':
+    unittest.main()
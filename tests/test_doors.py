@@ -0,0 +1,136 @@
+import collections
+import random
+import threading
+import time
+import unittest
+import requests
+import activities
+import doors
+
+
+def door(protocol, port, tags=(), load=0, addresses=("10.0.0.1",)):
+    return {"protocol": protocol, "port": port, "tags": list(tags), "load": load, "addresses": list(addresses)}
+
+
+class DoorTest(unittest.TestCase):
+
+    def test_addresses_are_used_in_turn(self):
+        d = doors.Door(door("https", 443, addresses=["10.0.0.2", "10.0.0.1"]))
+        self.assertEqual([d.url() for i in range(3)],
+                         ["https://10.0.0.1:443/", "https://10.0.0.2:443/", "https://10.0.0.1:443/"])
+
+    def test_weight(self):
+        self.assertEqual(doors.Door(door("https", 443, load=0.25)).weight, 0.75)
+        self.assertEqual(doors.Door(door("https", 443, load=2)).weight, 0.05)
+
+
+class DoorRegistryTest(unittest.TestCase):
+
+    DOORS = [door("https", 443, ["dcache-view"]),
+             door("https", 8443),
+             door("http", 80, ["dcache-view"])]
+
+    def setUp(self):
+        self.discovered = 0
+        random.seed(1)
+
+    def discover(self):
+        self.discovered += 1
+        return self.DOORS
+
+    def test_doors_are_discovered_once_when_first_needed(self):
+        registry = doors.DoorRegistry(self.discover, ttl=0)
+        self.assertEqual(self.discovered, 0)
+        for i in range(10):
+            registry.select("https", ["dcache-view"])
+        self.assertEqual(self.discovered, 1)
+
+    def test_selection_by_protocol_and_tags(self):
+        registry = doors.DoorRegistry(self.discover, ttl=0)
+        self.assertEqual(registry.select("https", ["dcache-view"]), "https://10.0.0.1:443/")
+        self.assertEqual(registry.select("http", ["dcache-view"]), "http://10.0.0.1:80/")
+        self.assertEqual({registry.select("https", []) for i in range(100)},
+                         {"https://10.0.0.1:443/", "https://10.0.0.1:8443/"})
+
+    def test_no_matching_door(self):
+        registry = doors.DoorRegistry(self.discover, ttl=0)
+        with self.assertRaises(Exception):
+            registry.select("https", ["dcache-view", "other"])
+        with self.assertRaises(Exception):
+            registry.select("ftp", [])
+
+    def test_lightly_loaded_doors_are_preferred(self):
+        registry = doors.DoorRegistry(lambda: [door("https", 1, load=0), door("https", 2, load=0.9)], ttl=0)
+        counts = collections.Counter(registry.select("https", []) for i in range(1000))
+        self.assertGreater(counts["https://10.0.0.1:1/"], 5 * counts["https://10.0.0.1:2/"])
+        self.assertGreater(counts["https://10.0.0.1:2/"], 0)
+
+    def test_doors_are_refreshed(self):
+        refreshed = threading.Event()
+
+        def discover():
+            self.discovered += 1
+            if self.discovered > 1:
+                refreshed.set()
+                return [door("https", 2443)]
+            return [door("https", 443)]
+
+        registry = doors.DoorRegistry(discover, ttl=0.01)
+        self.assertEqual(registry.select("https", []), "https://10.0.0.1:443/")
+        self.assertTrue(refreshed.wait(5))
+        registry.close()
+        for i in range(100):
+            if registry.select("https", []) == "https://10.0.0.1:2443/":
+                break
+        self.assertEqual(registry.select("https", []), "https://10.0.0.1:2443/")
+
+    def test_urls_and_generation(self):
+        registry = doors.DoorRegistry(self.discover, ttl=0)
+        self.assertEqual((registry.urls(), registry.generation), (set(), 0))
+        registry.select("https", [])
+        self.assertEqual(registry.urls(), {"https://10.0.0.1:443/", "https://10.0.0.1:8443/",
+                                           "http://10.0.0.1:80/"})
+        self.assertEqual(registry.generation, 1)
+
+
+class DoorSession(requests.Session):
+    "A session that discovers whatever doors the test currently lists"
+
+    def __init__(self, listed):
+        super(DoorSession, self).__init__()
+        self.listed = listed
+
+    def get(self, url, **kwargs):
+        test = self
+        class Response:
+            def raise_for_status(self):
+                pass
+            def json(self):
+                return test.listed[0]
+        return Response()
+
+
+class TransferringActivityTest(unittest.TestCase):
+
+    def test_adapters_of_doors_that_have_gone_are_removed(self):
+        listed = [[door("https", 443)]]
+        sessions = []
+        def session_factory(args):
+            sessions.append(DoorSession(listed))
+            return sessions[-1]
+        activity = activities.TransferringActivity(session_factory=session_factory, args={},
+                                                   api_url="https://frontend/api/v1", door_ttl=0.01)
+        self.assertEqual(activity.doors("https", []), "https://10.0.0.1:443/")
+        self.assertIn("https://10.0.0.1:443/", sessions[0].adapters)
+        listed[0] = [door("https", 2443)]
+        for i in range(500):
+            if activity.doors("https", []) == "https://10.0.0.1:2443/":
+                break
+            time.sleep(0.01)
+        self.assertIn("https://10.0.0.1:2443/", sessions[0].adapters)
+        self.assertNotIn("https://10.0.0.1:443/", sessions[0].adapters)
+        activity.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import moves
+
+
+class MovePairerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.expired = []
+        self.pairer = moves.MovePairer(lambda *half: self.expired.append(half), max_events=2, max_age=60)
+
+    def test_halves_are_paired(self):
+        self.assertIsNone(self.pairer.pair(7, "/a", 'IN_MOVED_FROM', False, 1))
+        self.assertEqual(self.pairer.pair(7, "/b", 'IN_MOVED_TO', False, 2), ("/a", 1))
+        self.assertEqual(len(self.pairer), 0)
+        self.pairer.expire(10)
+        self.assertEqual(self.expired, [])
+
+    def test_unpaired_half_expires_after_max_events(self):
+        self.pairer.pair(7, "/a", 'IN_MOVED_FROM', True, 1)
+        self.pairer.expire(2)
+        self.assertEqual(self.expired, [])
+        self.pairer.expire(3)
+        self.assertEqual(self.expired, [("/a", 'IN_MOVED_FROM', True, 1)])
+        self.assertEqual(len(self.pairer), 0)
+
+    def test_unpaired_half_expires_after_max_age(self):
+        pairer = moves.MovePairer(lambda *half: self.expired.append(half), max_events=1000, max_age=0)
+        pairer.pair(7, "/b", 'IN_MOVED_TO', False, 1)
+        pairer.expire(1)
+        self.assertEqual(self.expired, [("/b", 'IN_MOVED_TO', False, 1)])
+
+    def test_reused_cookie_does_not_expire_early(self):
+        self.pairer.pair(7, "/a", 'IN_MOVED_FROM', False, 1)
+        self.pairer.pair(7, "/b", 'IN_MOVED_TO', False, 2)
+        self.pairer.pair(7, "/c", 'IN_MOVED_FROM', False, 3)
+        self.pairer.expire(4)
+        self.assertEqual(self.expired, [])
+        self.pairer.expire(5)
+        self.assertEqual(self.expired, [("/c", 'IN_MOVED_FROM', False, 3)])
+
+    def test_oldest(self):
+        self.assertIsNone(self.pairer.oldest())
+        self.pairer.pair(1, "/a", 'IN_MOVED_FROM', False, 4)
+        self.pairer.pair(2, "/b", 'IN_MOVED_FROM', False, 5)
+        self.assertEqual(self.pairer.oldest(), 4)
+        self.pairer.pair(1, "/c", 'IN_MOVED_TO', False, 6)
+        self.assertEqual(self.pairer.oldest(), 5)
+
+    def test_flush(self):
+        self.pairer.pair(1, "/a", 'IN_MOVED_FROM', False, 1)
+        self.pairer.pair(2, "/b", 'IN_MOVED_TO', True, 1)
+        self.pairer.flush()
+        self.assertEqual(self.expired, [("/a", 'IN_MOVED_FROM', False, 1), ("/b", 'IN_MOVED_TO', True, 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import tempfile
+import time
+import unittest
+import recording
+
+
+class RecordingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "recording")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def record(self, roots=["/data/a b"], recursive=True):
+        recorder = recording.Recorder(self.path)
+        recorder.roots(roots, recursive)
+        recorder.watch("https://example.org/w1", "/data/a b")
+        recorder.event("inotify", "1", '{"event": {"name": "x"}}')
+        recorder.event("SYSTEM", None, '{"type":\n"EVENT_LOSS"}')
+        recorder.close()
+
+    def test_replay(self):
+        self.record()
+        replay = recording.Replay(self.path, speed=0)
+        self.assertEqual(replay.roots, ["/data/a b"])
+        self.assertTrue(replay.recursive)
+        self.assertEqual(list(replay), [('watch', "https://example.org/w1", "/data/a b"),
+                                        ('event', "inotify", "1", '{"event": {"name": "x"}}'),
+                                        ('event', "SYSTEM", None, '{"type": "EVENT_LOSS"}')])
+
+    def test_recording_replaces_an_earlier_one(self):
+        self.record(roots=["/old"])
+        self.record(roots=["/new"], recursive=False)
+        replay = recording.Replay(self.path, speed=0)
+        self.assertEqual(replay.roots, ["/new"])
+        self.assertFalse(replay.recursive)
+        self.assertEqual(len(list(replay)), 3)
+
+    def test_truncated_record_is_ignored(self):
+        self.record()
+        with open(self.path, "a") as f:
+            f.write("E 1.0 inotify 2 {")
+        self.assertEqual(len(list(recording.Replay(self.path, speed=0))), 3)
+
+    def test_events_are_spaced_out_as_recorded(self):
+        with open(self.path, "w") as f:
+            f.write("P 0 /data\nE 100.0 inotify 1 a\nE 100.2 inotify 2 b\n")
+        started = time.monotonic()
+        self.assertEqual(len(list(recording.Replay(self.path, speed=2))), 2)
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+
+
+if __name__ == '__main__':
+    unittest.main()
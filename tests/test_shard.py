@@ -0,0 +1,97 @@
+import os
+import signal
+import sys
+import tempfile
+import time
+import unittest
+import requests
+import shard
+
+
+class PartitionTest(unittest.TestCase):
+
+    TREE = {"/a": ["b", "c"], "/a/b": ["d"], "/a/c": [], "/a/b/d": [], "/e": []}
+
+    def list_subdirectories(self, path):
+        self.listed.append(path)
+        return self.TREE[path]
+
+    def setUp(self):
+        self.listed = []
+
+    def units(self, assignments):
+        return sorted(unit for units in assignments for unit in units)
+
+    def test_non_recursive_paths_are_spread(self):
+        assignments = shard.partition(["/a", "/e", "/a/b"], False, 2, self.list_subdirectories)
+        self.assertEqual(assignments, [[("/a", False), ("/a/b", False)], [("/e", False)]])
+        self.assertEqual(self.listed, [])
+
+    def test_recursive_trees_are_split(self):
+        assignments = shard.partition(["/a", "/e"], True, 2, self.list_subdirectories)
+        self.assertEqual(self.units(assignments),
+                         [("/a", False), ("/a/b", False), ("/a/b/d", False), ("/a/c", False), ("/e", False)])
+        self.assertEqual([len(units) for units in assignments], [3, 2])
+
+    def test_splitting_stops_at_enough_units(self):
+        assignments = shard.partition(["/a"], True, 1, self.list_subdirectories)
+        self.assertEqual(self.units(assignments), [("/a", False), ("/a/b", False), ("/a/b/d", True), ("/a/c", True)])
+        self.assertEqual(self.listed, ["/a", "/a/b"])
+
+    def test_directory_that_cannot_be_listed_stays_whole(self):
+        def list_subdirectories(path):
+            raise requests.exceptions.ConnectionError("refused")
+        assignments = shard.partition(["/a"], True, 2, list_subdirectories)
+        self.assertEqual(assignments, [[("/a", True)], []])
+
+
+class ShardsTest(unittest.TestCase):
+
+    def test_messages_until_all_exit(self):
+        def worker(index, units, send):
+            for unit in units:
+                send(('unit', index, unit))
+            send(('exit', index))
+        shards = shard.Shards(worker, [["/a", "/b"], ["/c"]])
+        shards.start()
+        messages = list(shards.messages())
+        shards.stop()
+        self.assertEqual([m for m in messages if m[1] == 0], [('unit', 0, "/a"), ('unit', 0, "/b"), ('exit', 0)])
+        self.assertEqual([m for m in messages if m[1] == 1], [('unit', 1, "/c"), ('exit', 1)])
+
+    def test_worker_dying_without_exit_message(self):
+        def worker(index, units, send):
+            send(('unit', index, units[0]))
+            if index == 1:
+                time.sleep(0.2) # Let the message be sent.
+                os._exit(3)
+            send(('exit', index))
+        shards = shard.Shards(worker, [["/a"], ["/b"]])
+        shards.start()
+        messages = list(shards.messages(poll=0.05))
+        shards.stop()
+        self.assertIn(('unit', 1, "/b"), messages)
+        self.assertEqual(messages[-1], ('exit', 1))
+
+    def test_stop_lets_workers_blocked_on_a_full_queue_clean_up(self):
+        with tempfile.TemporaryDirectory() as directory:
+            def worker(index, units, send):
+                signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+                try:
+                    send(('ready', index))
+                    while True:
+                        send(('unit', index, "/a"))
+                finally:
+                    send(('exit', index))
+                    open(os.path.join(directory, str(index)), 'w').close()
+            shards = shard.Shards(worker, [[], []], queue_depth=10)
+            shards.start()
+            time.sleep(0.2)
+            started = time.monotonic()
+            shards.stop(timeout=5)
+            self.assertLess(time.monotonic() - started, 5)
+            self.assertEqual(sorted(os.listdir(directory)), ["0", "1"])
+
+
+if __name__ == '__main__':
+    unittest.main()
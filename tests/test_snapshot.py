@@ -0,0 +1,211 @@
+import json
+import threading
+import time
+import unittest
+import requests
+import activities
+import snapshot
+
+ENDPOINT = "https://example.org/api/v1"
+
+
+class Response:
+
+    def __init__(self, status, body):
+        self.status_code = status
+        self.body = body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        if self.status_code != 200:
+            raise requests.exceptions.HTTPError('HTTP %d' % self.status_code, response=self)
+
+    def iter_content(self, chunk_size):
+        return iter([self.body])
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class Session:
+    """
+    Serves the listings of a namespace, given as {path: {name: (fileType,
+    size, mtime)}}; listing a path mapped to None fails.  If given, each
+    listing waits for gate to be set.
+    """
+
+    def __init__(self, namespace, gate=None):
+        self.namespace = namespace
+        self.gate = gate
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def get(self, url, stream=False):
+        if self.gate is not None:
+            self.gate.wait()
+        path = url[len(ENDPOINT + "/namespace"):].partition("?")[0]
+        if path not in self.namespace:
+            return Response(404, b"")
+        children = self.namespace[path]
+        if children is None:
+            return Response(500, b"")
+        return Response(200, json.dumps({"fileType": "DIR", "children": listing(children)}).encode())
+
+
+def listing(children):
+    return [{"fileName": name, "fileType": fileType, "size": size, "mtime": mtime}
+            for name, (fileType, size, mtime) in children.items()]
+
+
+class Recorder(activities.BaseActivity):
+
+    def __init__(self):
+        self.events = []
+
+    def onNewFile(self, path):
+        self.events.append(('NEW_FILE', path))
+
+    def onDeletedFile(self, path):
+        self.events.append(('DELETED_FILE', path))
+
+    def onNewDirectory(self, path):
+        self.events.append(('NEW_DIR', path))
+
+    def onDeletedDirectory(self, path):
+        self.events.append(('DELETED_DIR', path))
+
+    def onEventLoss(self):
+        self.events.append(('EVENT_LOSS',))
+
+
+class ReconcilingActivityTest(unittest.TestCase):
+
+    BEFORE = {"/data": {"same": ("REGULAR", 1, 10), "rewritten": ("REGULAR", 1, 10),
+                        "deleted": ("REGULAR", 1, 10), "gone": ("DIR", 512, 10),
+                        "kept": ("DIR", 512, 10)},
+              "/data/gone": {"x": ("REGULAR", 1, 10)},
+              "/data/kept": {}}
+
+    AFTER = {"/data": {"same": ("REGULAR", 1, 10), "rewritten": ("REGULAR", 2, 20),
+                       "new": ("REGULAR", 1, 10), "kept": ("DIR", 512, 10),
+                       "made": ("DIR", 512, 10)},
+             "/data/kept": {},
+             "/data/made": {"y": ("REGULAR", 1, 10), "z": ("DIR", 512, 10)},
+             "/data/made/z": {}}
+
+    def setUp(self):
+        self.recorder = Recorder()
+        self.new_directories = []
+        self.deleted_directories = []
+        self.namespace = self.BEFORE
+        self.gate = None
+
+    def reconciler(self, recursive=True):
+        reconciler = snapshot.ReconcilingActivity(self.recorder, lambda args: Session(self.namespace, self.gate),
+                                                  {"endpoint": ENDPOINT}, recursive=recursive, workers=2,
+                                                  on_new_directories=self.new_directories.append,
+                                                  on_deleted_directory=self.deleted_directories.append)
+        for path, children in self.BEFORE.items():
+            reconciler.listed(path, listing(children))
+        return reconciler
+
+    def reconcile(self, reconciler):
+        "Report event loss and wait for the differences to be passed on"
+        reconciler.onEventLoss()
+        while reconciler.oldest_held() is not None:
+            time.sleep(0.01)
+            reconciler.flush()
+
+    def test_differences_are_reported_after_event_loss(self):
+        reconciler = self.reconciler()
+        self.namespace = self.AFTER
+        self.reconcile(reconciler)
+        self.assertEqual(self.recorder.events[0], ('EVENT_LOSS',))
+        self.assertEqual(sorted(self.recorder.events[1:]),
+                         [('DELETED_DIR', '/data/gone'), ('DELETED_FILE', '/data/deleted'),
+                          ('NEW_DIR', '/data/made'), ('NEW_DIR', '/data/made/z'),
+                          ('NEW_FILE', '/data/made/y'), ('NEW_FILE', '/data/new'),
+                          ('NEW_FILE', '/data/rewritten')])
+        self.assertEqual(self.new_directories, [['/data/made'], ['/data/made/z']])
+        self.assertEqual(self.deleted_directories, ['/data/gone'])
+
+    def test_second_reconcile_finds_nothing(self):
+        reconciler = self.reconciler()
+        self.namespace = self.AFTER
+        self.reconcile(reconciler)
+        self.recorder.events = []
+        self.reconcile(reconciler)
+        self.assertEqual(self.recorder.events, [('EVENT_LOSS',)])
+
+    def test_new_directories_are_not_walked_unless_recursive(self):
+        reconciler = self.reconciler(recursive=False)
+        self.namespace = self.AFTER
+        self.reconcile(reconciler)
+        self.assertNotIn(('NEW_FILE', '/data/made/y'), self.recorder.events)
+        self.assertIn(('NEW_DIR', '/data/made'), self.recorder.events)
+        self.assertEqual(self.new_directories, [])
+
+    def test_events_keep_the_snapshot_up_to_date(self):
+        reconciler = self.reconciler()
+        reconciler.onDeletedFile("/data/deleted")
+        reconciler.onDeletedDirectory("/data/gone")
+        reconciler.onMovedDirectory("/data/kept", "/data/moved")
+        self.namespace = {"/data": {"same": ("REGULAR", 1, 10), "rewritten": ("REGULAR", 1, 10),
+                                    "moved": ("DIR", 512, 10)},
+                          "/data/moved": {}}
+        self.recorder.events = []
+        self.reconcile(reconciler)
+        self.assertEqual(self.recorder.events, [('EVENT_LOSS',)])
+
+    def test_failed_listing_keeps_the_snapshot(self):
+        reconciler = self.reconciler()
+        reconciler.listed("/broken", listing({"f": ("REGULAR", 1, 10)}))
+        self.namespace = dict(self.BEFORE, **{"/broken": None})
+        self.reconcile(reconciler)
+        self.namespace = dict(self.BEFORE, **{"/broken": {}})
+        self.recorder.events = []
+        self.reconcile(reconciler)
+        self.assertEqual(self.recorder.events, [('EVENT_LOSS',), ('DELETED_FILE', '/broken/f')])
+
+    def test_events_during_a_reconcile_are_passed_on_after_it(self):
+        reconciler = self.reconciler()
+        self.namespace = self.AFTER
+        self.gate = threading.Event()
+        loss = activities.EVENT_NUMBERS.next()
+        reconciler.onEventLoss()
+        activities.EVENT_NUMBERS.next()
+        reconciler.onNewFile("/data/later")
+        self.assertEqual(self.recorder.events, [('EVENT_LOSS',)])
+        self.assertEqual(reconciler.oldest_held(), loss)
+        self.gate.set()
+        reconciler.close()
+        self.assertEqual(self.recorder.events[-1], ('NEW_FILE', '/data/later'))
+        self.assertIn(('NEW_FILE', '/data/new'), self.recorder.events)
+        self.assertIsNone(reconciler.oldest_held())
+
+    def test_files_seen_only_in_events_are_reported_again(self):
+        reconciler = self.reconciler()
+        reconciler.onNewFile("/data/same")
+        self.recorder.events = []
+        self.reconcile(reconciler)
+        self.assertEqual(self.recorder.events, [('EVENT_LOSS',), ('NEW_FILE', '/data/same')])
+        self.recorder.events = []
+        self.reconcile(reconciler)
+        self.assertEqual(self.recorder.events, [('EVENT_LOSS',)])
+
+    def test_populate_does_not_report(self):
+        reconciler = self.reconciler()
+        self.namespace = self.AFTER
+        reconciler.populate(["/data"])
+        self.assertEqual(self.recorder.events, [])
+        self.assertEqual(self.new_directories, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
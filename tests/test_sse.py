@@ -0,0 +1,53 @@
+import unittest
+import sse
+
+
+def split(data, *positions):
+    "Return data as the chunks between these positions"
+    bounds = [0] + list(positions) + [len(data)]
+    return [data[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+def parsed(chunks):
+    return [(m.event, m.id, m.data) for m in sse.parse(chunks)]
+
+
+class ParseTest(unittest.TestCase):
+
+    STREAM = (b"event: inotify\nid: 1\ndata: {\"a\": 1}\n\n"
+              b": a comment\n\n"
+              b"event: SYSTEM\r\nid: 2\r\ndata: x\r\n\r\n"
+              b"data: first\ndata: second\n\n"
+              b"event: custom\ndata: y\n\n")
+
+    EXPECTED = [('inotify', '1', '{"a": 1}'),
+                ('SYSTEM', '2', 'x'),
+                ('message', '2', 'first\nsecond'),
+                ('custom', '2', 'y')]
+
+    def test_whole_stream(self):
+        self.assertEqual(parsed([self.STREAM]), self.EXPECTED)
+
+    def test_every_split(self):
+        for position in range(1, len(self.STREAM)):
+            with self.subTest(position=position):
+                self.assertEqual(parsed(split(self.STREAM, position)), self.EXPECTED)
+
+    def test_one_byte_at_a_time(self):
+        self.assertEqual(parsed(split(self.STREAM, *range(1, len(self.STREAM)))), self.EXPECTED)
+
+    def test_crlf_message_is_yielded_without_more_data(self):
+        messages = sse.parse(iter([b"event: inotify\r\nid: 8\r\ndata: w\r\n\r\n"]))
+        self.assertEqual([(m.event, m.id, m.data) for m in messages], [('inotify', '8', 'w')])
+
+    def test_incomplete_message_is_held(self):
+        self.assertEqual(parsed([b"data: a\n\ndata: b\n"]), [('message', None, 'a')])
+
+    def test_retry(self):
+        retries = []
+        list(sse.parse([b"retry: 2500\n\n"], retries.append))
+        self.assertEqual(retries, [2.5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import os
+import tempfile
+import unittest
+import transfer
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def manifest(self, path="/in/a b.tar", size=100, checksum=("ADLER32", "0a0b0c0d")):
+        return transfer.Manifest(self.directory.name, path, ".tar", size, checksum)
+
+    def test_new_manifest_is_pending_until_removed(self):
+        manifest = self.manifest()
+        self.assertEqual(manifest.uploaded, {})
+        self.assertEqual(transfer.Manifest.pending(self.directory.name), [("/in/a b.tar", ".tar")])
+        manifest.remove()
+        self.assertEqual(transfer.Manifest.pending(self.directory.name), [])
+
+    def test_uploaded_members_are_remembered(self):
+        manifest = self.manifest()
+        manifest.done("m1", 10)
+        manifest.done("d/m 2", 20)
+        manifest.close()
+        manifest = self.manifest()
+        self.assertEqual(manifest.uploaded, {"m1": 10, "d/m 2": 20})
+        manifest.done("m3", 30)
+        manifest.close()
+        self.assertEqual(self.manifest().uploaded, {"m1": 10, "d/m 2": 20, "m3": 30})
+
+    def test_changed_archive_starts_afresh(self):
+        manifest = self.manifest()
+        manifest.done("m1", 10)
+        manifest.close()
+        self.assertEqual(self.manifest(size=101).uploaded, {})
+        self.assertEqual(self.manifest(size=101).uploaded, {})
+
+    def test_changed_checksum_starts_afresh(self):
+        manifest = self.manifest()
+        manifest.done("m1", 10)
+        manifest.close()
+        self.assertEqual(self.manifest(checksum=None).uploaded, {})
+
+    def test_archives_are_kept_apart(self):
+        first = self.manifest("/in/a.tar")
+        first.done("m1", 10)
+        first.close()
+        self.assertEqual(self.manifest("/in/b.tar").uploaded, {})
+        self.assertEqual(sorted(transfer.Manifest.pending(self.directory.name)),
+                         [("/in/a.tar", ".tar"), ("/in/b.tar", ".tar")])
+
+    def test_only_a_matching_manifest_is_resumed(self):
+        self.assertFalse(self.manifest().resumed)
+        self.assertTrue(self.manifest().resumed)
+        self.assertFalse(self.manifest(size=101).resumed)
+
+    def test_long_path(self):
+        path = "/in/" + "/".join(["d" * 200] * 5) + "/" + "\u00e9" * 200 + ".tar"
+        manifest = self.manifest(path)
+        manifest.done("m1", 10)
+        manifest.close()
+        self.assertEqual(self.manifest(path).uploaded, {"m1": 10})
+        self.assertEqual(transfer.Manifest.pending(self.directory.name), [(path, ".tar")])
+        self.assertLess(len(transfer.local_name(path)), 255)
+
+    def test_truncated_record_is_ignored(self):
+        manifest = self.manifest()
+        manifest.done("m1", 10)
+        manifest.close()
+        (name,) = os.listdir(self.directory.name)
+        with open(os.path.join(self.directory.name, name), "a") as f:
+            f.write("U 20 m2")
+        self.assertEqual(self.manifest().uploaded, {"m1": 10})
+
+
+class ChecksumTest(unittest.TestCase):
+
+    def test_adler32(self):
+        digest = transfer.Adler32()
+        digest.update(b"Wikipedia")
+        self.assertEqual(digest.hexdigest(), "11e60398")
+
+    def test_supported_checksum(self):
+        item = {"checksums": [{"type": "SHA1", "value": "x"}, {"type": "ADLER32", "value": "0A0B0C0D"}]}
+        self.assertEqual(transfer.supported_checksum(item), ("ADLER32", "0a0b0c0d"))
+        self.assertIsNone(transfer.supported_checksum({"checksums": None}))
+
+
+if __name__ == '__main__':
+    unittest.main()
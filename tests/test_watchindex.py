@@ -0,0 +1,87 @@
+import unittest
+import watchindex
+
+
+class WatchIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = watchindex.WatchIndex()
+        for watch, path in [("w1", "/a"), ("w2", "/a/b"), ("w3", "/a/b/c"), ("w4", "/d")]:
+            self.index.add(watch, path)
+
+    def test_lookup(self):
+        self.assertEqual(len(self.index), 4)
+        self.assertIn("w2", self.index)
+        self.assertEqual(self.index["w3"], "/a/b/c")
+        self.assertEqual(self.index.get("w9", "-"), "-")
+        self.assertEqual(self.index.watch_for("/a/b"), "w2")
+        self.assertEqual(self.index.watch_for("/a/b/"), "w2")
+        self.assertIsNone(self.index.watch_for("/a/x"))
+        self.assertEqual(sorted(self.index), ["w1", "w2", "w3", "w4"])
+
+    def test_new_watch_replaces_old_one_for_the_same_path(self):
+        self.index.add("w5", "/a/b")
+        self.assertNotIn("w2", self.index)
+        self.assertEqual(self.index.watch_for("/a/b"), "w5")
+        self.assertEqual(len(self.index), 4)
+
+    def test_remove(self):
+        self.assertEqual(self.index.remove("w2"), "/a/b")
+        self.assertIsNone(self.index.remove("w2"))
+        self.assertIsNone(self.index.watch_for("/a/b"))
+        self.assertEqual(self.index.watch_for("/a/b/c"), "w3")
+
+    def test_remove_prunes_empty_nodes(self):
+        self.index.add("w5", "/x/y/z")
+        self.index.remove("w5")
+        self.index.add("w6", "/x")
+        self.assertEqual(self.index.remove_subtree("/x"), [("w6", "/x")])
+
+    def test_remove_subtree(self):
+        removed = self.index.remove_subtree("/a/b")
+        self.assertEqual(sorted(removed), [("w2", "/a/b"), ("w3", "/a/b/c")])
+        self.assertEqual(sorted(self.index.items()), [("w1", "/a"), ("w4", "/d")])
+        self.assertEqual(self.index.remove_subtree("/nowhere"), [])
+
+    def test_remove_everything(self):
+        self.assertEqual(len(self.index.remove_subtree("/")), 4)
+        self.assertEqual(len(self.index), 0)
+        self.index.add("w1", "/a")
+        self.assertEqual(self.index.items(), [("w1", "/a")])
+
+    def test_rename(self):
+        self.assertEqual(self.index.rename("/a/b", "/e/f"), [])
+        self.assertEqual(sorted(self.index.items()),
+                         [("w1", "/a"), ("w2", "/e/f"), ("w3", "/e/f/c"), ("w4", "/d")])
+        self.assertEqual(self.index.watch_for("/e/f/c"), "w3")
+        self.assertIsNone(self.index.watch_for("/a/b"))
+
+    def test_rename_replaces_watches_at_the_target(self):
+        replaced = self.index.rename("/a/b", "/d")
+        self.assertEqual(replaced, [("w4", "/d")])
+        self.assertEqual(sorted(self.index.items()), [("w1", "/a"), ("w2", "/d"), ("w3", "/d/c")])
+
+    def test_rename_of_unwatched_path(self):
+        self.assertEqual(self.index.rename("/x", "/y"), [])
+        self.assertEqual(len(self.index), 4)
+
+    def test_rename_to_itself(self):
+        self.assertEqual(self.index.rename("/a/b", "/a/b/"), [])
+        self.assertEqual(self.index.watch_for("/a/b/c"), "w3")
+        self.assertEqual(len(self.index), 4)
+
+    def test_rename_below_itself(self):
+        with self.assertRaises(Exception):
+            self.index.rename("/a/b", "/a/b/c/e")
+        self.assertEqual(len(self.index), 4)
+        self.assertEqual(self.index.rename("/a/b", "/a/bc"), [])
+        self.assertEqual(self.index.watch_for("/a/bc/c"), "w3")
+
+    def test_clear(self):
+        self.index.clear()
+        self.assertEqual(len(self.index), 0)
+        self.assertIsNone(self.index.watch_for("/a"))
+
+
+if __name__ == '__main__':
+    unittest.main()
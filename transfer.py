@@ -0,0 +1,241 @@
+"""Download large files as concurrent ranges, resuming interrupted downloads."""
+from concurrent.futures import wait
+from threading import Lock, BoundedSemaphore
+from urllib.parse import urljoin, quote, unquote
+import hashlib
+import zlib
+import os
+
+
+class Adler32:
+    """Incremental ADLER32, with the same interface as hashlib's objects."""
+
+    def __init__(self):
+        self.__value = 1
+
+    def update(self, data):
+        self.__value = zlib.adler32(data, self.__value)
+
+    def hexdigest(self):
+        return "%08x" % self.__value
+
+
+# The checksum types dCache reports that can be verified, by name.
+CHECKSUMS = {'ADLER32': Adler32, 'MD5_TYPE': hashlib.md5}
+
+
+def file_info(session, url):
+    """
+    Return the size of a file, given its namespace URL in the REST API, and
+    one checksum to verify it with, as a (type, value) tuple, or None if
+    dCache knows no checksum of a supported type.
+    """
+    r = session.get(url, params={"checksum": "true"})
+    r.raise_for_status()
+    info = r.json()
+    return (info["size"], supported_checksum(info))
+
+
+def supported_checksum(item):
+    "Return a checksum of a namespace entry that can be verified, as (type, value), or None"
+    return next(((c["type"], c["value"].lower()) for c in item.get("checksums") or []
+                 if c["type"] in CHECKSUMS), None)
+
+
+def checksum_of(local_path, checksum_type, buffer_size=1024*1024):
+    "Return the checksum of a local file"
+    digest = CHECKSUMS[checksum_type]()
+    with open(local_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(buffer_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Download:
+    """
+    Fetch a file of known size into local_path as parts of part_size
+    bytes, each with its own Range request, running on executor with at
+    most workers requests for this file at any time.  The door for each
+    request is taken from door_url, so the parts of one file may be
+    fetched through different doors; session returns the calling thread's
+    session.
+
+    The parts that have been written are recorded in a sidecar file,
+    local_path + '.parts', so a later Download of the same file fetches
+    only the missing parts.  The sidecar starts with the size and checksum
+    of the file; if they differ, the file is fetched from scratch.  A part
+    that fails is retried up to retries times.  Once all parts are written
+    the file is verified against checksum, if known, and the sidecar is
+    removed.
+    """
+
+    def __init__(self, session, door_url, path, local_path, size, checksum=None,
+                 part_size=64*1024*1024, workers=4, retries=3, buffer_size=1024*1024):
+        self.__session = session
+        self.__door_url = door_url
+        self.__path = path
+        self.__local_path = local_path
+        self.__sidecar = local_path + '.parts'
+        self.__size = size
+        self.__checksum = checksum
+        self.__part_size = part_size
+        self.__workers = workers
+        self.__retries = retries
+        self.__buffer_size = buffer_size
+        self.__lock = Lock()
+
+    def run(self, executor):
+        "Fetch all missing parts and verify the result, raising an Exception if that fails"
+        parts = range((self.__size + self.__part_size - 1) // self.__part_size)
+        done = self.__resume()
+        missing = [part for part in parts if part not in done]
+        if done:
+            print("Resuming download of %s: %d of %d parts already fetched"
+                  % (self.__path, len(parts) - len(missing), len(parts)))
+
+        slots = BoundedSemaphore(self.__workers)
+        fetches = []
+        with open(self.__sidecar, 'a') as self.__progress:
+            for part in missing:
+                slots.acquire()
+                fetch = executor.submit(self.__fetch, part)
+                fetch.add_done_callback(lambda f: slots.release())
+                fetches.append(fetch)
+            wait(fetches)
+        failures = [f.exception() for f in fetches if f.exception()]
+        if failures:
+            raise Exception('%d of %d parts of %s failed, first: %s'
+                            % (len(failures), len(fetches), self.__path, failures[0]))
+
+        if self.__checksum:
+            (checksum_type, expected) = self.__checksum
+            actual = checksum_of(self.__local_path, checksum_type, self.__buffer_size)
+            if actual != expected:
+                os.remove(self.__local_path)
+                os.remove(self.__sidecar)
+                raise Exception('%s checksum mismatch for %s: expected %s, got %s'
+                                % (checksum_type, self.__path, expected, actual))
+        os.remove(self.__sidecar)
+
+    def __header(self):
+        checksum = ":".join(self.__checksum) if self.__checksum else "-"
+        return "%d %s\n" % (self.__size, checksum)
+
+    def __resume(self):
+        "Return the parts already written, starting afresh if there is no usable progress"
+        if os.path.exists(self.__sidecar) and os.path.exists(self.__local_path):
+            with open(self.__sidecar) as f:
+                lines = f.readlines()
+            if lines and lines[0] == self.__header():
+                return {int(line) for line in lines[1:] if line.endswith("\n")}
+
+        with open(self.__local_path, 'wb') as f:
+            f.truncate(self.__size)
+        with open(self.__sidecar, 'w') as f:
+            f.write(self.__header())
+        return set()
+
+    def __fetch(self, part):
+        start = part * self.__part_size
+        end = min(start + self.__part_size, self.__size) - 1
+        for attempt in range(self.__retries + 1):
+            try:
+                self.__fetch_range(start, end)
+                break
+            except Exception as e:
+                if attempt == self.__retries:
+                    raise
+                print("Retrying bytes %d-%d of %s: %s" % (start, end, self.__path, e))
+
+        with self.__lock:
+            self.__progress.write("%d\n" % part)
+            self.__progress.flush()
+
+    def __fetch_range(self, start, end):
+        url = urljoin(self.__door_url(), self.__path)
+        headers = {'Range': 'bytes=%d-%d' % (start, end)}
+        with self.__session().get(url, headers=headers, allow_redirects=True, stream=True) as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise Exception('Door %s ignored the range request' % url)
+            with open(self.__local_path, 'r+b') as f:
+                f.seek(start)
+                written = 0
+                for chunk in r.iter_content(chunk_size=self.__buffer_size):
+                    f.write(chunk)
+                    written += len(chunk)
+                if written != end - start + 1:
+                    raise Exception('Received %d of %d bytes' % (written, end - start + 1))
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def local_name(path):
+    "Return a name for a local file about path, short enough for any file system"
+    return hashlib.sha256(path.encode()).hexdigest()
+
+
+class Manifest:
+    """
+    The progress of extracting one archive: which of its members have been
+    uploaded.  The manifest is a file in directory, named by local_name
+    after the archive, with one line per record:
+
+        A <size> <checksum> <extension> <archive path>
+        U <size> <member path>
+
+    Paths are URL-encoded.  If the archive's size or checksum no longer
+    match, the manifest is started afresh; otherwise resumed is True, as
+    an earlier attempt may have uploaded members it did not record.  The
+    manifest is removed once the archive has been extracted completely.
+    """
+
+    SUFFIX = '.manifest'
+
+    def __init__(self, directory, path, extension, size, checksum):
+        self.__file_path = os.path.join(directory, local_name(path) + self.SUFFIX)
+        self.__header = "A %d %s %s %s\n" % (size, ":".join(checksum) if checksum else "-",
+                                             extension, quote(path))
+        self.__lock = Lock()
+        self.uploaded = {}
+        self.resumed = False
+        if os.path.exists(self.__file_path):
+            with open(self.__file_path) as f:
+                lines = f.readlines()
+            if lines and lines[0] == self.__header:
+                self.resumed = True
+                for line in lines[1:]:
+                    if line.startswith("U ") and line.endswith("\n"):
+                        (_, size, member) = line.split()
+                        self.uploaded[unquote(member)] = int(size)
+        if not self.resumed:
+            with open(self.__file_path, 'w') as f:
+                f.write(self.__header)
+        self.__file = open(self.__file_path, 'a')
+
+    @classmethod
+    def pending(cls, directory):
+        "Return the (path, extension) of each archive with a manifest in directory"
+        archives = []
+        for name in os.listdir(directory):
+            if name.endswith(cls.SUFFIX):
+                with open(os.path.join(directory, name)) as f:
+                    header = f.readline().split()
+                if len(header) == 5 and header[0] == "A":
+                    archives.append((unquote(header[4]), header[3]))
+        return archives
+
+    def done(self, member, size):
+        "Record that a member has been uploaded"
+        with self.__lock:
+            self.__file.write("U %d %s\n" % (size, quote(member)))
+            self.__file.flush()
+
+    def remove(self):
+        with self.__lock:
+            self.__file.close()
+            os.remove(self.__file_path)
+
+    def close(self):
+        with self.__lock:
+            self.__file.close()
@@ -0,0 +1,163 @@
+"""Index the established watches by both watch URL and path."""
+from threading import RLock
+
+
+class Node:
+    """One component of a path, possibly with a watch."""
+    __slots__ = ('name', 'parent', 'children', 'watch')
+
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.children = {}
+        self.watch = None
+
+
+class WatchIndex:
+    """
+    The established watches, looked up by watch URL or by path.  Paths are
+    stored as a trie of path components, and a path is rebuilt from its
+    node when needed, so looking up a path costs O(depth), renaming a
+    directory costs O(depth) however many watches are below it, and
+    removing a directory costs O(depth) plus the number of watches removed.
+
+    Reading by watch URL works as for a dict mapping watch to path.
+    """
+
+    def __init__(self):
+        self.__lock = RLock()
+        self.__root = Node("", None)
+        self.__by_watch = {}
+
+    def __len__(self):
+        return len(self.__by_watch)
+
+    def __contains__(self, watch):
+        return watch in self.__by_watch
+
+    def __iter__(self):
+        return iter(list(self.__by_watch))
+
+    def __getitem__(self, watch):
+        with self.__lock:
+            return self.__path(self.__by_watch[watch])
+
+    def get(self, watch, default=None):
+        with self.__lock:
+            node = self.__by_watch.get(watch)
+            return default if node is None else self.__path(node)
+
+    def items(self):
+        with self.__lock:
+            return [(watch, self.__path(node)) for watch, node in self.__by_watch.items()]
+
+    def add(self, watch, path):
+        with self.__lock:
+            node = self.__node(path, create=True)
+            if node.watch is not None:
+                del self.__by_watch[node.watch]
+            node.watch = watch
+            self.__by_watch[watch] = node
+
+    def remove(self, watch):
+        "Remove a watch, returning its path, or None if there is no such watch"
+        with self.__lock:
+            node = self.__by_watch.pop(watch, None)
+            if node is None:
+                return None
+            path = self.__path(node)
+            node.watch = None
+            self.__prune(node)
+            return path
+
+    def clear(self):
+        with self.__lock:
+            self.__root = Node("", None)
+            self.__by_watch = {}
+
+    def watch_for(self, path):
+        "Return the watch for path, or None if it is not watched"
+        with self.__lock:
+            node = self.__node(path)
+            return None if node is None else node.watch
+
+    def rename(self, fromPath, toPath):
+        """
+        Move all watches at or below fromPath to toPath, returning a list
+        of (watch, path) pairs of any watches below toPath that were
+        replaced.  Renaming a path to itself changes nothing; renaming it
+        to a path below itself is an error.
+        """
+        components = self.__components(toPath)
+        from_components = self.__components(fromPath)
+        if components[:len(from_components)] == from_components:
+            if components == from_components:
+                return []
+            raise Exception('Cannot move ' + fromPath + ' to ' + toPath + ', which is below it')
+        with self.__lock:
+            node = self.__node(fromPath)
+            if node is None:
+                return []
+            replaced = self.remove_subtree(toPath)
+            old_parent = node.parent
+            del old_parent.children[node.name]
+            self.__prune(old_parent)
+
+            new_parent = self.__node_at(components[:-1], create=True)
+            node.name = components[-1]
+            node.parent = new_parent
+            new_parent.children[node.name] = node
+            return replaced
+
+    def remove_subtree(self, path):
+        "Remove all watches at or below path, returning a list of (watch, path) pairs"
+        with self.__lock:
+            node = self.__node(path)
+            if node is None:
+                return []
+            removed = []
+            pending = [(node, self.__path(node))]
+            while pending:
+                (current, current_path) = pending.pop()
+                if current.watch is not None:
+                    removed.append((current.watch, current_path))
+                    del self.__by_watch[current.watch]
+                prefix = current_path.rstrip("/") + "/"
+                pending.extend((child, prefix + name) for name, child in current.children.items())
+            if node.parent is None:
+                self.__root = Node("", None)
+            else:
+                del node.parent.children[node.name]
+                self.__prune(node.parent)
+            return removed
+
+    def __components(self, path):
+        return [name for name in path.split("/") if name]
+
+    def __node(self, path, create=False):
+        return self.__node_at(self.__components(path), create)
+
+    def __node_at(self, components, create=False):
+        node = self.__root
+        for name in components:
+            child = node.children.get(name)
+            if child is None:
+                if not create:
+                    return None
+                child = Node(name, node)
+                node.children[name] = child
+            node = child
+        return node
+
+    def __prune(self, node):
+        "Remove nodes that no longer lead to any watch"
+        while node.parent is not None and node.watch is None and not node.children:
+            del node.parent.children[node.name]
+            node = node.parent
+
+    def __path(self, node):
+        names = []
+        while node.parent is not None:
+            names.append(node.name)
+            node = node.parent
+        return "/" + "/".join(reversed(names))